@@ -1,10 +1,31 @@
 from __future__ import print_function
+import abc
+import argparse
+import asyncio
 import datetime
-import io
+import glob
+import hashlib
+import heapq
+import json
 import os
+import pathlib
+import queue
+import random
+import re
+import shlex
+import shutil
+import signal
+import sqlite3
+import subprocess
 import sys
+import tempfile
 import time
+import urllib.parse
+import urllib.request
 import logging
+import multiprocessing
+import threading
+import concurrent.futures
 import config
 
 """
@@ -15,6 +36,7 @@ from azure.identity import DefaultAzureCredential
 from azure.storage.blob import (
     BlobServiceClient,
     BlobSasPermissions,
+    ContentSettings,
     generate_blob_sas,
     generate_container_sas,
 )
@@ -22,7 +44,11 @@ from azure.batch import BatchServiceClient
 from azure.batch import models as batchmodels
 from azure.batch import batch_auth
 from msrest.authentication import BasicTokenAuthentication
-from azure.core.exceptions import HttpResponseError
+from msrest.exceptions import ClientRequestError
+from azure.core import MatchConditions
+from azure.core.exceptions import AzureError, HttpResponseError, ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
+import requests
 
 sys.path.append('.')
 sys.path.append('..')
@@ -66,13 +92,101 @@ def log_batch_exception(batch_exception):
     log.error("----------------------")
 
 
+class UserDelegationKeyCache:
+    """ユーザー委任キーを有効期限付きでキャッシュする（スレッドセーフ）。
+
+    要求された SAS の有効期限 + refresh_margin までキーが有効な間は再利用し、
+    期限が近づいたら 1 スレッドだけが再取得する（他のスレッドはロックで待機）。
+    キーは要求された期限より lifetime だけ長く取得するので、lifetime より長い SAS を繰り返し
+    発行する場合（監視モードの 24 時間 SAS など）も、lifetime の間は同じキーを再利用できる。
+    """
+    # ユーザー委任キーの有効期間の上限（サービス仕様: 7 日）
+    MAX_LIFETIME = datetime.timedelta(days=7)
+
+    def __init__(self, fetch, lifetime=datetime.timedelta(hours=6),
+                 refresh_margin=datetime.timedelta(minutes=10)):
+        self._fetch = fetch
+        self.lifetime = lifetime
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._key = None
+        self._expiry = None
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, valid_until):
+        if self._key is not None and self._expiry >= valid_until + self.refresh_margin:
+            self.hits += 1
+            return self._key
+        self.misses += 1
+        return None
+
+    def _refresh_window(self, valid_until):
+        now = datetime.datetime.now(datetime.UTC)
+        expiry = max(now + self.lifetime, valid_until + self.refresh_margin + self.lifetime)
+        expiry = min(expiry, now + self.MAX_LIFETIME)
+        log.debug("Fetching user delegation key (valid until %s)", expiry.isoformat())
+        return now - datetime.timedelta(minutes=5), expiry
+
+    def get(self, valid_until: datetime.datetime):
+        """valid_until まで（refresh_margin 込みで）有効なキーを返す。"""
+        with self._lock:
+            key = self._cached(valid_until)
+            if key is None:
+                start, expiry = self._refresh_window(valid_until)
+                self._key = key = self._fetch(start, expiry)
+                self._expiry = expiry
+            return key
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "expiry": self._expiry.isoformat() if self._expiry else None}
+
+
+class AsyncUserDelegationKeyCache(UserDelegationKeyCache):
+    """UserDelegationKeyCache の asyncio 版（fetch はコルーチン関数）。"""
+    def __init__(self, fetch, lifetime=datetime.timedelta(hours=6),
+                 refresh_margin=datetime.timedelta(minutes=10)):
+        super().__init__(fetch, lifetime=lifetime, refresh_margin=refresh_margin)
+        self._async_lock = asyncio.Lock()
+
+    async def get(self, valid_until: datetime.datetime):
+        async with self._async_lock:
+            with self._lock:
+                key = self._cached(valid_until)
+            if key is None:
+                start, expiry = self._refresh_window(valid_until)
+                key = await self._fetch(start, expiry)
+                with self._lock:
+                    self._key, self._expiry = key, expiry
+            return key
+
+
 class StorageV12:
     """Entra ID + v12 SDK のラッパー（ユーザー委任 SAS を発行）。"""
-    def __init__(self, account_name: str, credential: DefaultAzureCredential):
+    def __init__(self, account_name: str, credential: DefaultAzureCredential,
+                 max_block_size: int = None, max_single_put_size: int = None,
+                 connection_pool_size: int = None, key_lifetime_hours: float = 6):
         self.account_name = account_name
         self.account_url = f"https://{account_name}.blob.core.windows.net"
         self.cred = credential
-        self.svc = BlobServiceClient(account_url=self.account_url, credential=self.cred)
+        self.key_cache = UserDelegationKeyCache(
+            self._fetch_user_delegation_key,
+            lifetime=datetime.timedelta(hours=key_lifetime_hours))
+        client_kwargs = {}
+        if max_block_size:
+            client_kwargs['max_block_size'] = max_block_size
+        if max_single_put_size:
+            client_kwargs['max_single_put_size'] = max_single_put_size
+        if connection_pool_size:
+            # requests の既定プール (10 接続) では並列アップロード時に接続が使い捨てになるため拡張する
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=connection_pool_size,
+                                                    pool_maxsize=connection_pool_size)
+            session.mount('https://', adapter)
+            client_kwargs['transport'] = RequestsTransport(session=session)
+        self.svc = BlobServiceClient(account_url=self.account_url, credential=self.cred, **client_kwargs)
 
     def ensure_container(self, container_name: str):
         client = self.svc.get_container_client(container_name)
@@ -90,19 +204,173 @@ class StorageV12:
                 log.error("Also verify you're signed in to the correct tenant/subscription (az login / VS Code Azure extension).")
             raise
 
-    def upload_blob_from_path(self, container_name: str, blob_name: str, file_path: str, overwrite=True):
+    def upload_blob_from_path(self, container_name: str, blob_name: str, file_path: str, overwrite=True,
+                              max_concurrency: int = 1, md5_hex: str = None):
+        """1 ファイルをアップロードし、サイズ/所要時間/スループットを返す。
+
+        max_concurrency > 1 の場合、max_block_size 単位のブロックを並列に送信する。
+        md5_hex を渡すと Content-MD5 とメタデータ (source_md5) に記録する（差分アップロードの比較用）。
+        """
         log.info("Upload: %s -> container '%s' blob '%s'", file_path, container_name, blob_name)
         blob = self.svc.get_blob_client(container=container_name, blob=blob_name)
+        size = os.path.getsize(file_path)
+        upload_kwargs = {}
+        if md5_hex:
+            upload_kwargs['metadata'] = {'source_md5': md5_hex}
+            upload_kwargs['content_settings'] = ContentSettings(content_md5=bytearray.fromhex(md5_hex))
+        started = time.monotonic()
         with open(file_path, "rb") as f:
-            blob.upload_blob(f, overwrite=overwrite)
+            blob.upload_blob(f, length=size, overwrite=overwrite, max_concurrency=max_concurrency,
+                             **upload_kwargs)
+        elapsed = time.monotonic() - started
+        mb_per_sec = (size / (1024 * 1024)) / elapsed if elapsed > 0 else 0.0
+        log.info("Uploaded '%s': %.1f MB in %.2fs (%.1f MB/s)", blob_name, size / (1024 * 1024), elapsed, mb_per_sec)
+        return {"blob_name": blob_name, "bytes": size, "seconds": elapsed, "mb_per_sec": mb_per_sec}
+
+    def upload_blobs_from_paths(self, container_name: str, items, max_workers: int = 4,
+                                max_concurrency: int = 4, overwrite=True, on_uploaded=None):
+        """(blob_name, file_path[, md5_hex]) の列を有界スレッドプールで並列アップロードする。
+
+        戻り値は入力と同じ順序の統計 dict のリスト。いずれかが失敗した場合は未着手分を取り消して例外を送出する。
+        on_uploaded を渡すと、1 件完了するごとに（呼び出し元のスレッドで）その item を渡して呼ぶ。
+        """
+        items = list(items)
+        if not items:
+            return []
+        started = time.monotonic()
+        results = [None] * len(items)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            futures = {
+                pool.submit(self.upload_blob_from_path, container_name, item[0], item[1],
+                            overwrite, max_concurrency, item[2] if len(item) > 2 else None): idx
+                for idx, item in enumerate(items)}
+            try:
+                for fut in concurrent.futures.as_completed(futures):
+                    results[futures[fut]] = fut.result()
+                    if on_uploaded is not None:
+                        on_uploaded(items[futures[fut]])
+            except BaseException:
+                for fut in futures:
+                    fut.cancel()
+                raise
+        elapsed = time.monotonic() - started
+        total_mb = sum(r["bytes"] for r in results) / (1024 * 1024)
+        log.info("Uploaded %d files to '%s': %.1f MB in %.2fs (%.1f MB/s aggregate)",
+                 len(results), container_name, total_mb, elapsed, total_mb / elapsed if elapsed > 0 else 0.0)
+        return results
+
+    def get_blob_properties_or_none(self, container_name: str, blob_name: str):
+        blob = self.svc.get_blob_client(container=container_name, blob=blob_name)
+        try:
+            return blob.get_blob_properties()
+        except ResourceNotFoundError:
+            return None
+
+    def download_blob_to_path(self, container_name: str, blob_name: str, file_path: str, etag: str = None,
+                              max_concurrency: int = 4):
+        """1 Blob を file_path + '.part' にストリーミングで書き込み、完了後に file_path へ置き換える。
+
+        max_single_get_size を超える Blob は範囲ごとのチャンクに分けて max_concurrency 並列で取得する
+        （メモリに保持するのは並列数 x チャンク分だけ）。etag を渡すと、一覧後に更新された Blob は取得しない。
+        戻り値はサイズ/ETag/所要時間。
+        """
+        blob = self.svc.get_blob_client(container=container_name, blob=blob_name)
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        part_path = file_path + '.part'
+        condition = {'etag': etag, 'match_condition': MatchConditions.IfNotModified} if etag else {}
+        started = time.monotonic()
+        downloader = blob.download_blob(max_concurrency=max_concurrency, **condition)
+        with open(part_path, 'wb') as f:
+            size = downloader.readinto(f)
+        os.replace(part_path, file_path)
+        return {"blob": blob_name, "bytes": size, "etag": downloader.properties.etag,
+                "seconds": time.monotonic() - started}
+
+    def download_blobs(self, container_name: str, items, max_workers: int = 8, max_concurrency: int = 4,
+                       on_downloaded=None) -> dict:
+        """(blob_name, file_path[, etag]) の列を有界スレッドプールで並列ダウンロードする。
+
+        items は遅延評価で消費し、同時に保持するのは max_workers x 2 件まで。on_downloaded(item, stats) は
+        各ダウンロードの完了時に呼ばれる。戻り値は件数/バイト数/所要時間。
+        """
+        started = time.monotonic()
+        report = {"downloaded": 0, "bytes": 0}
+        max_in_flight = max(1, max_workers) * 2
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            in_flight = {}
+
+            def _drain(return_when):
+                done, _ = concurrent.futures.wait(in_flight, return_when=return_when)
+                for fut in done:
+                    item = in_flight.pop(fut)
+                    stats = fut.result()
+                    report["downloaded"] += 1
+                    report["bytes"] += stats["bytes"]
+                    if on_downloaded is not None:
+                        on_downloaded(item, stats)
 
-    def _get_user_delegation_key(self, hours=2):
-        now = datetime.datetime.now(datetime.UTC)
+            try:
+                for item in items:
+                    if len(in_flight) >= max_in_flight:
+                        _drain(concurrent.futures.FIRST_COMPLETED)
+                    in_flight[pool.submit(self.download_blob_to_path, container_name, item[0], item[1],
+                                          item[2] if len(item) > 2 else None, max_concurrency)] = item
+                if in_flight:
+                    _drain(concurrent.futures.ALL_COMPLETED)
+            except BaseException:
+                for fut in in_flight:
+                    fut.cancel()
+                raise
+        report["seconds"] = round(time.monotonic() - started, 2)
+        if report["downloaded"]:
+            total_mb = report["bytes"] / (1024 * 1024)
+            log.info("Downloaded %d blobs from '%s': %.1f MB in %.2fs (%.1f MB/s aggregate)",
+                     report["downloaded"], container_name, total_mb, report["seconds"],
+                     total_mb / report["seconds"] if report["seconds"] > 0 else 0.0)
+        return report
+
+    def list_blob_properties(self, container_name: str, name_starts_with: str = None):
+        """コンテナー内の Blob をメタデータ付きで 1 回の一覧取得で返す（name -> BlobProperties）。"""
+        client = self.svc.get_container_client(container_name)
+        return {b.name: b for b in client.list_blobs(name_starts_with=name_starts_with, include=['metadata'])}
+
+    def iter_blob_pages(self, container_name: str, name_starts_with: str = None, results_per_page: int = 5000):
+        """コンテナーを results_per_page 件ずつのページで一覧し、ページ（BlobProperties のリスト）を逐次返す。
+
+        一度に保持するのは 1 ページ分だけなので、数百万件のコンテナーでもメモリ使用量は一定。
+        """
+        client = self.svc.get_container_client(container_name)
+        pages = client.list_blobs(name_starts_with=name_starts_with, results_per_page=results_per_page).by_page()
+        for page in pages:
+            yield list(page)
+
+    def blob_url(self, container_name: str, blob_name: str, sas: str = None) -> str:
+        url = f"{self.account_url}/{container_name}/{urllib.parse.quote(blob_name, safe='/')}"
+        return f"{url}?{sas}" if sas else url
+
+    def start_blob_copy(self, container_name: str, blob_name: str, source_url: str, metadata: dict = None) -> str:
+        """source_url からのサーバー側コピーを開始し、コピー状態（'success' / 'pending'）を返す"""
+        blob = self.svc.get_blob_client(container=container_name, blob=blob_name)
+        return blob.start_copy_from_url(source_url, metadata=metadata)['copy_status']
+
+    def get_blob_copy_status(self, container_name: str, blob_name: str) -> str:
+        props = self.svc.get_blob_client(container=container_name, blob=blob_name).get_blob_properties()
+        return props.copy.status
+
+    def set_blob_metadata(self, container_name: str, blob_name: str, metadata: dict):
+        self.svc.get_blob_client(container=container_name, blob=blob_name).set_blob_metadata(metadata)
+
+    def _fetch_user_delegation_key(self, key_start_time, key_expiry_time):
         return self.svc.get_user_delegation_key(
-            key_start_time=now - datetime.timedelta(minutes=5),
-            key_expiry_time=now + datetime.timedelta(hours=hours)
+            key_start_time=key_start_time,
+            key_expiry_time=key_expiry_time
         )
 
+    def _get_user_delegation_key(self, hours=2):
+        """hours 後まで有効なユーザー委任キーを返す（キャッシュ経由、ヒット時は通信なし）。"""
+        now = datetime.datetime.now(datetime.UTC)
+        return self.key_cache.get(now + datetime.timedelta(hours=hours))
+
     def make_blob_user_delegation_sas_url(self, container_name: str, blob_name: str,
                                           permissions: BlobSasPermissions,
                                           expiry_hours: int = 2) -> str:
@@ -130,6 +398,16 @@ class StorageV12:
         )
         return f"{self.account_url}/{container_name}?{sas}"
 
+    def delete_blobs_with_prefix(self, container_name: str, prefix: str) -> int:
+        """prefix 配下の Blob をバッチ削除（1 リクエスト最大 256 件）し、削除件数を返す"""
+        client = self.svc.get_container_client(container_name)
+        names = [b.name for b in client.list_blobs(name_starts_with=prefix)]
+        for i in range(0, len(names), 256):
+            client.delete_blobs(*names[i:i + 256])
+        if names:
+            log.info("Deleted %d blobs under '%s/%s'", len(names), container_name, prefix)
+        return len(names)
+
     def delete_container_if_exists(self, container_name: str):
         client = self.svc.get_container_client(container_name)
         if client.exists():
@@ -139,32 +417,495 @@ class StorageV12:
             log.debug("Container '%s' does not exist (skip delete)", container_name)
 
 
+class AsyncStorageV12:
+    """StorageV12 の asyncio 版（azure.storage.blob.aio）。
+
+    async with で使う。全リクエストは接続数上限付きの 1 つの aiohttp セッションを共有する。
+    credential は azure.identity.aio の資格情報を渡す。
+    """
+    def __init__(self, account_name: str, credential, max_block_size: int = None,
+                 max_single_put_size: int = None, connection_limit: int = 64,
+                 key_lifetime_hours: float = 6):
+        self.account_name = account_name
+        self.account_url = f"https://{account_name}.blob.core.windows.net"
+        self.cred = credential
+        self.connection_limit = connection_limit
+        self._client_kwargs = {}
+        if max_block_size:
+            self._client_kwargs['max_block_size'] = max_block_size
+        if max_single_put_size:
+            self._client_kwargs['max_single_put_size'] = max_single_put_size
+        self.key_cache = AsyncUserDelegationKeyCache(
+            self._fetch_user_delegation_key,
+            lifetime=datetime.timedelta(hours=key_lifetime_hours))
+        self._session = None
+        self.svc = None
+
+    async def __aenter__(self):
+        # aio SDK は aiohttp が必要（requirements.txt 参照）
+        import aiohttp
+        from azure.core.pipeline.transport import AioHttpTransport
+        from azure.storage.blob.aio import BlobServiceClient as AioBlobServiceClient
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connection_limit))
+        self.svc = AioBlobServiceClient(
+            account_url=self.account_url, credential=self.cred,
+            transport=AioHttpTransport(session=self._session, session_owner=False), **self._client_kwargs)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.svc.close()
+        await self._session.close()
+
+    async def ensure_container(self, container_name: str):
+        client = self.svc.get_container_client(container_name)
+        if await client.exists():
+            log.debug("Container '%s': exists", container_name)
+        else:
+            await self.svc.create_container(container_name)
+            log.info("Created container '%s'", container_name)
+
+    async def upload_blob_from_path(self, container_name: str, blob_name: str, file_path: str, overwrite=True,
+                                    max_concurrency: int = 1, md5_hex: str = None):
+        log.info("Upload: %s -> container '%s' blob '%s'", file_path, container_name, blob_name)
+        blob = self.svc.get_blob_client(container=container_name, blob=blob_name)
+        size = os.path.getsize(file_path)
+        upload_kwargs = {}
+        if md5_hex:
+            upload_kwargs['metadata'] = {'source_md5': md5_hex}
+            upload_kwargs['content_settings'] = ContentSettings(content_md5=bytearray.fromhex(md5_hex))
+        started = time.monotonic()
+        with open(file_path, "rb") as f:
+            await blob.upload_blob(f, length=size, overwrite=overwrite, max_concurrency=max_concurrency,
+                                   **upload_kwargs)
+        elapsed = time.monotonic() - started
+        mb_per_sec = (size / (1024 * 1024)) / elapsed if elapsed > 0 else 0.0
+        log.info("Uploaded '%s': %.1f MB in %.2fs (%.1f MB/s)", blob_name, size / (1024 * 1024), elapsed, mb_per_sec)
+        return {"blob_name": blob_name, "bytes": size, "seconds": elapsed, "mb_per_sec": mb_per_sec}
+
+    async def get_blob_properties_or_none(self, container_name: str, blob_name: str):
+        blob = self.svc.get_blob_client(container=container_name, blob=blob_name)
+        try:
+            return await blob.get_blob_properties()
+        except ResourceNotFoundError:
+            return None
+
+    async def _fetch_user_delegation_key(self, key_start_time, key_expiry_time):
+        return await self.svc.get_user_delegation_key(
+            key_start_time=key_start_time,
+            key_expiry_time=key_expiry_time
+        )
+
+    async def make_blob_user_delegation_sas_url(self, container_name: str, blob_name: str,
+                                                permissions: BlobSasPermissions,
+                                                expiry_hours: int = 2) -> str:
+        now = datetime.datetime.now(datetime.UTC)
+        udk = await self.key_cache.get(now + datetime.timedelta(hours=expiry_hours))
+        sas = generate_blob_sas(
+            account_name=self.account_name,
+            container_name=container_name,
+            blob_name=blob_name,
+            user_delegation_key=udk,
+            permission=permissions,
+            expiry=now + datetime.timedelta(hours=expiry_hours)
+        )
+        return f"{self.account_url}/{container_name}/{blob_name}?{sas}"
+
+    async def delete_container_if_exists(self, container_name: str):
+        client = self.svc.get_container_client(container_name)
+        if await client.exists():
+            log.info("Deleting container '%s'", container_name)
+            await self.svc.delete_container(container_name)
+        else:
+            log.debug("Container '%s' does not exist (skip delete)", container_name)
+
+
 class AADTokenCredentials(BasicTokenAuthentication):
-    """毎リクエスト直前に AAD トークンを更新し、msrest 既定の挙動で送る安全版。"""
-    def __init__(self, credential: DefaultAzureCredential, scope: str):
+    """AAD トークンを有効期限付きでキャッシュし、msrest 既定の挙動で送るクレデンシャル。
+
+    AccessToken は expires_on の refresh_margin 秒前まで再利用し、期限が近づいたら
+    1 スレッドだけが credential.get_token を呼ぶ（他のスレッドはロックで待機）。
+    DefaultAzureCredential の資格情報チェーンや Azure CLI の呼び出しが毎リクエストに乗らない。
+    msrest が渡すセッション（接続プール）をそのまま使い、Authorization ヘッダーは
+    トークンが変わったときだけ書き換える。
+    """
+    def __init__(self, credential: DefaultAzureCredential, scope: str, refresh_margin: float = 300):
         self.credential = credential
         self.scope = scope
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._access_token = None
+        self.hits = 0
+        self.refreshes = 0
+        self.refresh_seconds_total = 0.0
+        self.refresh_seconds_max = 0.0
         super().__init__(self._token_dict())  # 初期トークンを設定
 
-    def _token_dict(self):
-        t = self.credential.get_token(self.scope)
-        return {"access_token": t.token}
+    def _fresh(self, access_token):
+        return access_token is not None and access_token.expires_on - self.refresh_margin > time.time()
+
+    def get_access_token(self, force_refresh=False):
+        """キャッシュ済みの AccessToken を返す（期限が近い/force_refresh の場合は再取得する）"""
+        access_token = self._access_token
+        if not force_refresh and self._fresh(access_token):
+            self.hits += 1
+            return access_token
+        with self._lock:
+            current = self._access_token
+            # ロック待ちの間に他のスレッドが更新済みならそれを使う
+            if self._fresh(current) and (current is not access_token or not force_refresh):
+                self.hits += 1
+                return current
+            started = time.monotonic()
+            self._access_token = current = self.credential.get_token(self.scope)
+            elapsed = time.monotonic() - started
+            self.refreshes += 1
+            self.refresh_seconds_total += elapsed
+            self.refresh_seconds_max = max(self.refresh_seconds_max, elapsed)
+            log.debug("Refreshed AAD token for %s in %.3fs (expires in %.0fs)", self.scope, elapsed,
+                      current.expires_on - time.time())
+            return current
+
+    def _token_dict(self, force_refresh=False):
+        return {"access_token": self.get_access_token(force_refresh).token}
 
     def signed_session(self, session=None):
-        # super を呼ぶ前に必ず最新トークンを注入（msrest は self.token を参照する）
+        # super を呼ぶ前に有効なトークンを注入（msrest は self.token を参照する）
         self.token = self._token_dict()
+        if session is not None and \
+                session.headers.get('Authorization') == f"{self.scheme} {self.token['access_token']}":
+            return session
         return super().signed_session(session)
 
+    def refresh_session(self, session=None):
+        # msrest がトークン期限切れを検知した場合は、キャッシュを無視して取り直す
+        self.token = self._token_dict(force_refresh=True)
+        return super().signed_session(session)
+
+    def stats(self):
+        with self._lock:
+            expires_in = self._access_token.expires_on - time.time() if self._access_token else None
+            return {"hits": self.hits, "refreshes": self.refreshes,
+                    "refresh_seconds_total": round(self.refresh_seconds_total, 3),
+                    "refresh_seconds_max": round(self.refresh_seconds_max, 3),
+                    "expires_in_seconds": round(expires_in) if expires_in is not None else None}
+
+
+def _md5_file(file_path: str, chunk_size: int = 4 * 1024 * 1024) -> str:
+    """ファイル全体を読み込まずにストリーミングで MD5 (hex) を計算する"""
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class UploadManifest:
+    """ローカルファイルのフィンガープリント (size, mtime, md5) を保持する JSON manifest。
+
+    size と mtime が前回と同じファイルは再ハッシュせず、記録済みの MD5 を使う。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as e:
+                log.warning("Ignoring unreadable upload manifest '%s': %s", path, e)
+
+    def fingerprint(self, file_path: str) -> dict:
+        key = os.path.abspath(file_path)
+        st = os.stat(file_path)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry.get("size") == st.st_size and entry.get("mtime_ns") == st.st_mtime_ns:
+            return entry
+        entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "md5": _md5_file(file_path)}
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self._entries, indent=1, sort_keys=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+
+class DownloadManifest:
+    """ダウンロード先ディレクトリに置く JSON manifest（Blob 名 -> size, etag）。
+
+    ローカルファイルのサイズと記録済みの ETag が Blob と一致すれば、再ダウンロードしない。
+    """
+    FILE_NAME = '.download_manifest.json'
+
+    def __init__(self, dest_dir: str):
+        self.dest_dir = dest_dir
+        self.path = os.path.join(dest_dir, self.FILE_NAME)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._unsaved = 0
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError) as e:
+                log.warning("Ignoring unreadable download manifest '%s': %s", self.path, e)
+
+    def local_path(self, blob_name: str) -> str:
+        return os.path.join(self.dest_dir, *blob_name.split('/'))
+
+    def is_current(self, blob_name: str, size: int = None, etag: str = None) -> bool:
+        """ローカルに同じ Blob（etag 省略時は記録済みの Blob）があれば True"""
+        with self._lock:
+            entry = self._entries.get(blob_name)
+        if entry is None or (etag is not None and entry.get("etag") != etag):
+            return False
+        try:
+            local_size = os.path.getsize(self.local_path(blob_name))
+        except OSError:
+            return False
+        return local_size == (size if size is not None else entry.get("size"))
+
+    def record(self, blob_name: str, size: int, etag: str, save_every: int = 100):
+        with self._lock:
+            self._entries[blob_name] = {"size": size, "etag": etag}
+            self._unsaved += 1
+            due = self._unsaved >= save_every
+        if due:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            data = json.dumps(self._entries, indent=1, sort_keys=True)
+            self._unsaved = 0
+        os.makedirs(self.dest_dir, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+
+
+class RunStateStore:
+    """
+    Crash-safe record of one run in a local SQLite database.
+
+    The store keeps the uploaded inputs (blob name, size and mtime), the
+    submitted tasks (with the names of their input files) and the tasks that
+    succeeded. Rows are committed in small batches as the work is done, so
+    after the orchestrator dies a ``--resume`` run can rebuild its state
+    from the store and the live job and upload and submit only what is
+    missing.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # 1 件ずつコミットするので fsync はチェックポイント時のみにする（プロセスが落ちても記録は残る）
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS uploads (blob_name TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER);
+            CREATE TABLE IF NOT EXISTS tasks (task_id TEXT PRIMARY KEY, inputs TEXT,
+                                              succeeded INTEGER NOT NULL DEFAULT 0);
+        ''')
+        self._uploads = None
+        self._succeeded_since = None
+
+    def begin(self, job_id: str, resume: bool = False):
+        """新しい実行では記録を消す。resume では同じジョブの記録があることを確認する"""
+        with self._lock, self._db:
+            row = self._db.execute("SELECT value FROM meta WHERE key = 'job_id'").fetchone()
+            if not resume:
+                self._db.execute('DELETE FROM uploads')
+                self._db.execute('DELETE FROM tasks')
+                self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('job_id', ?)", (job_id,))
+                return
+            if row is None or row[0] != job_id:
+                raise RuntimeError(f"ERROR: no run state for job '{job_id}' in {self.path}")
+            uploads = self._db.execute('SELECT COUNT(*) FROM uploads').fetchone()[0]
+            tasks, succeeded = self._db.execute('SELECT COUNT(*), COALESCE(SUM(succeeded), 0) FROM tasks').fetchone()
+        log.info("Resuming job '%s': %d uploads, %d submitted tasks (%d succeeded) recorded",
+                 job_id, uploads, tasks, succeeded)
+
+    @staticmethod
+    def _signature(file_path):
+        st = os.stat(file_path)
+        return st.st_size, st.st_mtime_ns
+
+    def is_uploaded(self, blob_name: str, file_path: str) -> bool:
+        """同じサイズ/更新時刻のファイルがこの実行でアップロード済みなら True"""
+        with self._lock:
+            if self._uploads is None:
+                self._uploads = {name: (size, mtime) for name, size, mtime
+                                 in self._db.execute('SELECT blob_name, size, mtime_ns FROM uploads')}
+            recorded = self._uploads.get(blob_name)
+        return recorded is not None and recorded == self._signature(file_path)
+
+    def record_uploads(self, items):
+        """(blob_name, file_path, ...) の列をアップロード済みとして記録する"""
+        rows = [(item[0], *self._signature(item[1])) for item in items]
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO uploads (blob_name, size, mtime_ns) VALUES (?, ?, ?)', rows)
+            if self._uploads is not None:
+                self._uploads.update((name, (size, mtime)) for name, size, mtime in rows)
+
+    def record_upload(self, item):
+        """1 件分の record_uploads（upload_blobs_from_paths の on_uploaded 用）"""
+        self.record_uploads([item])
+
+    def _record_tasks(self, rows):
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR IGNORE INTO tasks (task_id, inputs) VALUES (?, ?)', rows)
+
+    def pending_tasks(self, tasks, existing_ids=(), batch_size=100):
+        """ジョブに既にある（existing_ids）か成功済みのタスクを除き、残りを記録しながら返す（遅延評価）
+
+        記録済みのタスク ID の入力が異なる場合は、中断後に入力が変わったとみなして例外を送出する。
+        """
+        with self._lock:
+            known = {task_id: (inputs, succeeded) for task_id, inputs, succeeded
+                     in self._db.execute('SELECT task_id, inputs, succeeded FROM tasks')}
+        rows = []
+        skipped = 0
+        for task in tasks:
+            inputs = '\n'.join(rf.file_path or '' for rf in task.resource_files or [])
+            recorded = known.get(task.id)
+            if recorded is not None and recorded[0] != inputs:
+                raise RuntimeError(f"ERROR: task '{task.id}' was recorded with different inputs; "
+                                   "the input files changed since the interrupted run (start without --resume)")
+            if recorded is None:
+                rows.append((task.id, inputs))
+                if len(rows) >= batch_size:
+                    self._record_tasks(rows)
+                    rows = []
+            if task.id in existing_ids or recorded is not None and recorded[1]:
+                skipped += 1
+                continue
+            yield task
+        if rows:
+            self._record_tasks(rows)
+        if skipped:
+            log.info("Run state: %d tasks already submitted or completed (skipped)", skipped)
+
+    def record_succeeded(self, task_ids):
+        with self._lock, self._db:
+            self._db.executemany('UPDATE tasks SET succeeded = 1 WHERE task_id = ? AND succeeded = 0',
+                                 ((t,) for t in task_ids))
+
+    def sync_succeeded(self, batch_service_client, job_id) -> int:
+        """前回以降に成功したタスクをジョブから一覧して記録し、一覧した件数を返す
+
+        OutputFollower.poll と同様に stateTransitionTime の最大値を覚えておき、次回はそれ以降に
+        遷移したタスクだけを一覧する（成功済みのタスク全体を毎回一覧しない）。
+        """
+        odata_filter = "executionInfo/result eq 'success'"
+        if self._succeeded_since is not None:
+            odata_filter += " and stateTransitionTime ge datetime'{}'".format(
+                self._succeeded_since.strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+        tasks = list_tasks(batch_service_client, job_id, odata_filter, select='id,stateTransitionTime')
+        self.record_succeeded(t.id for t in tasks)
+        transitions = [t.state_transition_time for t in tasks if t.state_transition_time]
+        if transitions:
+            self._succeeded_since = max(transitions + ([self._succeeded_since] if self._succeeded_since else []))
+        return len(tasks)
+
+    def on_poll(self, batch_service_client, job_id, min_interval=60):
+        """wait_for_tasks_to_complete の on_poll 用に、成功したタスクを最短 min_interval 秒ごとに記録するコールバックを返す
+
+        成功数が前回の記録から増えたときだけ、前回以降に成功したタスクを一覧する（sync_succeeded）。
+        中断しても --resume で再実行されるのは、最後の記録以降に成功したタスクだけになる。
+        """
+        state = {'next': 0.0, 'succeeded': None}
+
+        def _on_poll(counts):
+            succeeded = (counts or {}).get('succeeded')
+            if time.time() < state['next'] or succeeded is not None and succeeded == state['succeeded']:
+                return
+            state['next'] = time.time() + min_interval
+            try:
+                self.sync_succeeded(batch_service_client, job_id)
+                state['succeeded'] = succeeded
+            except (batchmodels.BatchErrorException, ClientRequestError) as e:
+                log.debug("Could not record succeeded tasks: %s", e)
+        return _on_poll
+
+    def close(self):
+        with self._lock:
+            self._db.close()
 
-def upload_file_to_container(storage: StorageV12, container_name: str, file_path: str):
-    """1) アップロード 2) 読み取りユーザー委任 SAS を返す"""
+
+def _blob_matches_fingerprint(props, fp: dict) -> bool:
+    if props is None or props.size != fp["size"]:
+        return False
+    if (props.metadata or {}).get("source_md5") == fp["md5"]:
+        return True
+    content_md5 = getattr(getattr(props, "content_settings", None), "content_md5", None)
+    return bool(content_md5) and bytes(content_md5).hex() == fp["md5"]
+
+
+def upload_file_to_container(storage: StorageV12, container_name: str, file_path: str,
+                             manifest: UploadManifest = None, max_concurrency: int = 1):
+    """1) アップロード 2) 読み取りユーザー委任 SAS を返す
+
+    manifest を渡すと差分モード: 既存 Blob の size/MD5 がローカルと一致すればアップロードを省略する。
+    """
     blob_name = os.path.basename(file_path)
-    storage.upload_blob_from_path(container_name, blob_name, file_path)
+    if manifest is None:
+        storage.upload_blob_from_path(container_name, blob_name, file_path, max_concurrency=max_concurrency)
+    else:
+        fp = manifest.fingerprint(file_path)
+        if _blob_matches_fingerprint(storage.get_blob_properties_or_none(container_name, blob_name), fp):
+            log.info("Skip upload (unchanged): %s", blob_name)
+        else:
+            storage.upload_blob_from_path(container_name, blob_name, file_path,
+                                          max_concurrency=max_concurrency, md5_hex=fp["md5"])
     sas_url = storage.make_blob_user_delegation_sas_url(
         container_name, blob_name, permissions=BlobSasPermissions(read=True))
     return batchmodels.ResourceFile(file_path=blob_name, http_url=sas_url)
 
 
+def upload_files_to_container(storage: StorageV12, container_name: str, file_paths,
+                              max_workers: int = 4, max_concurrency: int = 4,
+                              manifest: UploadManifest = None, run_state: RunStateStore = None):
+    """複数ファイルを並列アップロードし、入力と同じ順序の ResourceFile リストを返す
+
+    manifest を渡すと差分モード: コンテナーを 1 回一覧し、size/MD5 が一致する Blob はアップロードしない。
+    run_state を渡すと、記録済みのファイルはアップロードせず、アップロードしたファイルを 1 件ずつ完了時に記録する。
+    """
+    file_paths = list(file_paths)
+    if manifest is None:
+        items = [(os.path.basename(p), p) for p in file_paths]
+        to_upload = items
+    else:
+        existing = storage.list_blob_properties(container_name)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            fps = list(pool.map(manifest.fingerprint, file_paths))
+        items = [(os.path.basename(p), p, fp["md5"]) for p, fp in zip(file_paths, fps)]
+        to_upload = [item for item, fp in zip(items, fps)
+                     if not _blob_matches_fingerprint(existing.get(item[0]), fp)]
+        manifest.save()
+        log.info("Incremental upload: %d of %d files changed or missing", len(to_upload), len(items))
+    on_uploaded = None
+    if run_state is not None:
+        to_upload = [item for item in to_upload if not run_state.is_uploaded(item[0], item[1])]
+        log.info("Run state: %d files to upload", len(to_upload))
+        on_uploaded = run_state.record_upload
+    storage.upload_blobs_from_paths(container_name, to_upload, max_workers=max_workers,
+                                    max_concurrency=max_concurrency, on_uploaded=on_uploaded)
+    resource_files = []
+    for blob_name, *_ in items:
+        sas_url = storage.make_blob_user_delegation_sas_url(
+            container_name, blob_name, permissions=BlobSasPermissions(read=True))
+        resource_files.append(batchmodels.ResourceFile(file_path=blob_name, http_url=sas_url))
+    return resource_files
+
+
 def get_container_sas_url_for_write(storage: StorageV12, container_name: str):
     """出力用: コンテナーへの書き込みを許可するユーザー委任 SAS URL を返す"""
     perms = BlobSasPermissions(read=True, write=True, add=True, create=True, list=True)
@@ -174,6 +915,225 @@ def get_container_sas_url_for_write(storage: StorageV12, container_name: str):
 """旧 get_container_sas_url は v12+AAD では get_container_sas_url_for_write に置換"""
 
 
+def _iter_source_blobs(storage: StorageV12, container_name: str, prefix: str = None,
+                       suffixes=('.mp4',), results_per_page: int = 5000):
+    for page in storage.iter_blob_pages(container_name, name_starts_with=prefix, results_per_page=results_per_page):
+        for blob in page:
+            if not suffixes or blob.name.lower().endswith(tuple(s.lower() for s in suffixes)):
+                yield blob
+
+
+def iter_blob_input_files(storage: StorageV12, container_name: str, prefix: str = None, suffixes=('.mp4',),
+                          sas_hours: int = 24, results_per_page: int = 5000):
+    """Storage 上の入力をダウンロード/再アップロードせずに ResourceFile として逐次返す（遅延評価）
+
+    コンテナー（prefix 配下）をページ単位で一覧し、読み取り SAS はコンテナーに 1 つだけ発行して各 Blob の URL に付ける。
+    file_path は Blob 名のままなので、出力もソースと同じ階層名でアップロードされる。
+    """
+    sas = storage.make_container_user_delegation_sas_url(
+        container_name, BlobSasPermissions(read=True), expiry_hours=sas_hours).split('?', 1)[1]
+    for blob in _iter_source_blobs(storage, container_name, prefix, suffixes, results_per_page):
+        yield batchmodels.ResourceFile(file_path=blob.name, http_url=storage.blob_url(container_name, blob.name, sas))
+
+
+def stage_blob_input_files(storage: StorageV12, source_container: str, dest_container: str, prefix: str = None,
+                           suffixes=('.mp4',), sas_hours: int = 24, max_in_flight: int = 64,
+                           poll_seconds: float = 2.0, results_per_page: int = 5000):
+    """ソースの Blob を dest_container にサーバー側コピーし、コピーが完了したものから ResourceFile を逐次返す
+
+    データはクライアントを経由しない（start_copy_from_url）。同一アカウント内のコピーは通常即時に完了し、
+    非同期コピーになった場合は最大 max_in_flight 件まで並行させて完了を待つ。
+    """
+    source_sas = storage.make_container_user_delegation_sas_url(
+        source_container, BlobSasPermissions(read=True), expiry_hours=sas_hours).split('?', 1)[1]
+    dest_sas = storage.make_container_user_delegation_sas_url(
+        dest_container, BlobSasPermissions(read=True), expiry_hours=sas_hours).split('?', 1)[1]
+    pending = []
+    copied = 0
+
+    def _resource_file(name):
+        return batchmodels.ResourceFile(file_path=name, http_url=storage.blob_url(dest_container, name, dest_sas))
+
+    def _drain(limit):
+        while len(pending) > limit:
+            still = []
+            for name in pending:
+                status = storage.get_blob_copy_status(dest_container, name)
+                if status == 'success':
+                    yield _resource_file(name)
+                elif status == 'pending':
+                    still.append(name)
+                else:
+                    raise RuntimeError(f"ERROR: server-side copy of '{name}' ended with status '{status}'")
+            pending[:] = still
+            if len(pending) > limit:
+                time.sleep(poll_seconds)
+
+    for blob in _iter_source_blobs(storage, source_container, prefix, suffixes, results_per_page):
+        status = storage.start_blob_copy(dest_container, blob.name,
+                                         storage.blob_url(source_container, blob.name, source_sas))
+        copied += 1
+        if status == 'success':
+            yield _resource_file(blob.name)
+        else:
+            pending.append(blob.name)
+            yield from _drain(max_in_flight - 1)
+    yield from _drain(0)
+    log.info("Staged %d blobs from '%s' to '%s' with server-side copy", copied, source_container, dest_container)
+
+
+def probe_media_duration(file_path: str):
+    """ローカルの ffprobe でメディアの長さ（秒）を返す。ffprobe が無い/解析できない場合は None"""
+    try:
+        out = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+             "-of", "default=noprint_wrappers=1:nokey=1", file_path],
+            capture_output=True, text=True, check=True, timeout=120).stdout
+        return float(out.strip())
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None
+
+
+def collect_media_info(file_paths, probe_duration=False, max_workers=8, manifest: UploadManifest = None):
+    """入力ファイルの情報を Blob 名（= ResourceFile.file_path）をキーにした dict で返す
+
+    各値は {'path', 'size', 'duration', 'md5'}。duration は probe_duration=True かつ ffprobe が使える場合のみ、
+    md5 は manifest を渡した場合のみ（manifest により変更のないファイルは再ハッシュしない）。
+    """
+    file_paths = list(file_paths)
+    durations = [None] * len(file_paths)
+    md5s = [None] * len(file_paths)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        if probe_duration:
+            if shutil.which("ffprobe"):
+                durations = list(pool.map(probe_media_duration, file_paths))
+            else:
+                log.warning("ffprobe not found locally; media durations are unknown")
+        if manifest is not None:
+            md5s = [fp["md5"] for fp in pool.map(manifest.fingerprint, file_paths)]
+    if manifest is not None:
+        manifest.save()
+    return {os.path.basename(p): {"path": p, "size": os.path.getsize(p), "duration": d, "md5": h}
+            for p, d, h in zip(file_paths, durations, md5s)}
+
+
+# 変換コマンド/設定のシグネチャ。変換内容を変えたら更新し、以前の結果キャッシュを無効にする
+TRANSCODE_SIGNATURE = 'ffmpeg -i {input} {stem}.mp3'
+
+# 既定の変換プロファイル（従来どおり 1 入力から <stem>.mp3 を 1 つ出力する）
+DEFAULT_TRANSCODE_PROFILES = ({'name': 'mp3', 'suffix': '.mp3', 'args': ''},)
+
+
+def validate_transcode_profiles(profiles):
+    """変換プロファイルの一覧を検証して返す（None は既定プロファイル）
+
+    各プロファイルは {'name', 'suffix', 'args'[, 'path', 'upload_condition']} の dict。
+    suffix は出力ファイル名（<stem><suffix>）の末尾、args はその出力に付ける ffmpeg の出力オプション、
+    path は出力コンテナー内のプレフィックス、upload_condition はアップロード条件（既定 'tasksuccess'）。
+    """
+    if not profiles:
+        return DEFAULT_TRANSCODE_PROFILES
+    seen = set()
+    for profile in profiles:
+        if not profile.get('name') or not profile.get('suffix'):
+            raise ValueError(f"Transcode profile needs 'name' and 'suffix': {profile}")
+        target = (profile.get('path') or '') + profile['suffix']
+        if target in seen:
+            raise ValueError(f"Transcode profiles write the same output twice: {target}")
+        seen.add(target)
+    return tuple(profiles)
+
+
+def _profile_outputs(stem, profiles=None):
+    """各プロファイルの (ローカルの出力ファイル名, Blob 名, アップロード条件) のリスト"""
+    return [(stem + p['suffix'], (p.get('path') or '') + stem + p['suffix'], p.get('upload_condition', 'tasksuccess'))
+            for p in profiles or DEFAULT_TRANSCODE_PROFILES]
+
+
+def _output_names(input_file_path, profiles=None):
+    """入力 1 つに対する出力 Blob 名のリスト（結果キャッシュの照合用）"""
+    return [blob for _, blob, _ in _profile_outputs(_output_stem(input_file_path), profiles)]
+
+
+def _ffmpeg_output_args(stem, profiles=None):
+    """1 回のデコードで全プロファイルを書き出す ffmpeg の出力部分（"<args> <out> <args> <out> ..."）"""
+    return " ".join(f"{p['args']} {stem}{p['suffix']}".strip() for p in profiles or DEFAULT_TRANSCODE_PROFILES)
+
+
+def transcode_signature(profiles=None):
+    """結果キャッシュのキーに使う変換シグネチャ（既定プロファイルでは TRANSCODE_SIGNATURE のまま）"""
+    profiles = validate_transcode_profiles(profiles)
+    if profiles == DEFAULT_TRANSCODE_PROFILES:
+        return TRANSCODE_SIGNATURE
+    return 'ffmpeg -i {input} ' + _ffmpeg_output_args('{stem}', profiles)
+
+
+class ResultCache:
+    """出力 Blob のメタデータ (result_key) による変換結果キャッシュ。
+
+    result_key は入力の MD5 と変換シグネチャのハッシュ。load() で出力コンテナーを 1 回だけ一覧し、
+    同じキーを持つ出力がある入力はタスクを作らない。commit() で今回作られた出力にキーを記録する。
+    lookup() は複数スレッドから呼べる（一覧の読み込みと集計はロックで保護する）。
+    """
+    METADATA_KEY = 'result_key'
+
+    def __init__(self, storage: StorageV12, container_name: str, signature: str = TRANSCODE_SIGNATURE):
+        self.storage = storage
+        self.container_name = container_name
+        self.signature = signature
+        self._existing = None
+        self._expected = {}
+        self.hits = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        blobs = self.storage.list_blob_properties(self.container_name)
+        self._existing = {name: (b.metadata or {}).get(self.METADATA_KEY) for name, b in blobs.items()}
+        log.info("Result cache: %d blobs in '%s'", len(self._existing), self.container_name)
+
+    def load(self):
+        with self._lock:
+            self._load()
+
+    def key_for(self, input_md5: str) -> str:
+        return hashlib.sha256(f"{input_md5}|{self.signature}".encode()).hexdigest()
+
+    def lookup(self, output_names, input_md5: str) -> bool:
+        """全出力が同じキーで存在すれば True。無ければ commit() 対象として記録して False"""
+        if not input_md5:
+            return False
+        key = self.key_for(input_md5)
+        with self._lock:
+            if self._existing is None:
+                self._load()
+            if all(self._existing.get(name) == key for name in output_names):
+                self.hits += 1
+                return True
+            for name in output_names:
+                self._expected[name] = key
+        return False
+
+    def commit(self, since: datetime.datetime, succeeded_outputs=None, max_workers: int = 16) -> int:
+        """since 以降に更新された（= 今回のタスクが出力した）Blob に result_key を記録し、件数を返す
+
+        succeeded_outputs（成功したタスクの出力 Blob 名、succeeded_output_names を参照）を渡すと、
+        それ以外の出力（失敗したタスクが task_completion でアップロードした途中の出力など）には記録しない。
+        """
+        with self._lock:
+            expected = dict(self._expected)
+        if not expected:
+            return 0
+        blobs = self.storage.list_blob_properties(self.container_name)
+        targets = [(name, key) for name, key in expected.items()
+                   if name in blobs and blobs[name].last_modified >= since
+                   and (succeeded_outputs is None or name in succeeded_outputs)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+            list(pool.map(lambda t: self.storage.set_blob_metadata(
+                self.container_name, t[0], {**(blobs[t[0]].metadata or {}), self.METADATA_KEY: t[1]}), targets))
+        log.info("Result cache: recorded keys on %d of %d expected outputs", len(targets), len(expected))
+        return len(targets)
+
+
 def _normalize_batch_url(url: str) -> str:
     """Ensure Batch URL has scheme and no trailing slash."""
     if not url or not isinstance(url, str):
@@ -184,26 +1144,206 @@ def _normalize_batch_url(url: str) -> str:
     return u.rstrip('/')
 
 
-def create_pool(batch_service_client, pool_id):
+# 主な VM サイズの vCPU 数（一覧に無いサイズは名前の数字部分から推定する）
+_VM_SIZE_VCPUS = {
+    'standard_a1_v2': 1, 'standard_a2_v2': 2, 'standard_a4_v2': 4, 'standard_a8_v2': 8,
+    'standard_d2s_v3': 2, 'standard_d4s_v3': 4, 'standard_d8s_v3': 8, 'standard_d16s_v3': 16,
+    'standard_f2s_v2': 2, 'standard_f4s_v2': 4, 'standard_f8s_v2': 8, 'standard_f16s_v2': 16,
+}
+
+
+def vm_size_vcpus(vm_size: str) -> int:
+    """VM サイズ名から vCPU 数を返す（例: Standard_F8s_v2 -> 8）。不明な場合は 1"""
+    key = (vm_size or '').lower()
+    if key in _VM_SIZE_VCPUS:
+        return _VM_SIZE_VCPUS[key]
+    m = re.match(r'^standard_[a-z]+?(\d+)', key)
+    return int(m.group(1)) if m else 1
+
+
+def resolve_task_slots_per_node(vm_size: str, setting) -> int:
+    """task_slots_per_node を決める。'auto' は vCPU 数。サービス上限（vCPU の 4 倍、最大 256）に収める"""
+    vcpus = vm_size_vcpus(vm_size)
+    slots = vcpus if str(setting).lower() == 'auto' else int(setting or 1)
+    return max(1, min(slots, vcpus * 4, 256))
+
+
+# 自動スケールの Spot/低優先度ノード数の上限（config._AUTOSCALE_MAX_LOW_PRIORITY の既定値）
+DEFAULT_AUTOSCALE_MAX_LOW_PRIORITY = 20
+
+
+def build_autoscale_formula(min_dedicated=0, max_dedicated=0, min_low_priority=0,
+                            max_low_priority=DEFAULT_AUTOSCALE_MAX_LOW_PRIORITY,
+                            task_slots_per_node=1, prefer_low_priority=True, sample_minutes=5):
+    """キュー長（$PendingTasks = 待機中 + 実行中タスク数）からノード数を決める自動スケール式を返す
+
+    必要ノード数 = ceil(タスク数 / スロット数) を、prefer_low_priority なら Spot/低優先度ノードから先に、
+    そうでなければ専用ノードから先に割り当て、それぞれ min/max で制限する。
+    縮小時は $NodeDeallocationOption = taskcompletion で実行中タスクの完了を待ってからノードを外す。
+    """
+    first, second = ('Low', 'Ded') if prefer_low_priority else ('Ded', 'Low')
+    bounds = {'Ded': (min_dedicated, max_dedicated), 'Low': (min_low_priority, max_low_priority)}
+    return "\n".join([
+        f"$samples = $PendingTasks.GetSamplePercent(TimeInterval_Minute * {sample_minutes});",
+        "$tasks = $samples < 70 ? max(0, $PendingTasks.GetSample(1)) : "
+        f"max($PendingTasks.GetSample(1), avg($PendingTasks.GetSample(TimeInterval_Minute * {sample_minutes})));",
+        f"$wanted = ceil($tasks / {max(1, task_slots_per_node)});",
+        f"${first} = min({bounds[first][1]}, max({bounds[first][0]}, $wanted - {bounds[second][0]}));",
+        f"${second} = min({bounds[second][1]}, max({bounds[second][0]}, $wanted - ${first}));",
+        "$TargetDedicatedNodes = $Ded;",
+        "$TargetLowPriorityNodes = $Low;",
+        "$NodeDeallocationOption = taskcompletion;",
+    ])
+
+
+def log_autoscale_decisions(batch_service_client, pool_id, last_timestamp=None):
+    """直近の自動スケール評価結果を、前回ログ以降に更新されていればログ出力し、その timestamp を返す"""
+    pool = batch_service_client.pool.get(pool_id, pool_get_options=batchmodels.PoolGetOptions(
+        select='id,autoScaleRun,currentDedicatedNodes,currentLowPriorityNodes'))
+    run = getattr(pool, 'auto_scale_run', None)
+    if run is None or run.timestamp == last_timestamp:
+        return last_timestamp
+    if run.error:
+        log.warning("Autoscale evaluation failed at %s: %s: %s", run.timestamp, run.error.code, run.error.message)
+    else:
+        decided = {k: v for k, v in (kv.split('=', 1) for kv in (run.results or '').split(';') if '=' in kv)
+                   if k in ('$TargetDedicatedNodes', '$TargetLowPriorityNodes', '$tasks', '$wanted')}
+        log.info("Autoscale decision at %s: %s (current ded/low=%s/%s)", run.timestamp, decided,
+                 pool.current_dedicated_nodes, pool.current_low_priority_nodes)
+    return run.timestamp
+
+
+def _sha256_file(file_path: str, chunk_size: int = 4 * 1024 * 1024) -> str:
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def stage_ffmpeg_build(storage: StorageV12, container_name: str, archive_path: str, sas_hours: int = 144):
+    """固定バージョンの ffmpeg 静的ビルド（tar.xz）を一度だけ Storage に置き、読み取り SAS URL と SHA-256 を返す
+
+    Blob 名にハッシュを含めるため、同じアーカイブは再アップロードしない。
+    SAS はノード追加（自動スケール/低優先度ノードの置き換え）時にも使われるため長めに発行する。
+    """
+    sha256 = _sha256_file(archive_path)
+    blob_name = f"ffmpeg/{sha256[:16]}/{os.path.basename(archive_path)}"
+    storage.ensure_container(container_name)
+    props = storage.get_blob_properties_or_none(container_name, blob_name)
+    if props is not None and props.size == os.path.getsize(archive_path):
+        log.info("ffmpeg build already staged: %s/%s", container_name, blob_name)
+    else:
+        storage.upload_blob_from_path(container_name, blob_name, archive_path)
+    url = storage.make_blob_user_delegation_sas_url(
+        container_name, blob_name, permissions=BlobSasPermissions(read=True), expiry_hours=sas_hours)
+    return {"url": url, "sha256": sha256}
+
+
+def build_ffmpeg_start_task(provision='apt', staged=None, app_package=None):
+    """ffmpeg を用意する StartTask と、プールに付けるアプリケーションパッケージ参照のリストを返す
+
+    - 'apt': apt-get で毎回インストール（従来の挙動）
+    - 'staged': stage_ffmpeg_build の静的ビルドをノード共有ディレクトリにキャッシュ。
+      キャッシュが無いときだけダウンロードし、SHA-256 を検証して展開する
+    - 'app_package': Batch のアプリケーションパッケージ (id, version) をリンクする（ノード側で Batch がキャッシュ）
+    """
+    app_refs = None
+    if provision == 'staged':
+        cache = "$AZ_BATCH_NODE_SHARED_DIR/ffmpeg-cache/" + staged["sha256"]
+        script = (
+            "set -e; c={cache}; "
+            "if [ ! -f $c/.ok ]; then "
+            "mkdir -p $c; curl -sSfL --retry 5 -o $c/ffmpeg.tar.xz '{url}'; "
+            "echo '{sha256}  '$c/ffmpeg.tar.xz | sha256sum -c -; "
+            "tar -xJf $c/ffmpeg.tar.xz -C $c --strip-components=1; rm -f $c/ffmpeg.tar.xz; touch $c/.ok; "
+            "fi; "
+            "ln -sf $c/ffmpeg /usr/local/bin/ffmpeg; ln -sf $c/ffprobe /usr/local/bin/ffprobe"
+        ).format(cache=cache, url=staged["url"], sha256=staged["sha256"])
+    elif provision == 'app_package':
+        app_id, version = app_package
+        env = "AZ_BATCH_APP_PACKAGE_{}_{}".format(
+            re.sub(r'[^A-Za-z0-9_]', '_', app_id), re.sub(r'[^A-Za-z0-9_]', '_', version))
+        script = ("set -e; d=$(find ${env} -name ffmpeg -type f | head -n 1 | xargs dirname); "
+                  "ln -sf $d/ffmpeg /usr/local/bin/ffmpeg; "
+                  "[ -f $d/ffprobe ] && ln -sf $d/ffprobe /usr/local/bin/ffprobe || true").format(env=env)
+        app_refs = [batchmodels.ApplicationPackageReference(application_id=app_id, version=version)]
+    else:
+        script = "apt-get update && apt-get install -y ffmpeg"
+    start_task = batchmodels.StartTask(
+        command_line="/bin/bash -c \"{}\"".format(script),
+        wait_for_success=True,
+        user_identity=batchmodels.UserIdentity(
+            auto_user=batchmodels.AutoUserSpecification(
+                scope=batchmodels.AutoUserScope.pool,
+                elevation_level=batchmodels.ElevationLevel.admin)),
+    )
+    return start_task, app_refs
+
+
+def report_node_startup_times(batch_service_client, pool_id):
+    """ノードごとの起動時間（割り当て → StartTask 完了、StartTask 自体の所要時間）をログ出力して返す"""
+    opts = batchmodels.ComputeNodeListOptions(select='id,state,isDedicated,allocationTime,startTaskInfo')
+    rows = []
+    for n in batch_service_client.compute_node.list(pool_id, compute_node_list_options=opts):
+        info = getattr(n, 'start_task_info', None)
+        start = getattr(info, 'start_time', None)
+        end = getattr(info, 'end_time', None)
+        row = {
+            'node_id': n.id,
+            'dedicated': n.is_dedicated,
+            'start_task_seconds': (end - start).total_seconds() if start and end else None,
+            'ready_seconds': (end - n.allocation_time).total_seconds() if end and n.allocation_time else None,
+        }
+        rows.append(row)
+        log.info("- Node %s (%s): allocation->ready=%ss, start_task=%ss", n.id,
+                 'dedicated' if n.is_dedicated else 'low-priority',
+                 row['ready_seconds'], row['start_task_seconds'])
+    ready = sorted(r['ready_seconds'] for r in rows if r['ready_seconds'] is not None)
+    if ready:
+        log.info("Node start-up: %d nodes, median %.0fs, max %.0fs (allocation -> start task done)",
+                 len(ready), ready[len(ready) // 2], ready[-1])
+    return rows
+
+
+def create_pool(batch_service_client, pool_id, task_slots_per_node=1, node_fill_type=None,
+                auto_scale_formula=None, auto_scale_interval=datetime.timedelta(minutes=5),
+                start_task=None, application_package_references=None):
     """
     Creates a pool of compute nodes with the specified OS settings.
 
     :param batch_service_client: A Batch service client.
     :type batch_service_client: `azure.batch.BatchServiceClient`
     :param str pool_id: An ID for the new pool.
+    :param int task_slots_per_node: Number of tasks that can run
+     concurrently on one node.
+    :param str node_fill_type: 'spread' or 'pack'; None keeps the service
+     default.
+    :param str auto_scale_formula: When set, the pool is autoscaled with
+     this formula instead of the fixed node counts from config. An
+     existing pool gets the formula applied.
+    :param timedelta auto_scale_interval: Autoscale evaluation interval.
+    :param start_task: The StartTask that provisions ffmpeg (see
+     `build_ffmpeg_start_task`); defaults to installing it with apt-get.
+     An existing pool gets it applied for nodes that join later.
+    :param list application_package_references: Application packages to
+     deploy to each node.
     :param str publisher: Marketplace image publisher
     :param str offer: Marketplace image offer
     :param str sku: Marketplace image sky
     """
-    log.info("Creating pool '%s'...", pool_id)
+    log.info("Creating pool '%s' (task slots per node: %d)...", pool_id, task_slots_per_node)
 
     # Create a new pool of Linux compute nodes using an Azure Virtual Machines
     # Marketplace image. For more information about creating pools of Linux
     # nodes, see:
     # https://azure.microsoft.com/documentation/articles/batch-linux-nodes/
 
-    # The start task installs ffmpeg on each node from an available repository, using
-    # an administrator user identity.
+    # The start task installs ffmpeg on each node (from an available repository by
+    # default, or from a pre-staged build), using an administrator user identity.
+    patch_existing_start_task = start_task is not None
+    if start_task is None:
+        start_task, _ = build_ffmpeg_start_task('apt')
 
     # 任意の VNet/Subnet を指定（_SUBNET_ID が空なら None）
     net_conf = None
@@ -236,16 +1376,16 @@ def create_pool(batch_service_client, pool_id):
         ),
         network_configuration=net_conf,
         vm_size=config._POOL_VM_SIZE,
-        target_dedicated_nodes=config._DEDICATED_POOL_NODE_COUNT,
-        target_low_priority_nodes=config._LOW_PRIORITY_POOL_NODE_COUNT,
-        start_task=batchmodels.StartTask(
-            command_line="/bin/bash -c \"apt-get update && apt-get install -y ffmpeg\"",
-            wait_for_success=True,
-            user_identity=batchmodels.UserIdentity(
-                auto_user=batchmodels.AutoUserSpecification(
-                    scope=batchmodels.AutoUserScope.pool,
-                    elevation_level=batchmodels.ElevationLevel.admin)),
-        )
+        target_dedicated_nodes=None if auto_scale_formula else config._DEDICATED_POOL_NODE_COUNT,
+        target_low_priority_nodes=None if auto_scale_formula else config._LOW_PRIORITY_POOL_NODE_COUNT,
+        enable_auto_scale=bool(auto_scale_formula),
+        auto_scale_formula=auto_scale_formula,
+        auto_scale_evaluation_interval=auto_scale_interval if auto_scale_formula else None,
+        task_slots_per_node=task_slots_per_node,
+        task_scheduling_policy=batchmodels.TaskSchedulingPolicy(
+            node_fill_type=node_fill_type) if node_fill_type else None,
+        start_task=start_task,
+        application_package_references=application_package_references,
     )
 
     try:
@@ -253,12 +1393,29 @@ def create_pool(batch_service_client, pool_id):
     except batchmodels.BatchErrorException as e:
         code = getattr(getattr(e, 'error', None), 'code', None)
         if code == 'PoolExists':
-            log.info("Pool '%s' already exists. Reusing it.", pool_id)
+            log.info("Pool '%s' already exists. Reusing it (task slots per node are not changed).", pool_id)
+            if auto_scale_formula:
+                batch_service_client.pool.enable_auto_scale(
+                    pool_id, auto_scale_formula=auto_scale_formula,
+                    auto_scale_evaluation_interval=auto_scale_interval)
+                log.info("Applied autoscale formula to existing pool '%s'", pool_id)
+            if patch_existing_start_task:
+                # SAS の期限切れを防ぐため、既存プールにも最新の StartTask を反映する（以後に参加するノードに適用）
+                batch_service_client.pool.patch(pool_id, batchmodels.PoolPatchParameter(
+                    start_task=start_task,
+                    application_package_references=application_package_references))
+                log.info("Updated start task of existing pool '%s'", pool_id)
         else:
             raise
+    if auto_scale_formula:
+        log.debug("Autoscale formula:\n%s", auto_scale_formula)
+        try:
+            log_autoscale_decisions(batch_service_client, pool_id)
+        except batchmodels.BatchErrorException as e:
+            log.debug("Could not read autoscale run: %s", e)
 
 
-def create_job(batch_service_client, job_id, pool_id):
+def create_job(batch_service_client, job_id, pool_id, uses_task_dependencies=False):
     """
     Creates a job with the specified ID, associated with the specified pool.
 
@@ -266,12 +1423,15 @@ def create_job(batch_service_client, job_id, pool_id):
     :type batch_service_client: `azure.batch.BatchServiceClient`
     :param str job_id: The ID for the job.
     :param str pool_id: The ID for the pool.
+    :param bool uses_task_dependencies: Whether tasks in the job may depend
+     on other tasks (required by segmented mode).
     """
     log.info("Creating job '%s'...", job_id)
 
     job = batchmodels.JobAddParameter(
         id=job_id,
-        pool_info=batchmodels.PoolInformation(pool_id=pool_id))
+        pool_info=batchmodels.PoolInformation(pool_id=pool_id),
+        uses_task_dependencies=uses_task_dependencies)
 
     try:
         batch_service_client.job.add(job)
@@ -283,86 +1443,657 @@ def create_job(batch_service_client, job_id, pool_id):
             raise
 
 
-def add_tasks(batch_service_client, job_id, input_files, output_container_sas_url):
+# Batch の add_collection 1 回あたりの上限（タスク数 100、ペイロードはサービス上限 4MB に余裕を持たせる）
+MAX_TASKS_PER_ADD_COLLECTION = 100
+MAX_ADD_COLLECTION_BYTES = 3 * 1024 * 1024
+
+
+def _ffmpeg_output_file(file_pattern, output_container_sas_url, path=None,
+                        upload_condition=batchmodels.OutputFileUploadCondition.task_success):
+    """タスク終了時（既定は成功時のみ）に file_pattern を出力コンテナーへアップロードする OutputFile を返す"""
+    return batchmodels.OutputFile(
+        file_pattern=file_pattern,
+        destination=batchmodels.OutputFileDestination(
+            container=batchmodels.OutputFileBlobContainerDestination(
+                container_url=output_container_sas_url, path=path)),
+        upload_options=batchmodels.OutputFileUploadOptions(
+            upload_condition=upload_condition))
+
+
+# 分割モードで各セグメントの出力を置く出力コンテナー内のプレフィックス
+SEGMENTS_PREFIX = 'segments/'
+# セグメントタスクの ID（<task_id>-segNNN）。結合タスクが depends_on で参照するのはこれだけ
+SEGMENT_TASK_ID_PATTERN = re.compile(r'-seg\d+$')
+
+
+def _output_stem(input_file_path):
+    return "".join((input_file_path).split('.')[:-1])
+
+
+def _build_ffmpeg_task(task_id, input_file, output_container_sas_url, profiles=None):
+    """1 入力ファイルを 1 回のデコードで各プロファイルの出力（既定は mp3 のみ）に変換する TaskAddParameter を返す
+
+    出力ごとに OutputFile を作り、プロファイルの path / upload_condition に従ってアップロードする。
     """
-    Adds a task for each input file in the collection to the specified job.
+    input_file_path = input_file.file_path
+    stem = _output_stem(input_file_path)
+    command = "/bin/bash -c \"ffmpeg -i {} {} \"".format(
+        input_file_path, _ffmpeg_output_args(stem, profiles))
+    return batchmodels.TaskAddParameter(
+        id=task_id,
+        command_line=command,
+        resource_files=[input_file],
+        output_files=[_ffmpeg_output_file(local, output_container_sas_url,
+                                          path=blob if blob != local else None, upload_condition=condition)
+                      for local, blob, condition in _profile_outputs(stem, profiles)])
+
+
+def _build_packed_task(task_id, input_files, output_container_sas_url, profiles=None):
+    """複数の小さい入力を 1 タスクで順に変換する TaskAddParameter を返す
+
+    1 つでも失敗するとタスクは非 0 で終了するが、成功した出力はアップロードされる（task_completion）。
+    失敗した変換の出力は途中までしか書かれていないため、アップロードされないよう削除する。
+    """
+    steps = []
+    output_files = []
+    for input_file in input_files:
+        stem = _output_stem(input_file.file_path)
+        outputs = _profile_outputs(stem, profiles)
+        steps.append("ffmpeg -i {} {} || {{ rc=1; rm -f {}; }}".format(
+            input_file.file_path, _ffmpeg_output_args(stem, profiles), " ".join(local for local, _, _ in outputs)))
+        for local, blob, _ in outputs:
+            output_files.append(_ffmpeg_output_file(
+                local, output_container_sas_url, path=blob if blob != local else None,
+                upload_condition=batchmodels.OutputFileUploadCondition.task_completion))
+    command = "/bin/bash -c \"rc=0; {}; exit $rc\"".format("; ".join(steps))
+    return batchmodels.TaskAddParameter(
+        id=task_id,
+        command_line=command,
+        resource_files=list(input_files),
+        output_files=output_files)
+
+
+def _segment_ranges(duration, segment_seconds, max_segments):
+    """長さ duration 秒を最大 max_segments 個の (開始秒, 長さ秒) に分割する"""
+    count = max(1, min(max_segments, int(-(-duration // segment_seconds))))
+    starts = [round(k * duration / count, 3) for k in range(count)]
+    # 隣接セグメントが隙間なく続くよう長さは次の開始秒との差とし、最後は終端まで（長さを指定しない）
+    return [(start, round(starts[k + 1] - start, 3) if k < count - 1 else None)
+            for k, start in enumerate(starts)]
+
+
+def _build_segmented_tasks(task_id, input_file, output_container_sas_url, duration,
+                           segment_seconds, max_segments):
+    """長い入力を時間範囲ごとのセグメントタスクと、それらに依存する結合タスクに分割する
+
+    セグメントタスクは入力全体をダウンロードせず、SAS URL から ffmpeg が必要な範囲だけを読む。
+    各セグメントの mp3 は出力コンテナーの segments/<stem>/ に置かれ、結合タスクが concat demuxer で
+    再エンコードせずに 1 つの mp3 にまとめる。
+    セグメントが失敗しても結合タスクは実行され（依存関係を satisfy）、セグメントが揃っていなければ失敗する。
+    既定の block では結合タスクが active のまま残り、監視がタイムアウトまで待ち続けるため。
+    """
+    stem = _output_stem(input_file.file_path)
+    prefix = f"{SEGMENTS_PREFIX}{stem}/"
+    ranges = _segment_ranges(duration, segment_seconds, max_segments)
+    satisfy_on_failure = batchmodels.ExitConditions(
+        default=batchmodels.ExitOptions(dependency_action=batchmodels.DependencyAction.satisfy))
+    tasks = []
+    for k, (start, length) in enumerate(ranges):
+        seg_file = f"{stem}_seg{k:03d}.mp3"
+        span = f"-ss {start} -t {length}" if length is not None else f"-ss {start}"
+        command = "/bin/bash -c \"ffmpeg -y {} -i '{}' {} \"".format(span, input_file.http_url, seg_file)
+        tasks.append(batchmodels.TaskAddParameter(
+            id=f"{task_id}-seg{k:03d}",
+            command_line=command,
+            output_files=[_ffmpeg_output_file(seg_file, output_container_sas_url, path=prefix + seg_file)],
+            exit_conditions=satisfy_on_failure))
+    output_file_path = stem + '.mp3'
+    command = ("/bin/bash -c \"n=$(ls {prefix}*.mp3 2>/dev/null | wc -l); if [ $n -ne {count} ]; then"
+               " echo missing segments: $n of {count} >&2; exit 1; fi;"
+               " ls {prefix}*.mp3 | sort | sed 's/^/file /' > concat.txt"
+               " && ffmpeg -y -f concat -safe 0 -i concat.txt -c copy {out} \"").format(
+        prefix=prefix, count=len(ranges), out=output_file_path)
+    tasks.append(batchmodels.TaskAddParameter(
+        id=task_id,
+        command_line=command,
+        resource_files=[batchmodels.ResourceFile(
+            storage_container_url=output_container_sas_url, blob_prefix=prefix)],
+        output_files=[_ffmpeg_output_file(output_file_path, output_container_sas_url)],
+        depends_on=batchmodels.TaskDependencies(task_ids=[t.id for t in tasks])))
+    return tasks
+
+
+# タイミングマーカー: コマンド開始/終了時刻（epoch 秒）をタスクの作業ディレクトリに書く
+TIMING_MARKER_FILE = 'timing.txt'
+
+
+def _with_timing_markers(task):
+    """/bin/bash -c "..." のコマンドを、開始/終了時刻を TIMING_MARKER_FILE に記録するよう書き換える
+
+    終了コードは元のコマンドのものを返す。実行情報の開始/終了時刻と突き合わせると
+    リソースのダウンロード・ffmpeg 実行・出力アップロードの時間に分けられる（TaskMetricsCollector）。
+    元のコマンドはサブシェルで実行するので、exit や cd を含んでいても終了時刻は必ず記録される。
+    """
+    m = re.match(r'^/bin/bash -c "(.*)"$', task.command_line, re.DOTALL)
+    if m:
+        task.command_line = (
+            '/bin/bash -c "echo start $(date +%s.%N) > {f}; ( {cmd} ); rc=$?; '
+            'echo end $(date +%s.%N) >> {f}; exit $rc"').format(f=TIMING_MARKER_FILE, cmd=m.group(1).strip())
+    return task
+
+
+def _task_payload_size(task) -> int:
+    return len(json.dumps(task.serialize()))
+
+
+def _chunk_tasks(tasks, max_tasks=MAX_TASKS_PER_ADD_COLLECTION, max_bytes=MAX_ADD_COLLECTION_BYTES):
+    """タスク列を add_collection の上限（件数とペイロードサイズ）に収まるチャンクに分割して逐次返す"""
+    chunk, chunk_bytes = [], 0
+    for task in tasks:
+        size = _task_payload_size(task)
+        if chunk and (len(chunk) >= max_tasks or chunk_bytes + size > max_bytes):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(task)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def _is_transient_batch_error(err) -> bool:
+    """スロットリング (429)、サーバーエラー (5xx)、接続エラーは再試行対象"""
+    if isinstance(err, ClientRequestError):
+        return True
+    response = getattr(err, 'response', None)
+    status = getattr(response, 'status_code', None)
+    return status is not None and (status == 429 or 500 <= status <= 599)
+
+
+def _submit_task_chunk(batch_service_client, job_id, chunk, max_attempts, backoff_seconds):
+    """1 チャンクを投入し、失敗/スロットリングされたタスクだけをバックオフしながら再投入する。
+
+    戻り値は (追加できたタスク数, 恒久的に失敗した TaskAddResult のリスト)。
+    """
+    pending = list(chunk)
+    added = 0
+    failures = []
+    for attempt in range(1, max_attempts + 1):
+        try:
+            result = batch_service_client.task.add_collection(job_id, pending)
+        except batchmodels.CreateTasksErrorException as e:
+            # SDK は 100 件単位の分割と RequestBodyTooLarge/5xx 結果の再送を行い、
+            # 残りを pending_tasks に、クライアントエラー（TaskExists 以外）を failure_tasks に返す
+            failures.extend(e.failure_tasks)
+            retry = list(e.pending_tasks)
+            added += len(pending) - len(retry) - len(e.failure_tasks)
+            fatal = [err for err in e.errors if not _is_transient_batch_error(err)]
+            if fatal:
+                raise fatal[0]
+        except (batchmodels.BatchErrorException, ClientRequestError) as e:
+            if not _is_transient_batch_error(e):
+                raise
+            retry = pending
+        else:
+            retry = []
+            for task_result in result.value:
+                if task_result.status == batchmodels.TaskAddStatus.server_error:
+                    retry.extend(t for t in pending if t.id == task_result.task_id)
+                elif (task_result.status == batchmodels.TaskAddStatus.client_error
+                        and task_result.error.code != 'TaskExists'):
+                    failures.append(task_result)
+                else:
+                    added += 1
+        if not retry:
+            break
+        pending = retry
+        if attempt == max_attempts:
+            raise RuntimeError(
+                f"ERROR: {len(pending)} tasks could not be added after {max_attempts} attempts "
+                f"(first: {pending[0].id})")
+        delay = min(30.0, backoff_seconds * (2 ** (attempt - 1))) * random.uniform(0.5, 1.0)
+        log.debug("Retrying %d tasks in %.1fs (attempt %d/%d)", len(pending), delay, attempt + 1, max_attempts)
+        time.sleep(delay)
+    return added, failures
+
+
+def submit_tasks(batch_service_client, job_id, tasks, max_workers=8, max_attempts=6, backoff_seconds=1.0):
+    """
+    Submits tasks to a job in size-limited chunks, several chunks at a time.
+
+    Tasks are consumed lazily, so at most about ``2 * max_workers`` chunks are
+    held in memory. Tasks that fail with a server error or are throttled are
+    resubmitted with exponential backoff; tasks that already exist count as
+    added.
 
     :param batch_service_client: A Batch service client.
     :type batch_service_client: `azure.batch.BatchServiceClient`
     :param str job_id: The ID of the job to which to add the tasks.
-    :param list input_files: A collection of input files. One task will be
-     created for each input file.
-    :param output_container_sas_token: A SAS token granting write access to
-    the specified Azure Blob storage container.
+    :param tasks: An iterable of `azure.batch.models.TaskAddParameter`.
+    :param int max_workers: Number of add_collection requests in flight.
+    :param int max_attempts: Attempts per chunk before giving up.
+    :return: The number of tasks added.
+    :rtype: int
     """
+    started = time.monotonic()
+    added = 0
+    failures = []
+    max_in_flight = max(1, max_workers) * 2
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        in_flight = set()
+
+        def _drain(return_when):
+            nonlocal added, in_flight
+            done, in_flight = concurrent.futures.wait(in_flight, return_when=return_when)
+            for fut in done:
+                n, failed = fut.result()
+                added += n
+                failures.extend(failed)
+
+        for chunk in _chunk_tasks(tasks):
+            if len(in_flight) >= max_in_flight:
+                _drain(concurrent.futures.FIRST_COMPLETED)
+            in_flight.add(pool.submit(_submit_task_chunk, batch_service_client, job_id, chunk,
+                                      max_attempts, backoff_seconds))
+        _drain(concurrent.futures.ALL_COMPLETED)
+
+    log.info("Added %d tasks to job '%s' in %.2fs", added, job_id, time.monotonic() - started)
+    if failures:
+        for task_result in failures[:20]:
+            log.error("Task '%s' was not added: %s: %s", task_result.task_id,
+                      task_result.error.code, getattr(task_result.error.message, 'value', task_result.error.message))
+        raise RuntimeError(f"ERROR: {len(failures)} tasks were rejected by the Batch service")
+    return added
+
+
+def build_tasks(input_files, output_container_sas_url, media_info=None, segment_seconds=None,
+                segment_min_duration=1800, max_segments=32, pack_max_bytes=0, pack_max_files=16,
+                result_cache=None, timing_markers=False, profiles=None):
+    """入力ファイル列から TaskAddParameter を逐次生成する（オプションは add_tasks を参照）
+
+    実行バックエンドに依存しないタスク定義で、AzureBatchBackend / LocalProcessBackend の両方が使う。
+    """
+    media_info = media_info or {}
+    emit = _with_timing_markers if timing_markers else (lambda task: task)
+    profiles = validate_transcode_profiles(profiles)
+    if segment_seconds and profiles != DEFAULT_TRANSCODE_PROFILES:
+        # セグメントの結合は mp3 の concat 前提のため、複数プロファイルでは入力を分割しない
+        log.warning("Segmented mode is not applied with custom transcode profiles.")
+        segment_seconds = None
+    pack, pack_first_idx = [], None
+    for idx, input_file in enumerate(input_files):
+        task_id = 'Task{}'.format(idx)
+        info = media_info.get(input_file.file_path, {})
+        duration = info.get('duration')
+        size = info.get('size')
+        if result_cache is not None and result_cache.lookup(
+                _output_names(input_file.file_path, profiles), info.get('md5')):
+            log.debug("Cached output for '%s'; no task", input_file.file_path)
+            continue
+        if segment_seconds and duration and duration >= segment_min_duration:
+            segmented = _build_segmented_tasks(task_id, input_file, output_container_sas_url,
+                                               duration, segment_seconds, max_segments)
+            log.info("Input '%s' (%.0fs) split into %d segments",
+                     input_file.file_path, duration, len(segmented) - 1)
+            yield from map(emit, segmented)
+        elif pack_max_bytes and size is not None and size <= pack_max_bytes:
+            if not pack:
+                pack_first_idx = idx
+            pack.append(input_file)
+            if len(pack) >= pack_max_files:
+                yield emit(_build_packed_task('Pack{}'.format(pack_first_idx), pack, output_container_sas_url,
+                                              profiles))
+                pack = []
+        else:
+            yield emit(_build_ffmpeg_task(task_id, input_file, output_container_sas_url, profiles))
+    if pack:
+        yield emit(_build_packed_task('Pack{}'.format(pack_first_idx), pack, output_container_sas_url, profiles))
 
-    log.info("Adding %d tasks to job '%s'...", len(input_files), job_id)
 
-    tasks = list()
+def drop_cached_inputs(file_paths, media_info, result_cache: ResultCache, profiles=None):
+    """結果キャッシュに出力がある入力を除いたパスのリストを返す（アップロードの前に使う）
 
-    for idx, input_file in enumerate(input_files):
-        input_file_path = input_file.file_path
-        output_file_path = "".join((input_file_path).split('.')[:-1]) + '.mp3'
-        command = "/bin/bash -c \"ffmpeg -i {} {} \"".format(
-            input_file_path, output_file_path)
-        tasks.append(batchmodels.TaskAddParameter(
-            id='Task{}'.format(idx),
-            command_line=command,
-            resource_files=[input_file],
-            output_files=[batchmodels.OutputFile(
-                file_pattern=output_file_path,
-                destination=batchmodels.OutputFileDestination(
-                          container=batchmodels.OutputFileBlobContainerDestination(
-                              container_url=output_container_sas_url)),
-                upload_options=batchmodels.OutputFileUploadOptions(
-                    upload_condition=batchmodels.OutputFileUploadCondition.task_success))]
-        )
-        )
-    batch_service_client.task.add_collection(job_id, tasks)
+    media_info は collect_media_info に manifest を渡して得たもの（md5 が必要）。
+    """
+    remaining = [p for p in file_paths
+                 if not result_cache.lookup(_output_names(os.path.basename(p), profiles),
+                                            media_info.get(os.path.basename(p), {}).get('md5'))]
+    log.info("Result cache: %d of %d inputs have cached outputs (not uploaded)",
+             len(file_paths) - len(remaining), len(file_paths))
+    return remaining
+
+
+def order_longest_first(input_files, media_info):
+    """入力を推定処理時間の長い順に並べたリストを返す
+
+    全入力の長さ（ffprobe）が分かっていれば長さ、そうでなければファイルサイズで比較する。
+    Batch はジョブ内のタスクをおおむね投入順に割り当てるため、長い入力を先に投入すると最後に長いタスクが残りにくい。
+    """
+    input_files = list(input_files)
+    use_duration = bool(input_files) and all(
+        media_info.get(f.file_path, {}).get('duration') for f in input_files)
+    key = 'duration' if use_duration else 'size'
+    log.info("Scheduling: longest first by %s", key)
+    return sorted(input_files, key=lambda f: media_info.get(f.file_path, {}).get(key) or 0, reverse=True)
+
+
+def _list_schedule_makespan(costs, slots):
+    """costs をこの順に空いたスロットへ割り当てたときの完了時刻（Batch のキュー順の割り当てを模擬する）"""
+    finish = [0.0] * max(1, slots)
+    for cost in costs:
+        heapq.heappush(finish, heapq.heappop(finish) + cost)
+    return max(finish)
+
+
+def estimate_makespan(input_files, media_info, slots, seconds_per_media_second=0.05, seconds_per_mb=0.5,
+                      segment_seconds=None, segment_min_duration=1800, max_segments=32):
+    """
+    Estimates how long the job's tasks take on ``slots`` task slots.
+
+    Each input's run time is its probed duration times
+    ``seconds_per_media_second``, or its size times ``seconds_per_mb`` when
+    the duration is unknown; segmented inputs are split evenly. Tasks are
+    assigned to the first free slot in submission order, both in the given
+    order and longest first.
+
+    :return: Estimated seconds for ``input_order`` and ``longest_first``,
+     the ``lower_bound`` (total work over slots, or the longest task), and
+     the ``slots`` and ``tasks`` used.
+    :rtype: dict
+    """
+    costs = []
+    for input_file in input_files:
+        info = media_info.get(input_file.file_path, {})
+        duration = info.get('duration')
+        cost = duration * seconds_per_media_second if duration else \
+            (info.get('size') or 0) / (1024 * 1024) * seconds_per_mb
+        if segment_seconds and duration and duration >= segment_min_duration:
+            count = len(_segment_ranges(duration, segment_seconds, max_segments))
+            costs.extend([cost / count] * count)
+        else:
+            costs.append(cost)
+    slots = max(1, slots)
+    return {
+        'slots': slots,
+        'tasks': len(costs),
+        'input_order': round(_list_schedule_makespan(costs, slots), 1),
+        'longest_first': round(_list_schedule_makespan(sorted(costs, reverse=True), slots), 1),
+        'lower_bound': round(max([sum(costs) / slots] + costs), 1) if costs else 0.0,
+    }
+
+
+def add_tasks(batch_service_client, job_id, input_files, output_container_sas_url,
+              max_workers=8, max_attempts=6, media_info=None, segment_seconds=None,
+              segment_min_duration=1800, max_segments=32, pack_max_bytes=0, pack_max_files=16,
+              result_cache=None, timing_markers=False, profiles=None, preserve_order=False,
+              run_state=None):
+    """
+    Adds a task for each input file in the collection to the specified job.
+
+    Each task decodes its input once and writes one output per transcode
+    profile (see `validate_transcode_profiles`); the default is a single
+    mp3.
+
+    When ``result_cache`` is given, inputs whose outputs already exist with
+    the same result key (input MD5 from ``media_info`` plus the transcode
+    signature) are skipped.
 
+    When ``pack_max_bytes`` is set, inputs no larger than that (per
+    ``media_info``) are packed up to ``pack_max_files`` per task, so the
+    per-task overhead is paid once for several short clips.
+
+    When ``segment_seconds`` is set, inputs whose duration in ``media_info``
+    is at least ``segment_min_duration`` seconds are split into segment tasks
+    plus a merge task that depends on them; the job must have been created
+    with ``uses_task_dependencies=True``.
+
+    :param batch_service_client: A Batch service client.
+    :type batch_service_client: `azure.batch.BatchServiceClient`
+    :param str job_id: The ID of the job to which to add the tasks.
+    :param input_files: A collection of input files. One task will be
+     created for each input file. Any iterable is accepted; tasks are built
+     and submitted in chunks as it is consumed.
+    :param output_container_sas_token: A SAS token granting write access to
+    the specified Azure Blob storage container.
+    :param int max_workers: Number of add_collection requests in flight.
+    :param int max_attempts: Attempts per chunk for failed or throttled tasks.
+    :param dict media_info: Input information keyed by file path, as
+     returned by `collect_media_info`.
+    :param float segment_seconds: Target segment length; None disables
+     segmented mode.
+    :param float segment_min_duration: Shortest input that is segmented.
+    :param int max_segments: Maximum segments per input.
+    :param int pack_max_bytes: Largest input that is packed; 0 disables
+     packing.
+    :param int pack_max_files: Maximum inputs per packed task.
+    :param ResultCache result_cache: Output cache to consult; None disables
+     caching.
+    :param bool timing_markers: Record command start/end times in each
+     task's working directory (see `TaskMetricsCollector`).
+    :param profiles: Transcode profiles; None for the default mp3 output.
+    :param bool preserve_order: Submit one chunk at a time so that tasks are
+     queued in the order given (e.g. after `order_longest_first`).
+    :param RunStateStore run_state: Records the submitted tasks; tasks that
+     are already in the job or recorded as succeeded are not submitted.
+    :return: The number of tasks added.
+    :rtype: int
+    """
 
-def wait_for_tasks_to_complete(batch_service_client, job_id, timeout):
+    if hasattr(input_files, '__len__'):
+        log.info("Adding tasks for %d input files to job '%s'...", len(input_files), job_id)
+    else:
+        log.info("Adding tasks to job '%s'...", job_id)
+
+    tasks = build_tasks(input_files, output_container_sas_url, media_info=media_info,
+                        segment_seconds=segment_seconds, segment_min_duration=segment_min_duration,
+                        max_segments=max_segments, pack_max_bytes=pack_max_bytes,
+                        pack_max_files=pack_max_files, result_cache=result_cache,
+                        timing_markers=timing_markers, profiles=profiles)
+    if run_state is not None:
+        tasks = run_state.pending_tasks(tasks, set(list_task_ids(batch_service_client, job_id, None)))
+    added = submit_tasks(batch_service_client, job_id, tasks,
+                         max_workers=1 if preserve_order else max_workers, max_attempts=max_attempts)
+    if result_cache is not None:
+        log.info("Result cache: %d inputs already transcoded (skipped)", result_cache.hits)
+    return added
+
+
+def _get_task_counts(batch_service_client, job_id):
+    """job.get_task_counts の TaskCounts を返す（1 回の軽量な呼び出しでジョブ全体の集計が得られる）"""
+    result = batch_service_client.job.get_task_counts(job_id)
+    # azure-batch 10 以降は TaskCountsResult、それ以前は TaskCounts を直接返す
+    return getattr(result, 'task_counts', result)
+
+
+def _counts_to_dict(counts) -> dict:
+    return {k: getattr(counts, k, 0) or 0 for k in ('active', 'running', 'completed', 'succeeded', 'failed')}
+
+
+def list_tasks(batch_service_client, job_id, odata_filter=None, select='id', limit=None):
+    """サーバー側フィルターと select で必要なタスク/フィールドだけを列挙する（limit 件で打ち切り）"""
+    opts = batchmodels.TaskListOptions(filter=odata_filter, select=select)
+    tasks = []
+    for task in batch_service_client.task.list(job_id, task_list_options=opts):
+        tasks.append(task)
+        if limit is not None and len(tasks) >= limit:
+            break
+    return tasks
+
+
+def list_task_ids(batch_service_client, job_id, odata_filter, limit=None):
+    """サーバー側フィルターと id のみの select でタスク ID を列挙する"""
+    return [t.id for t in list_tasks(batch_service_client, job_id, odata_filter, select='id', limit=limit)]
+
+
+def succeeded_output_names(batch_service_client, job_id) -> set:
+    """成功したタスクの OutputFile が作る Blob 名の集合（ワイルドカードの出力は含まない）"""
+    names = set()
+    for task in list_tasks(batch_service_client, job_id, "executionInfo/result eq 'success'",
+                           select='id,outputFiles'):
+        for of in task.output_files or []:
+            if not re.search(r'[*?\[]', of.file_pattern):
+                names.add(of.destination.container.path or of.file_pattern)
+    return names
+
+
+def wait_for_tasks_to_complete(batch_service_client, job_id, timeout, mode='counts',
+                               max_poll_interval=30.0, on_poll=None, straggler_policy=None):
     """
     Returns when all tasks in the specified job reach the Completed state.
 
+    In ``counts`` mode (default) the job is polled with ``job.get_task_counts``
+    and the poll interval grows while nothing changes, up to
+    ``max_poll_interval`` seconds. Task listings are only issued with
+    server-side filters, to confirm completion and to name failed tasks.
+    ``list`` mode lists every task on each poll (the original behavior).
+
     :param batch_service_client: A Batch service client.
     :type batch_service_client: `azure.batch.BatchServiceClient`
     :param str job_id: The id of the job whose tasks should be monitored.
     :param timedelta timeout: The duration to wait for task completion. If all
     tasks in the specified job do not reach Completed state within this time
     period, an exception will be raised.
+    :param str mode: ``counts`` or ``list``.
+    :param float max_poll_interval: Upper bound of the adaptive poll interval.
+    :param on_poll: Optional callable invoked with the counts dict after
+     every successful poll (e.g. to log autoscale decisions).
+    :param StragglerPolicy straggler_policy: Duplicates slow tasks while
+     monitoring; copies that lost to a successful twin are not counted as
+     failed, and the policy's report is added as ``stragglers``.
+    :return: A summary with counts by state, succeeded/failed totals, the
+     IDs of failed tasks and the time spent.
+    :rtype: dict
     """
+    started = time.monotonic()
     timeout_expiration = datetime.datetime.now() + timeout
-    log.info("Monitoring tasks until 'Completed' (timeout: %s)", timeout)
+    log.info("Monitoring tasks until 'Completed' (timeout: %s, mode: %s)", timeout, mode)
     next_log = time.time()
+    interval = 1.0
+    last_counts = None
+    polls = 0
     while datetime.datetime.now() < timeout_expiration:
-        tasks = batch_service_client.task.list(job_id)
-
-        incomplete_tasks = [task for task in tasks if
-                            task.state != batchmodels.TaskState.completed]
-        if not incomplete_tasks:
-            log.info("All tasks reached 'Completed'.")
-            return True
+        polls += 1
+        try:
+            if mode == 'list':
+                opts = batchmodels.TaskListOptions(select='id,state,executionInfo')
+                tasks = list(batch_service_client.task.list(job_id, task_list_options=opts))
+                counts = {'active': 0, 'running': 0, 'completed': 0, 'succeeded': 0, 'failed': 0}
+                for task in tasks:
+                    if task.state == batchmodels.TaskState.completed:
+                        counts['completed'] += 1
+                        result = getattr(task.execution_info, 'result', None)
+                        counts['failed' if result == batchmodels.TaskExecutionResult.failure else 'succeeded'] += 1
+                    elif task.state == batchmodels.TaskState.running:
+                        counts['running'] += 1
+                    else:
+                        counts['active'] += 1
+            else:
+                counts = _counts_to_dict(_get_task_counts(batch_service_client, job_id))
+        except (batchmodels.BatchErrorException, ClientRequestError) as e:
+            if not _is_transient_batch_error(e):
+                raise
+            interval = min(max_poll_interval, interval * 2)
+            log.debug("Monitoring throttled or failed transiently (%s); next poll in %.0fs", e, interval)
+            time.sleep(interval)
+            continue
+
+        if on_poll is not None:
+            on_poll(counts)
+        if straggler_policy is not None:
+            straggler_policy.poll(counts)
+
+        incomplete = counts['active'] + counts['running']
+        # タスク数の集計は最終的整合のため、完了に見えたら未完了タスクの有無をフィルター付き一覧で確認する
+        if incomplete == 0 and (mode == 'list' or not list_task_ids(
+                batch_service_client, job_id, "state ne 'completed'", limit=1)):
+            failed_ids = list_task_ids(batch_service_client, job_id,
+                                       "executionInfo/result eq 'failure'") if counts['failed'] else []
+            stragglers = None
+            if straggler_policy is not None:
+                stragglers = straggler_policy.finalize()
+                covered = straggler_policy.covered_task_ids()
+                counts = dict(counts, failed=counts['failed'] - sum(1 for t in failed_ids if t in covered))
+                failed_ids = [t for t in failed_ids if t not in covered]
+            summary = {
+                'job_id': job_id,
+                'counts': counts,
+                'succeeded': counts['succeeded'],
+                'failed': counts['failed'],
+                'failed_task_ids': failed_ids,
+                'elapsed_seconds': round(time.monotonic() - started, 1),
+                'polls': polls,
+            }
+            if stragglers is not None:
+                summary['stragglers'] = stragglers
+            log.info("All tasks reached 'Completed'. succeeded=%d, failed=%d, polls=%d, elapsed=%.1fs",
+                     summary['succeeded'], summary['failed'], polls, summary['elapsed_seconds'])
+            if failed_ids:
+                log.warning("Failed tasks: %s", ", ".join(failed_ids[:50]))
+            return summary
+
+        # 変化がなければポーリング間隔を伸ばし、進捗があれば短く戻す
+        if counts != last_counts:
+            interval = 1.0
         else:
-            if time.time() >= next_log:
-                remain = (timeout_expiration - datetime.datetime.now()).total_seconds()
-                log.debug("Monitoring... incomplete: %d, ~%ds left", len(incomplete_tasks), int(remain))
-                next_log = time.time() + 5
-            time.sleep(1)
+            interval = min(max_poll_interval, interval * 1.5)
+        last_counts = counts
+        if time.time() >= next_log:
+            remain = (timeout_expiration - datetime.datetime.now()).total_seconds()
+            log.debug("Monitoring... %s, ~%ds left, next poll in %.0fs", counts, int(remain), interval)
+            next_log = time.time() + 5
+        time.sleep(interval)
 
     # Timeout: dump diagnostics before raising
     try:
         dump_batch_diagnostics(batch_service_client, job_id)
     except Exception as diag_err:
         log.warning("Failed to output diagnostics: %s", diag_err)
-        raise RuntimeError(f"ERROR: tasks did not reach 'Completed' within timeout: {timeout}")
+    raise RuntimeError(f"ERROR: tasks did not reach 'Completed' within timeout: {timeout}")
+
+
+def _read_task_file_tail(batch_service_client, job_id, task_id, file_name, max_bytes):
+    """タスクのファイル末尾 max_bytes だけを Range 指定で取得する（ファイル全体はダウンロードしない）"""
+    props = batch_service_client.file.get_properties_from_task(job_id, task_id, file_name, raw=True)
+    length = int(props.headers.get('Content-Length') or 0)
+    if length <= 0:
+        return b''
+    start = max(0, length - max_bytes)
+    opts = batchmodels.FileGetFromTaskOptions(ocp_range=f'bytes={start}-{length - 1}')
+    return b''.join(batch_service_client.file.get_from_task(
+        job_id, task_id, file_name, file_get_from_task_options=opts))
+
+
+def _read_task_log_tails(batch_service_client, job_id, task_id, max_bytes):
+    """stdout/stderr の末尾を取得する（best-effort。取得できないファイルは省略）"""
+    tails = {}
+    for fname in ("stdout.txt", "stderr.txt"):
+        try:
+            tails[fname] = _read_task_file_tail(batch_service_client, job_id, task_id, fname, max_bytes)
+        except Exception as _:
+            pass
+    return tails
+
 
+def _sample_tasks_for_diagnostics(batch_service_client, job_id, max_tasks):
+    """診断対象のタスクを失敗 → 未完了 → 成功の順に最大 max_tasks 件選ぶ"""
+    select = 'id,state,executionInfo,nodeInfo'
+    sampled = []
+    for odata_filter in ("executionInfo/result eq 'failure'",
+                         "state ne 'completed'",
+                         "executionInfo/result eq 'success'"):
+        remaining = max_tasks - len(sampled)
+        if remaining <= 0:
+            break
+        sampled.extend(list_tasks(batch_service_client, job_id, odata_filter, select=select, limit=remaining))
+    return sampled
 
-def dump_batch_diagnostics(batch_service_client, job_id, max_log_bytes=4096):
+
+def dump_batch_diagnostics(batch_service_client, job_id, max_log_bytes=4096, max_tasks=20, max_workers=8):
     """Prints a concise diagnostics report for the job/pool/nodes/tasks.
 
     - Task states summary and per-task details (exit code, failure info)
-    - Tail of stdout/stderr for each task (best-effort)
+      for up to ``max_tasks`` tasks, failed tasks first
+    - Tail of stdout/stderr for each sampled task (best-effort), fetched with
+      range requests through a pool of ``max_workers`` threads
     - Pool allocation and compute node states, including start task info
     """
     log.info("===== Azure Batch Diagnostics (start) =====")
@@ -374,14 +2105,19 @@ def dump_batch_diagnostics(batch_service_client, job_id, max_log_bytes=4096):
     log.info("Job: %s; Pool: %s", job_id, pool_id)
 
     # Tasks overview
-    tasks = list(batch_service_client.task.list(job_id))
-    by_state = {}
-    for t in tasks:
-        s = str(t.state)
-        by_state[s] = by_state.get(s, 0) + 1
-    log.info("Task states: %s", by_state)
-
-    for t in tasks:
+    try:
+        log.info("Task states: %s", _counts_to_dict(_get_task_counts(batch_service_client, job_id)))
+    except Exception as _:
+        pass
+    tasks = _sample_tasks_for_diagnostics(batch_service_client, job_id, max_tasks)
+    log.info("Sampled tasks: %d (failed first)", len(tasks))
+
+    # Fetch stdout/stderr tails concurrently (best-effort)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        tail_futures = [pool.submit(_read_task_log_tails, batch_service_client, job_id, t.id, max_log_bytes)
+                        for t in tasks]
+
+    for t, tail_future in zip(tasks, tail_futures):
         exec_info = getattr(t, 'execution_info', None)
         exit_code = getattr(exec_info, 'exit_code', None) if exec_info else None
         failure = getattr(exec_info, 'failure_info', None) if exec_info else None
@@ -393,18 +2129,9 @@ def dump_batch_diagnostics(batch_service_client, job_id, max_log_bytes=4096):
             if getattr(failure, 'details', None):
                 for d in failure.details:
                     log.warning("    %s: %s", d.name, d.value)
-        # Fetch stdout/stderr (best-effort)
-        for fname in ("stdout.txt", "stderr.txt"):
-            try:
-                stream = io.BytesIO()
-                batch_service_client.file.get_from_task(job_id, t.id, fname, stream)
-                data = stream.getvalue()
-                if not data:
-                    continue
-                tail = data[-max_log_bytes:]
+        for fname, tail in tail_future.result().items():
+            if tail:
                 log.info("  %s (last %d bytes):\n%s", fname, len(tail), tail.decode(errors='replace'))
-            except Exception as _:
-                pass
 
     # Pool / nodes
     if pool_id:
@@ -435,6 +2162,1479 @@ def dump_batch_diagnostics(batch_service_client, job_id, max_log_bytes=4096):
     log.info("===== Azure Batch Diagnostics (end) =====")
 
 
+# タスクのライフサイクルを区切るフェーズ（秒）
+TASK_METRIC_PHASES = ('queue_wait', 'download', 'run', 'upload', 'total')
+TASK_METRIC_QUANTILES = (('0.5', 'p50'), ('0.9', 'p90'), ('0.99', 'p99'))
+
+
+def _percentile(sorted_values, q):
+    """昇順の値の q 分位点（線形補間）"""
+    pos = (len(sorted_values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+
+def _phase_stats(values) -> dict:
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return {'count': 0}
+    stats = {'count': len(values), 'sum': round(sum(values), 3), 'mean': round(sum(values) / len(values), 3)}
+    for q, key in TASK_METRIC_QUANTILES:
+        stats[key] = round(_percentile(values, float(q)), 3)
+    stats['max'] = round(values[-1], 3)
+    return stats
+
+
+def _parse_timing_markers(data: bytes):
+    """TIMING_MARKER_FILE の内容から (コマンド開始, コマンド終了) の epoch 秒を返す（無い値は None）"""
+    marks = {}
+    for line in data.decode(errors='replace').splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            try:
+                marks[parts[0]] = float(parts[1])
+            except ValueError:
+                pass
+    return marks.get('start'), marks.get('end')
+
+
+class TaskMetricsCollector:
+    """
+    Collects per-task lifecycle timings from the completed tasks of a job.
+
+    Every completed task contributes its queue wait (creation to start) and
+    total time (start to end) from ``execution_info``. When the tasks were
+    submitted with timing markers and ``read_markers`` is set, the marker
+    file is read too, and the total is split into resource download (start
+    to command start), ``run`` (the ffmpeg command) and output upload
+    (command end to task end).
+
+    `collect` only lists tasks that completed since its previous call, so it
+    can run repeatedly while the job is in progress (see `on_poll`).
+    """
+    def __init__(self, batch_service_client, job_id, read_markers=False, max_workers=8):
+        self.client = batch_service_client
+        self.job_id = job_id
+        self.read_markers = read_markers
+        self.max_workers = max_workers
+        self.records = {}
+        self._since = None
+
+    def _record(self, task, markers):
+        info = task.execution_info
+        start, end = info.start_time, info.end_time
+        rec = {'task_id': task.id,
+               'node_id': getattr(task.node_info, 'node_id', None) if task.node_info else None,
+               'result': getattr(info.result, 'value', info.result),
+               'queue_wait': (start - task.creation_time).total_seconds() if task.creation_time else None,
+               'total': (end - start).total_seconds()}
+        cmd_start, cmd_end = markers or (None, None)
+        if cmd_start is not None and cmd_end is not None:
+            rec['download'] = round(cmd_start - start.timestamp(), 3)
+            rec['run'] = round(cmd_end - cmd_start, 3)
+            rec['upload'] = round(end.timestamp() - cmd_end, 3)
+        return rec
+
+    def _read_markers(self, task_id):
+        try:
+            return _parse_timing_markers(_read_task_file_tail(
+                self.client, self.job_id, task_id, TIMING_MARKER_FILE, 256))
+        except Exception as _:
+            return None
+
+    def collect(self) -> int:
+        """前回以降に完了したタスクを取り込み、新たに取り込んだ件数を返す"""
+        odata_filter = "state eq 'completed'"
+        if self._since is not None:
+            odata_filter += " and stateTransitionTime ge datetime'{}'".format(
+                self._since.strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+        tasks = [t for t in list_tasks(self.client, self.job_id, odata_filter,
+                                       select='id,creationTime,stateTransitionTime,executionInfo,nodeInfo')
+                 if t.id not in self.records and t.execution_info is not None
+                 and t.execution_info.start_time and t.execution_info.end_time]
+        if not tasks:
+            return 0
+        markers = [None] * len(tasks)
+        if self.read_markers:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as pool:
+                markers = list(pool.map(self._read_markers, [t.id for t in tasks]))
+        for task, mark in zip(tasks, markers):
+            self.records[task.id] = self._record(task, mark)
+        transitions = [t.state_transition_time for t in tasks if t.state_transition_time]
+        if transitions:
+            self._since = max(transitions + ([self._since] if self._since else []))
+        return len(tasks)
+
+    def on_poll(self, min_interval=60):
+        """wait_for_tasks_to_complete の on_poll 用に、最短 min_interval 秒ごとに collect するコールバックを返す"""
+        state = {'next': time.time() + min_interval}
+
+        def _on_poll(_counts):
+            if time.time() < state['next']:
+                return
+            state['next'] = time.time() + min_interval
+            try:
+                self.collect()
+            except (batchmodels.BatchErrorException, ClientRequestError) as e:
+                log.debug("Could not collect task metrics: %s", e)
+        return _on_poll
+
+    def summary(self) -> dict:
+        """フェーズごとの件数/合計/平均/パーセンタイルと、ノードごとの内訳を返す"""
+        records = list(self.records.values())
+        by_node = {}
+        for rec in records:
+            by_node.setdefault(rec['node_id'] or 'unknown', []).append(rec)
+        return {
+            'job_id': self.job_id,
+            'tasks': len(records),
+            'phases': {phase: _phase_stats(r.get(phase) for r in records) for phase in TASK_METRIC_PHASES},
+            'nodes': {node: {'tasks': len(recs),
+                             'failed': sum(1 for r in recs if r['result'] == 'failure'),
+                             'phases': {phase: _phase_stats(r.get(phase) for r in recs)
+                                        for phase in TASK_METRIC_PHASES}}
+                      for node, recs in sorted(by_node.items())},
+        }
+
+    def to_prometheus(self, summary=None) -> str:
+        """summary を Prometheus のテキスト形式で返す"""
+        summary = summary or self.summary()
+        job = summary['job_id']
+        lines = ['# HELP batch_task_phase_seconds Task lifecycle phase duration in seconds.',
+                 '# TYPE batch_task_phase_seconds summary']
+        for phase, st in summary['phases'].items():
+            if not st['count']:
+                continue
+            labels = f'job="{job}",phase="{phase}"'
+            for q, key in TASK_METRIC_QUANTILES:
+                lines.append(f'batch_task_phase_seconds{{{labels},quantile="{q}"}} {st[key]}')
+            lines.append(f'batch_task_phase_seconds_sum{{{labels}}} {st["sum"]}')
+            lines.append(f'batch_task_phase_seconds_count{{{labels}}} {st["count"]}')
+        lines += ['# HELP batch_node_tasks Completed tasks per compute node.',
+                  '# TYPE batch_node_tasks gauge']
+        for node, st in summary['nodes'].items():
+            lines.append(f'batch_node_tasks{{job="{job}",node="{node}"}} {st["tasks"]}')
+        lines += ['# HELP batch_node_phase_seconds Total phase time per compute node in seconds.',
+                  '# TYPE batch_node_phase_seconds gauge']
+        for node, st in summary['nodes'].items():
+            for phase, phase_st in st['phases'].items():
+                if phase_st['count']:
+                    lines.append(f'batch_node_phase_seconds{{job="{job}",node="{node}",phase="{phase}"}} '
+                                 f'{phase_st["sum"]}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path=None, prometheus_path=None) -> dict:
+        """summary を JSON / Prometheus テキスト形式のファイルに書き出し、summary を返す"""
+        summary = self.summary()
+        if json_path:
+            with open(json_path, 'w', encoding='utf-8') as f:
+                json.dump(summary, f, indent=2)
+        if prometheus_path:
+            with open(prometheus_path, 'w', encoding='utf-8') as f:
+                f.write(self.to_prometheus(summary))
+        phases = summary['phases']
+        log.info("Task metrics (%d tasks): %s", summary['tasks'],
+                 ", ".join(f"{p} p50={st['p50']}s p90={st['p90']}s" for p, st in phases.items() if st['count']))
+        return summary
+
+
+class StragglerPolicy:
+    """
+    Starts a duplicate of each running task that takes far longer than its
+    completed peers, and keeps whichever copy succeeds first.
+
+    A task is a straggler once its current attempt has been running longer
+    than ``multiplier`` times the median run time of the successful tasks
+    (after at least ``min_completed`` have finished), and at least
+    ``min_seconds``. The duplicate (``<task id>-dup``) reuses the task's
+    command line, resource files and output files. Batch has no node
+    anti-affinity, so the duplicate normally lands on whichever node frees a
+    slot first; the report notes when both copies ran on the same node. When
+    one copy succeeds the other is terminated, and the terminated copy is
+    not counted as a failure in the monitor's summary. Tasks that other
+    tasks depend on (segments of a segmented input, recognised by their
+    ``-segNNN`` ID) are never duplicated, because a duplicate cannot
+    satisfy the dependant's ``depends_on``.
+
+    Pass the policy to `wait_for_tasks_to_complete` as ``straggler_policy``.
+    """
+    DUPLICATE_SUFFIX = '-dup'
+
+    def __init__(self, batch_service_client, job_id, multiplier=2.0, min_completed=5, min_seconds=120,
+                 max_duplicates=10, check_interval=30):
+        self.client = batch_service_client
+        self.job_id = job_id
+        self.multiplier = multiplier
+        self.min_completed = min_completed
+        self.min_seconds = min_seconds
+        self.max_duplicates = max_duplicates
+        self.check_interval = check_interval
+        self.metrics = TaskMetricsCollector(batch_service_client, job_id)
+        self.pairs = {}
+        self._next_check = 0.0
+
+    def _threshold(self):
+        runs = sorted(r['total'] for r in self.metrics.records.values()
+                      if r['result'] == 'success' and not r['task_id'].endswith(self.DUPLICATE_SUFFIX))
+        if len(runs) < self.min_completed:
+            return None
+        return max(self.min_seconds, self.multiplier * _percentile(runs, 0.5))
+
+    @staticmethod
+    def _is_depended_on(task_id):
+        """他のタスクが depends_on で参照するタスク（セグメントタスク）か。ID の規則で判定し、一覧はしない"""
+        return SEGMENT_TASK_ID_PATTERN.search(task_id) is not None
+
+    def _start_duplicate(self, task_id, elapsed, node_id):
+        task = self.client.task.get(self.job_id, task_id)
+        duplicate_id = task_id + self.DUPLICATE_SUFFIX
+        self.client.task.add(self.job_id, batchmodels.TaskAddParameter(
+            id=duplicate_id,
+            command_line=task.command_line,
+            resource_files=task.resource_files,
+            output_files=task.output_files,
+            environment_settings=task.environment_settings,
+            constraints=task.constraints,
+            required_slots=task.required_slots))
+        self.pairs[task_id] = {'task_id': task_id, 'duplicate_id': duplicate_id, 'node_id': node_id,
+                               'started_after_seconds': round(elapsed, 1), 'winner': None}
+        log.warning("Straggler '%s' has run %.0fs on %s; started duplicate '%s'",
+                    task_id, elapsed, node_id, duplicate_id)
+
+    def _get_states(self, task_ids):
+        states = {}
+        for task_id in task_ids:
+            try:
+                states[task_id] = self.client.task.get(
+                    self.job_id, task_id,
+                    task_get_options=batchmodels.TaskGetOptions(select='id,state,executionInfo,nodeInfo'))
+            except batchmodels.BatchErrorException as e:
+                log.debug("Could not read task '%s': %s", task_id, e)
+        return states
+
+    def _resolve_pairs(self):
+        """成功した側が出たペアについて、もう一方を終了させる"""
+        open_pairs = [p for p in self.pairs.values() if p['winner'] is None]
+        if not open_pairs:
+            return
+        states = self._get_states([i for p in open_pairs for i in (p['task_id'], p['duplicate_id'])])
+        for pair in open_pairs:
+            original, duplicate = states.get(pair['task_id']), states.get(pair['duplicate_id'])
+            for winner, loser, name in ((duplicate, original, 'duplicate'), (original, duplicate, 'original')):
+                info = getattr(winner, 'execution_info', None)
+                if winner is None or winner.state != batchmodels.TaskState.completed or \
+                        getattr(info, 'result', None) != batchmodels.TaskExecutionResult.success:
+                    continue
+                pair['winner'] = name
+                pair['winner_seconds'] = round((info.end_time - info.start_time).total_seconds(), 1)
+                loser_info = getattr(loser, 'execution_info', None)
+                loser_node = getattr(getattr(loser, 'node_info', None), 'node_id', None)
+                pair['same_node'] = loser_node is not None and loser_node == getattr(winner.node_info, 'node_id', None)
+                if loser is not None and loser.state != batchmodels.TaskState.completed:
+                    self.client.task.terminate(self.job_id, loser.id)
+                    pair['terminated'] = loser.id
+                    if getattr(loser_info, 'start_time', None):
+                        pair['loser_seconds'] = round(
+                            (datetime.datetime.now(datetime.UTC) - loser_info.start_time).total_seconds(), 1)
+                log.info("Straggler '%s': %s copy won after %.0fs%s", pair['task_id'], name,
+                         pair['winner_seconds'], f"; terminated '{pair['terminated']}'" if 'terminated' in pair else '')
+                break
+
+    def poll(self, counts):
+        """監視ループから毎回呼ばれる。check_interval ごとに遅いタスクを探し、重複タスクの勝敗を処理する"""
+        if time.time() < self._next_check:
+            return
+        self._next_check = time.time() + self.check_interval
+        try:
+            self._resolve_pairs()
+            self.metrics.collect()
+            threshold = self._threshold()
+            if threshold is None or len(self.pairs) >= self.max_duplicates or not counts.get('running'):
+                return
+            now = datetime.datetime.now(datetime.UTC)
+            for task in list_tasks(self.client, self.job_id, "state eq 'running'",
+                                   select='id,executionInfo,nodeInfo'):
+                start = getattr(task.execution_info, 'start_time', None)
+                if start is None or task.id in self.pairs or task.id.endswith(self.DUPLICATE_SUFFIX) \
+                        or self._is_depended_on(task.id):
+                    continue
+                elapsed = (now - start).total_seconds()
+                if elapsed > threshold:
+                    self._start_duplicate(task.id, elapsed, getattr(task.node_info, 'node_id', None))
+                    if len(self.pairs) >= self.max_duplicates:
+                        break
+        except (batchmodels.BatchErrorException, ClientRequestError) as e:
+            log.debug("Straggler check failed: %s", e)
+
+    def covered_task_ids(self):
+        """もう一方のコピーが成功したため失敗として数えないタスク ID"""
+        covered = set()
+        for pair in self.pairs.values():
+            if pair['winner'] == 'duplicate':
+                covered.add(pair['task_id'])
+            elif pair['winner'] == 'original':
+                covered.add(pair['duplicate_id'])
+        return covered
+
+    def finalize(self):
+        """監視の終了時に呼ぶ。未処理のペアを解決し、重複実行の記録を返す
+
+        time_cut_seconds は、重複側が勝ったペアで元のタスクが終了されるまでに走っていた時間と
+        重複側の所要時間の差の合計（遅いコピーを待たずに済んだ時間の目安）。
+        """
+        try:
+            self._resolve_pairs()
+        except (batchmodels.BatchErrorException, ClientRequestError) as e:
+            log.debug("Could not resolve duplicate tasks: %s", e)
+        pairs = list(self.pairs.values())
+        duplicate_wins = [p for p in pairs if p['winner'] == 'duplicate']
+        report = {
+            'duplicates_started': len(pairs),
+            'duplicate_wins': len(duplicate_wins),
+            'original_wins': sum(1 for p in pairs if p['winner'] == 'original'),
+            'unresolved': sum(1 for p in pairs if p['winner'] is None),
+            'time_cut_seconds': round(sum(max(0.0, p.get('loser_seconds', 0) - p['winner_seconds'])
+                                          for p in duplicate_wins), 1),
+            'pairs': pairs,
+        }
+        if pairs:
+            log.info("Stragglers: %d duplicates, %d won by duplicate, %d by original, time cut ~%.0fs",
+                     report['duplicates_started'], report['duplicate_wins'], report['original_wins'],
+                     report['time_cut_seconds'])
+        return report
+
+
+def download_outputs(storage: StorageV12, container_name: str, dest_dir: str, prefix: str = None,
+                     max_workers: int = 8, max_concurrency: int = 4, exclude_prefixes=(SEGMENTS_PREFIX,),
+                     results_per_page: int = 5000) -> dict:
+    """
+    Downloads the blobs of a container (under ``prefix``) into ``dest_dir``.
+
+    The container is listed page by page and the blobs are downloaded
+    ``max_workers`` at a time while the listing continues, so memory stays
+    bounded however many outputs there are. Each blob is written to a
+    ``.part`` file that is renamed when complete. Blobs whose local copy
+    has the same size and whose recorded ETag (see `DownloadManifest`) is
+    unchanged are skipped, so an interrupted download can simply be run
+    again.
+
+    :return: Counts of downloaded and skipped blobs, bytes and seconds.
+    :rtype: dict
+    """
+    manifest = DownloadManifest(dest_dir)
+    skipped = 0
+
+    def _items():
+        nonlocal skipped
+        for page in storage.iter_blob_pages(container_name, name_starts_with=prefix,
+                                            results_per_page=results_per_page):
+            for blob in page:
+                if exclude_prefixes and blob.name.startswith(tuple(exclude_prefixes)):
+                    continue
+                if manifest.is_current(blob.name, blob.size, blob.etag):
+                    skipped += 1
+                    continue
+                yield blob.name, manifest.local_path(blob.name), blob.etag
+
+    try:
+        report = storage.download_blobs(
+            container_name, _items(), max_workers=max_workers, max_concurrency=max_concurrency,
+            on_downloaded=lambda item, stats: manifest.record(item[0], stats["bytes"], stats["etag"]))
+    finally:
+        manifest.save()
+    report["skipped"] = skipped
+    log.info("Outputs in '%s': %d downloaded, %d already present in %s",
+             container_name, report["downloaded"], skipped, dest_dir)
+    return report
+
+
+class OutputFollower:
+    """
+    Downloads each task's outputs as soon as the task succeeds.
+
+    `on_poll` returns a monitor callback that lists the tasks completed
+    since its previous run (as `TaskMetricsCollector` does) and queues the
+    blobs named by their output files for download on a background thread
+    pool, so monitoring is not held up by the transfers. Wildcard output
+    patterns are resolved by listing their blob prefix. Call `finish` after
+    the job to wait for the queued downloads.
+    """
+    def __init__(self, batch_service_client, job_id, storage: StorageV12, container_name, dest_dir,
+                 max_workers=8, max_concurrency=4, exclude_prefixes=(SEGMENTS_PREFIX,)):
+        self.client = batch_service_client
+        self.job_id = job_id
+        self.storage = storage
+        self.container_name = container_name
+        self.manifest = DownloadManifest(dest_dir)
+        self.max_concurrency = max_concurrency
+        self.exclude_prefixes = tuple(exclude_prefixes or ())
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self._futures = []
+        self._queued = set()
+        self._since = None
+
+    def _output_blob_names(self, task):
+        """タスクの OutputFile が作る Blob 名を返す（ワイルドカードの出力だけプレフィックスで一覧する）"""
+        for of in task.output_files or []:
+            path = of.destination.container.path
+            wildcard = re.search(r'[*?\[]', of.file_pattern)
+            if not wildcard:
+                # path 省略時はファイル名がそのまま Blob 名になる
+                yield path or of.file_pattern
+                continue
+            # path 省略時はパターンのワイルドカードより前の部分で絞る（コンテナー全体を一覧しない）
+            prefix = path or of.file_pattern[:wildcard.start()]
+            for page in self.storage.iter_blob_pages(self.container_name, name_starts_with=prefix or None):
+                yield from (b.name for b in page)
+
+    def _download(self, blob_name):
+        stats = self.storage.download_blob_to_path(self.container_name, blob_name,
+                                                   self.manifest.local_path(blob_name),
+                                                   max_concurrency=self.max_concurrency)
+        self.manifest.record(blob_name, stats["bytes"], stats["etag"])
+        return stats
+
+    def poll(self) -> int:
+        """前回以降に成功したタスクの出力をダウンロード待ちに加え、加えた件数を返す"""
+        odata_filter = "state eq 'completed' and executionInfo/result eq 'success'"
+        if self._since is not None:
+            odata_filter += " and stateTransitionTime ge datetime'{}'".format(
+                self._since.strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+        tasks = list_tasks(self.client, self.job_id, odata_filter, select='id,stateTransitionTime,outputFiles')
+        queued = 0
+        for task in tasks:
+            for name in self._output_blob_names(task):
+                if name in self._queued or name.startswith(self.exclude_prefixes) or \
+                        self.manifest.is_current(name):
+                    continue
+                self._queued.add(name)
+                self._futures.append(self._pool.submit(self._download, name))
+                queued += 1
+        transitions = [t.state_transition_time for t in tasks if t.state_transition_time]
+        if transitions:
+            self._since = max(transitions + ([self._since] if self._since else []))
+        return queued
+
+    def on_poll(self, min_interval=30):
+        """wait_for_tasks_to_complete の on_poll 用に、最短 min_interval 秒ごとに poll するコールバックを返す"""
+        state = {'next': 0.0}
+
+        def _on_poll(_counts):
+            if time.time() < state['next']:
+                return
+            state['next'] = time.time() + min_interval
+            try:
+                self.poll()
+            except (batchmodels.BatchErrorException, ClientRequestError, HttpResponseError) as e:
+                log.debug("Could not queue task outputs: %s", e)
+        return _on_poll
+
+    def finish(self) -> int:
+        """待ち行列のダウンロードの完了を待ち、ダウンロードできた件数を返す（失敗分は後の一括ダウンロードで再取得）"""
+        downloaded = 0
+        for fut in concurrent.futures.as_completed(self._futures):
+            try:
+                fut.result()
+                downloaded += 1
+            except (HttpResponseError, OSError) as e:
+                log.warning("Output download failed: %s", e)
+        self._pool.shutdown(wait=True)
+        self.manifest.save()
+        log.info("Downloaded %d task outputs while the job was running", downloaded)
+        return downloaded
+
+
+def create_batch_client(credential, batch_account_url=None, auth_mode=None,
+                        account_name=None, account_key=None):
+    """config（または引数）に従って AAD / SharedKey の BatchServiceClient を作る"""
+    batch_url = _normalize_batch_url(batch_account_url or getattr(config, '_BATCH_ACCOUNT_URL', ''))
+    auth_mode = (auth_mode or getattr(config, '_AUTH_MODE', 'SharedKey')).upper()
+    log.info("Batch URL: %s", batch_url)
+    log.info("Auth mode: %s", auth_mode)
+    if auth_mode == 'AAD':
+        # AAD 認証: 期限が近づくまでトークンを再利用する msrest 互換クレデンシャルを使用
+        token_creds = AADTokenCredentials(credential, "https://batch.core.windows.net/.default",
+                                          refresh_margin=getattr(config, '_AAD_TOKEN_REFRESH_MARGIN_SECONDS', 300))
+        return BatchServiceClient(token_creds, batch_url=batch_url)
+    # SharedKey 認証
+    creds = batch_auth.SharedKeyCredentials(
+        account_name or config._BATCH_ACCOUNT_NAME,
+        account_key or config._BATCH_ACCOUNT_KEY
+    )
+    return BatchServiceClient(creds, batch_url=batch_url)
+
+
+def create_pool_from_config(batch_client, storage: StorageV12, pool_id):
+    """config のスロット数・自動スケール・ffmpeg 用意方法でプールを作成し、
+    {'task_slots', 'autoscale_formula'} を返す"""
+    task_slots = resolve_task_slots_per_node(
+        config._POOL_VM_SIZE, getattr(config, '_TASK_SLOTS_PER_NODE', 1))
+    # 自動スケール: キュー長に応じてノード数を増減する（固定ノード数の代わり）
+    autoscale_formula = None
+    if getattr(config, '_AUTOSCALE', False):
+        autoscale_formula = build_autoscale_formula(
+            min_dedicated=getattr(config, '_AUTOSCALE_MIN_DEDICATED', 0),
+            max_dedicated=getattr(config, '_AUTOSCALE_MAX_DEDICATED', 0),
+            min_low_priority=getattr(config, '_AUTOSCALE_MIN_LOW_PRIORITY', 0),
+            max_low_priority=getattr(config, '_AUTOSCALE_MAX_LOW_PRIORITY', DEFAULT_AUTOSCALE_MAX_LOW_PRIORITY),
+            task_slots_per_node=task_slots,
+            prefer_low_priority=getattr(config, '_AUTOSCALE_PREFER_LOW_PRIORITY', True))
+    # ffmpeg の用意: 'apt'（既定）/ 'staged'（固定ビルドをノードにキャッシュ）/ 'app_package'
+    provision = getattr(config, '_FFMPEG_PROVISION', 'apt')
+    start_task = app_refs = None
+    if provision != 'apt':
+        staged = None
+        if provision == 'staged':
+            staged = stage_ffmpeg_build(storage, getattr(config, '_FFMPEG_TOOLS_CONTAINER', 'tools'),
+                                        config._FFMPEG_ARCHIVE_PATH,
+                                        sas_hours=getattr(config, '_FFMPEG_SAS_HOURS', 144))
+        start_task, app_refs = build_ffmpeg_start_task(
+            provision, staged=staged, app_package=getattr(config, '_FFMPEG_APP_PACKAGE', None))
+    create_pool(batch_client, pool_id, task_slots_per_node=task_slots,
+                node_fill_type=getattr(config, '_NODE_FILL_TYPE', None),
+                auto_scale_formula=autoscale_formula,
+                auto_scale_interval=datetime.timedelta(
+                    minutes=getattr(config, '_AUTOSCALE_INTERVAL_MINUTES', 5)),
+                start_task=start_task, application_package_references=app_refs)
+    return {'task_slots': task_slots, 'autoscale_formula': autoscale_formula}
+
+
+class ExecutionBackend(abc.ABC):
+    """
+    Runs the task definitions from `build_tasks` somewhere.
+
+    The methods mirror the module-level Azure Batch steps (`create_pool`,
+    `create_job`, `add_tasks`, `wait_for_tasks_to_complete`), so the
+    orchestrator can run the same tasks on Azure Batch or on the local
+    machine.
+    """
+    name = None
+
+    @abc.abstractmethod
+    def create_pool(self) -> dict:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def create_job(self, uses_task_dependencies=False):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def add_tasks(self, input_files, output_container_url, **task_options) -> int:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def wait_for_tasks_to_complete(self, timeout, **monitor_options) -> dict:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class AzureBatchBackend(ExecutionBackend):
+    """プール/ジョブ/タスクを Azure Batch で実行するバックエンド（従来の処理をそのまま呼ぶ）"""
+    name = 'batch'
+
+    def __init__(self, batch_service_client, storage: StorageV12, pool_id, job_id,
+                 max_workers=8, max_attempts=6):
+        self.client = batch_service_client
+        self.storage = storage
+        self.pool_id = pool_id
+        self.job_id = job_id
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+
+    def create_pool(self) -> dict:
+        return create_pool_from_config(self.client, self.storage, self.pool_id)
+
+    def create_job(self, uses_task_dependencies=False):
+        create_job(self.client, self.job_id, self.pool_id, uses_task_dependencies=uses_task_dependencies)
+
+    def add_tasks(self, input_files, output_container_url, **task_options) -> int:
+        return add_tasks(self.client, self.job_id, input_files, output_container_url,
+                         max_workers=self.max_workers, max_attempts=self.max_attempts, **task_options)
+
+    def wait_for_tasks_to_complete(self, timeout, **monitor_options) -> dict:
+        return wait_for_tasks_to_complete(self.client, self.job_id, timeout, **monitor_options)
+
+
+def split_inputs_across_shards(input_files, weights, media_info=None):
+    """
+    Splits input files across shards in proportion to their weights.
+
+    Inputs are assigned longest first (duration from ``media_info``, else
+    size, else one unit each) to the shard whose load relative to its
+    weight stays lowest, so each shard gets about its share of the work
+    rather than of the file count. Each shard's inputs keep their original
+    order. Shards with a weight of zero get nothing.
+
+    :param dict weights: Weight by shard name.
+    :return: Input files by shard name.
+    :rtype: dict
+    """
+    media_info = media_info or {}
+    input_files = list(input_files)
+    active = [(name, w) for name, w in weights.items() if w > 0]
+    if not active:
+        raise ValueError("ERROR: all shards have zero weight")
+
+    def _cost(input_file):
+        info = media_info.get(input_file.file_path, {})
+        return info.get('duration') or info.get('size') or 1
+
+    heap = [(0.0, i, name, w) for i, (name, w) in enumerate(active)]
+    assigned = {name: [] for name in weights}
+    for idx in sorted(range(len(input_files)), key=lambda k: -_cost(input_files[k])):
+        load, i, name, w = heapq.heappop(heap)
+        assigned[name].append(idx)
+        heapq.heappush(heap, (load + _cost(input_files[idx]) / w, i, name, w))
+    return {name: [input_files[idx] for idx in sorted(indices)] for name, indices in assigned.items()}
+
+
+def pool_task_slots(batch_service_client, pool_id) -> int:
+    """プールの目標ノード数（自動スケール中は現在のノード数との大きい方）x ノードあたりのスロット数"""
+    pool = batch_service_client.pool.get(pool_id, pool_get_options=batchmodels.PoolGetOptions(
+        select='id,taskSlotsPerNode,targetDedicatedNodes,targetLowPriorityNodes,'
+               'currentDedicatedNodes,currentLowPriorityNodes'))
+    nodes = max((pool.target_dedicated_nodes or 0) + (pool.target_low_priority_nodes or 0),
+                (pool.current_dedicated_nodes or 0) + (pool.current_low_priority_nodes or 0))
+    return nodes * (pool.task_slots_per_node or 1)
+
+
+class ShardedBatchBackend(ExecutionBackend):
+    """
+    Spreads one run over several Batch pools and accounts.
+
+    Each shard is an `AzureBatchBackend` with its own client, pool and job.
+    Pools and jobs are created on all shards in parallel. The inputs are
+    split across the shards by `split_inputs_across_shards`, in proportion
+    to each shard's ``weight`` or, with ``split='capacity'``, to the task
+    slots of its pool (`pool_task_slots`). Each shard's tasks are then
+    submitted in parallel. The monitor waits on all jobs at once, logs the
+    combined progress, and passes the combined counts to ``on_poll``.
+    """
+    name = 'sharded'
+
+    def __init__(self, shards, split='weight'):
+        if split not in ('weight', 'capacity'):
+            raise ValueError(f"Unknown shard split: {split}")
+        self.shards = shards    # [(name, AzureBatchBackend, weight)]
+        self.split = split
+
+    @classmethod
+    def from_targets(cls, targets, credential, storage: StorageV12, job_id, split='weight',
+                     max_workers=8, max_attempts=6):
+        """config._SHARD_TARGETS の形式（dict のリスト）から各シャードのクライアント/バックエンドを作る"""
+        shards = []
+        for i, target in enumerate(targets):
+            name = target.get('name') or f"shard{i}"
+            client = create_batch_client(credential, batch_account_url=target.get('batch_account_url'),
+                                         auth_mode=target.get('auth_mode'), account_name=target.get('account_name'),
+                                         account_key=target.get('account_key'))
+            backend = AzureBatchBackend(client, storage, target.get('pool_id') or config._POOL_ID,
+                                        target.get('job_id') or f"{job_id}-{name}",
+                                        max_workers=max_workers, max_attempts=max_attempts)
+            shards.append((name, backend, float(target.get('weight', 1))))
+        if len({name for name, _, _ in shards}) != len(shards):
+            raise ValueError("ERROR: shard names must be unique")
+        return cls(shards, split=split)
+
+    def _map(self, fn) -> dict:
+        """fn(name, backend) を全シャードで並列に実行し、シャード名ごとの結果を返す"""
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.shards)) as pool:
+            futures = {name: pool.submit(fn, name, backend) for name, backend, _ in self.shards}
+            return {name: fut.result() for name, fut in futures.items()}
+
+    def create_pool(self) -> dict:
+        settings = self._map(lambda name, backend: backend.create_pool())
+        first = settings[self.shards[0][0]]
+        return {'task_slots': first['task_slots'],
+                'autoscale_formula': first['autoscale_formula'],
+                'shards': settings}
+
+    def create_job(self, uses_task_dependencies=False):
+        self._map(lambda name, backend: backend.create_job(uses_task_dependencies=uses_task_dependencies))
+
+    def shard_weights(self) -> dict:
+        weights = {name: weight for name, _, weight in self.shards}
+        if self.split == 'capacity':
+            slots = self._map(lambda name, backend: pool_task_slots(backend.client, backend.pool_id))
+            if any(slots.values()):
+                weights = {name: float(n) for name, n in slots.items()}
+            else:
+                log.warning("Shard pools report no task slots yet; splitting by weight.")
+        return weights
+
+    def add_tasks(self, input_files, output_container_url, **task_options) -> int:
+        input_files = list(input_files)
+        weights = self.shard_weights()
+        parts = split_inputs_across_shards(input_files, weights, task_options.get('media_info'))
+        for name, backend, _ in self.shards:
+            log.info("Shard '%s' (job '%s', pool '%s', weight %g): %d inputs",
+                     name, backend.job_id, backend.pool_id, weights[name], len(parts[name]))
+        added = self._map(lambda name, backend: backend.add_tasks(parts[name], output_container_url,
+                                                                  **task_options) if parts[name] else 0)
+        return sum(added.values())
+
+    def wait_for_tasks_to_complete(self, timeout, on_poll=None, log_interval=30, **monitor_options) -> dict:
+        lock = threading.Lock()
+        progress = {}
+        state = {'next_log': 0.0}
+
+        def _shard_on_poll(name):
+            def _on_poll(counts):
+                with lock:
+                    progress[name] = counts
+                    combined = {k: sum(c[k] for c in progress.values()) for k in counts}
+                    due = time.time() >= state['next_log']
+                    if due:
+                        state['next_log'] = time.time() + log_interval
+                if due:
+                    total = combined['active'] + combined['running'] + combined['completed']
+                    log.info("All shards: %d/%d tasks completed (running %d, failed %d; %d of %d shards reporting)",
+                             combined['completed'], total, combined['running'], combined['failed'],
+                             len(progress), len(self.shards))
+                if on_poll is not None:
+                    on_poll(combined)
+            return _on_poll
+
+        summaries = self._map(lambda name, backend: backend.wait_for_tasks_to_complete(
+            timeout, on_poll=_shard_on_poll(name), **monitor_options))
+        counts = {k: sum(s['counts'][k] for s in summaries.values())
+                  for k in ('active', 'running', 'completed', 'succeeded', 'failed')}
+        summary = {
+            'job_id': [backend.job_id for _, backend, _ in self.shards],
+            'counts': counts,
+            'succeeded': counts['succeeded'],
+            'failed': counts['failed'],
+            'failed_task_ids': [f"{name}/{task_id}" for name, s in summaries.items()
+                                for task_id in s['failed_task_ids']],
+            'elapsed_seconds': max(s['elapsed_seconds'] for s in summaries.values()),
+            'polls': sum(s['polls'] for s in summaries.values()),
+            'shards': summaries,
+        }
+        log.info("All shards completed. succeeded=%d, failed=%d, elapsed=%.1fs",
+                 summary['succeeded'], summary['failed'], summary['elapsed_seconds'])
+        return summary
+
+
+def _local_path_from_url(url: str) -> str:
+    """file:// URL をローカルパスに変換する（ローカルバックエンドは file:// のみ扱う）"""
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme != 'file':
+        raise ValueError(f"Local backend only supports file:// URLs: {url}")
+    return urllib.request.url2pathname(parsed.path)
+
+
+def local_resource_files(file_paths):
+    """ローカルの入力ファイルを、アップロードせずに参照する ResourceFile（file:// URL）の列にする"""
+    for path in file_paths:
+        path = os.path.abspath(path)
+        yield batchmodels.ResourceFile(file_path=os.path.basename(path), http_url=pathlib.Path(path).as_uri())
+
+
+def _local_task_spec(task, work_root):
+    """TaskAddParameter を子プロセスに渡せる dict（コマンド、配置するファイル、出力先）に変換する"""
+    workdir = os.path.join(work_root, task.id, 'wd')
+    resources = []
+    containers = []
+    for rf in task.resource_files or []:
+        if rf.http_url:
+            resources.append((_local_path_from_url(rf.http_url), rf.file_path or os.path.basename(rf.http_url)))
+        elif rf.storage_container_url:
+            # コンテナー指定は実行時に展開する（結合タスクの入力は先行タスクの出力なので、投入時にはまだ無い）
+            containers.append((_local_path_from_url(rf.storage_container_url.split('?')[0]),
+                               rf.blob_prefix or '', rf.file_path or ''))
+    outputs = []
+    for of in task.output_files or []:
+        container = of.destination.container
+        outputs.append((of.file_pattern, _local_path_from_url(container.container_url.split('?')[0]),
+                        container.path, str(getattr(of.upload_options.upload_condition, 'value',
+                                                    of.upload_options.upload_condition))))
+    return {'task_id': task.id, 'argv': shlex.split(task.command_line), 'workdir': workdir,
+            'resources': resources, 'containers': containers, 'outputs': outputs}
+
+
+def _local_worker_init(pid_queue=None):
+    """（子プロセス）ワーカーを自身のプロセスグループに入れ、タイムアウト時に ffmpeg ごと終了できるようにする
+
+    pid_queue にはワーカーの PID（= プロセスグループ ID）を送り、親が終了させる対象を把握できるようにする。
+    """
+    if hasattr(os, 'setpgid'):
+        os.setpgid(0, 0)
+    if pid_queue is not None:
+        pid_queue.put(os.getpid())
+
+
+def _run_local_task(spec) -> dict:
+    """（子プロセス）ファイルを配置してコマンドを実行し、条件に合う出力を出力ディレクトリへコピーする"""
+    workdir = spec['workdir']
+    os.makedirs(workdir, exist_ok=True)
+    resources = list(spec['resources'])
+    for root, prefix, dest_dir in spec['containers']:
+        for folder, _, files in os.walk(root):
+            for filename in files:
+                name = os.path.relpath(os.path.join(folder, filename), root).replace(os.sep, '/')
+                if name.startswith(prefix):
+                    resources.append((os.path.join(folder, filename), os.path.join(dest_dir, name)))
+    for src, dest in resources:
+        target = os.path.join(workdir, dest)
+        os.makedirs(os.path.dirname(target) or workdir, exist_ok=True)
+        shutil.copyfile(src, target)
+    started = time.time()
+    parent = os.path.dirname(workdir)
+    env = dict(os.environ, AZ_BATCH_TASK_WORKING_DIR=workdir, AZ_BATCH_TASK_DIR=parent)
+    with open(os.path.join(parent, 'stdout.txt'), 'wb') as out, \
+            open(os.path.join(parent, 'stderr.txt'), 'wb') as err:
+        try:
+            exit_code = subprocess.run(spec['argv'], cwd=workdir, stdout=out, stderr=err, env=env).returncode
+        except OSError as e:
+            err.write(str(e).encode())
+            exit_code = 127
+    ended = time.time()
+    succeeded = exit_code == 0
+    for pattern, dest_root, path, condition in spec['outputs']:
+        if condition == 'tasksuccess' and not succeeded or condition == 'taskfailure' and succeeded:
+            continue
+        wildcard = any(c in pattern for c in '*?[')
+        for match in glob.glob(os.path.join(workdir, pattern), recursive=True):
+            rel = os.path.relpath(match, workdir).replace(os.sep, '/')
+            name = rel if path is None else (path.rstrip('/') + '/' + rel if wildcard else path)
+            target = os.path.join(dest_root, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(match, target)
+    return {'task_id': spec['task_id'], 'exit_code': exit_code, 'start': started, 'end': ended}
+
+
+class LocalProcessBackend(ExecutionBackend):
+    """
+    Runs the generated command lines on this machine.
+
+    Each task gets ``<work_root>/<job_id>/<task_id>/wd`` as its working
+    directory, its resource files are copied there from ``file://`` URLs,
+    and its output files are copied under the directory that the
+    ``file://`` output container URL points to, using the same names the
+    blobs would get. Tasks run in a process pool sized to the local cores.
+
+    ``depends_on`` follows the Batch rules: a dependant runs once its
+    dependencies have completed, and a failed dependency blocks it (it is
+    marked failed without running) unless the failed task's
+    ``exit_conditions`` satisfy dependencies on failure, as segment tasks
+    do. Dependants of missing or circular dependencies are marked failed.
+    """
+    name = 'local'
+
+    def __init__(self, job_id, work_root=None, max_workers=None, keep_workdirs=False):
+        self.job_id = job_id
+        self.work_root = os.path.join(work_root or tempfile.gettempdir(), 'batch_ffmpeg_local', job_id)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.keep_workdirs = keep_workdirs
+        self._tasks = {}
+        self._results = {}
+
+    def create_pool(self) -> dict:
+        log.info("Local backend: %d worker processes", self.max_workers)
+        return {'task_slots': 1, 'autoscale_formula': None}
+
+    def create_job(self, uses_task_dependencies=False):
+        shutil.rmtree(self.work_root, ignore_errors=True)
+        os.makedirs(self.work_root)
+        self._tasks.clear()
+        self._results.clear()
+
+    def add_tasks(self, input_files, output_container_url, **task_options) -> int:
+        for task in build_tasks(input_files, output_container_url, **task_options):
+            if task.id not in self._tasks:
+                default_exit = getattr(task.exit_conditions, 'default', None)
+                self._tasks[task.id] = (_local_task_spec(task, self.work_root),
+                                        list(getattr(task.depends_on, 'task_ids', None) or []),
+                                        getattr(default_exit, 'dependency_action', None)
+                                        == batchmodels.DependencyAction.satisfy)
+        log.info("Local backend: %d tasks queued for job '%s'", len(self._tasks), self.job_id)
+        return len(self._tasks)
+
+    def wait_for_tasks_to_complete(self, timeout, **monitor_options) -> dict:
+        started = time.monotonic()
+        deadline = started + timeout.total_seconds()
+        waiting = {tid: deps for tid, (_, deps, _) in self._tasks.items() if tid not in self._results}
+        pid_queue = multiprocessing.Queue()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers, initializer=_local_worker_init,
+                                                    initargs=(pid_queue,)) as pool:
+            running = {}
+            while waiting or running:
+                progressed = False
+                for tid, deps in list(waiting.items()):
+                    if any(self._blocks_dependants(d) for d in deps):
+                        self._results[tid] = {'task_id': tid, 'exit_code': None, 'blocked': True}
+                    elif all(d in self._results for d in deps):
+                        try:
+                            running[pool.submit(_run_local_task, self._tasks[tid][0])] = tid
+                        except concurrent.futures.BrokenExecutor as e:
+                            self._results[tid] = {'task_id': tid, 'exit_code': None, 'error': str(e)}
+                    else:
+                        continue
+                    del waiting[tid]
+                    progressed = True
+                if not running:
+                    if not progressed:
+                        # 存在しないタスクへの依存や循環依存: 実行できないので失敗扱いにする
+                        for tid in waiting:
+                            self._results[tid] = {'task_id': tid, 'exit_code': None, 'blocked': True}
+                        waiting.clear()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._terminate_pool(pool, pid_queue)
+                    raise RuntimeError(f"ERROR: local tasks did not complete within timeout: {timeout}")
+                done, _ = concurrent.futures.wait(running, timeout=remaining,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    tid = running.pop(fut)
+                    try:
+                        result = fut.result()
+                    except Exception as e:
+                        # ファイル配置の失敗やワーカーの異常終了: 他のタスクは続け、このタスクは失敗として記録する
+                        self._results[tid] = {'task_id': tid, 'exit_code': None, 'error': str(e)}
+                        log.warning("Local task %s: failed to run: %s", tid, e)
+                        continue
+                    self._results[tid] = result
+                    log.info("Local task %s: exit=%s (%.1fs)", result['task_id'], result['exit_code'],
+                             result['end'] - result['start'])
+        failed_ids = [tid for tid, r in self._results.items() if r['exit_code'] != 0]
+        counts = {'active': 0, 'running': 0, 'completed': len(self._results),
+                  'succeeded': len(self._results) - len(failed_ids), 'failed': len(failed_ids)}
+        summary = {'job_id': self.job_id, 'counts': counts, 'succeeded': counts['succeeded'],
+                   'failed': counts['failed'], 'failed_task_ids': failed_ids,
+                   'elapsed_seconds': round(time.monotonic() - started, 1), 'polls': 0}
+        log.info("All local tasks completed. succeeded=%d, failed=%d, elapsed=%.1fs",
+                 summary['succeeded'], summary['failed'], summary['elapsed_seconds'])
+        if failed_ids:
+            log.warning("Failed tasks: %s (logs under %s)", ", ".join(failed_ids[:50]), self.work_root)
+        return summary
+
+    def _blocks_dependants(self, task_id) -> bool:
+        """完了したタスクが失敗しており、依存するタスクを実行させない（Batch の既定の block）か"""
+        result = self._results.get(task_id)
+        return result is not None and result['exit_code'] != 0 and not self._tasks[task_id][2]
+
+    @staticmethod
+    def _terminate_pool(pool, pid_queue):
+        """未開始のタスクを取り消し、実行中のワーカーを（起動した ffmpeg ごと）終了させる"""
+        pool.shutdown(wait=False, cancel_futures=True)
+        pids = set()
+        while True:
+            try:
+                pids.add(pid_queue.get(timeout=0.2))
+            except queue.Empty:
+                break
+        # タスクを実行中のワーカーは初期化を終えているので、ここで全て見つかる
+        for pid in pids:
+            try:
+                if hasattr(os, 'killpg'):
+                    os.killpg(pid, signal.SIGTERM)
+                else:
+                    os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                # すでに終了したワーカー
+                pass
+
+    def close(self):
+        if not self.keep_workdirs and not any(r['exit_code'] != 0 for r in self._results.values()):
+            shutil.rmtree(self.work_root, ignore_errors=True)
+
+
+def choose_execution_backend(file_paths, setting='batch', max_files=24, max_total_mb=2048) -> str:
+    """
+    Chooses ``'local'`` or ``'batch'`` execution for a set of inputs.
+
+    ``setting`` forces a backend unless it is ``'auto'``; then small batches
+    (at most ``max_files`` inputs and ``max_total_mb`` in total) run locally
+    when ffmpeg is installed here, because creating a pool and waiting for
+    nodes takes longer than transcoding them on this machine.
+    """
+    if setting in ('batch', 'local'):
+        return setting
+    if setting != 'auto':
+        raise ValueError(f"Unknown execution backend: {setting}")
+    total_mb = sum(os.path.getsize(p) for p in file_paths) / (1024 * 1024)
+    if len(file_paths) <= max_files and total_mb <= max_total_mb and shutil.which('ffmpeg'):
+        choice = 'local'
+    else:
+        choice = 'batch'
+    log.info("Execution backend: %s (%d files, %.1f MB)", choice, len(file_paths), total_mb)
+    return choice
+
+
+_PIPELINE_DONE = object()
+
+
+def run_pipeline(batch_service_client, storage: StorageV12, file_paths, input_container_name,
+                 job_id, output_container_sas_url, prepare_batch, upload_workers=8, upload_concurrency=4,
+                 queue_size=1000, manifest: UploadManifest = None, result_cache: ResultCache = None,
+                 submit_workers=4, flush_seconds=1.0, max_attempts=6, profiles=None, incremental=True,
+                 timing_markers=False):
+    """
+    Uploads inputs and submits their tasks as overlapping pipeline stages.
+
+    ``prepare_batch`` (pool and job creation) starts at the same time as the
+    uploads. Each input's task is queued as soon as its upload and SAS URL
+    are ready, and is submitted once the job exists, in chunks of up to 100
+    tasks or whatever arrived within ``flush_seconds``. The queue between the
+    upload and submit stages holds at most ``queue_size`` entries, so uploads
+    wait for submission rather than buffering without bound.
+
+    :param callable prepare_batch: Creates the pool and the job.
+    :param UploadManifest manifest: Input fingerprints (MD5) for the result
+     cache, and for incremental upload when ``incremental`` is set.
+    :param ResultCache result_cache: Inputs with cached outputs are neither
+     uploaded nor submitted. Its output listing is loaded once before the
+     stages start.
+    :param profiles: Transcode profiles; None for the default mp3 output.
+    :param bool incremental: Skip uploading inputs whose blob already matches
+     the manifest fingerprint.
+    :param bool timing_markers: Record command start/end times in each
+     task's ``timing.txt`` (see `_with_timing_markers`).
+    :return: Per-stage timings (seconds from the start of the pipeline) and
+     counts.
+    :rtype: dict
+    """
+    file_paths = list(file_paths)
+    emit = _with_timing_markers if timing_markers else (lambda task: task)
+    t0 = time.monotonic()
+    report = {'inputs': len(file_paths), 'uploaded': 0, 'cached': 0, 'tasks_added': 0}
+    ready = queue.Queue(maxsize=max(1, queue_size))
+    job_ready = threading.Event()
+    abort = threading.Event()
+    errors = []
+    lock = threading.Lock()
+
+    def _mark(name):
+        with lock:
+            report[name] = round(time.monotonic() - t0, 2)
+
+    def _put(item):
+        while not abort.is_set():
+            try:
+                ready.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _setup_stage():
+        try:
+            prepare_batch()
+            _mark('batch_ready_at')
+            job_ready.set()
+        except BaseException as e:
+            errors.append(e)
+            abort.set()
+
+    def _upload_one(idx, path):
+        if abort.is_set():
+            return
+        if result_cache is not None and manifest is not None:
+            fp = manifest.fingerprint(path)
+            if result_cache.lookup(_output_names(os.path.basename(path), profiles), fp["md5"]):
+                with lock:
+                    report['cached'] += 1
+                return
+        resource_file = upload_file_to_container(storage, input_container_name, path,
+                                                 manifest=manifest if incremental else None,
+                                                 max_concurrency=upload_concurrency)
+        with lock:
+            report['uploaded'] += 1
+        _put((idx, resource_file))
+
+    def _upload_stage():
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, upload_workers)) as pool:
+                for fut in [pool.submit(_upload_one, idx, path) for idx, path in enumerate(file_paths)]:
+                    fut.result()
+            _mark('upload_done_at')
+        except BaseException as e:
+            errors.append(e)
+            abort.set()
+        finally:
+            _put(_PIPELINE_DONE)
+
+    def _submit_stage():
+        failures = []
+        try:
+            while not job_ready.wait(0.5):
+                if abort.is_set():
+                    return
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, submit_workers)) as pool:
+                in_flight = set()
+                finished = False
+                while not finished and not abort.is_set():
+                    chunk, deadline = [], None
+                    while len(chunk) < MAX_TASKS_PER_ADD_COLLECTION:
+                        timeout = 0.5 if deadline is None else max(0.0, deadline - time.monotonic())
+                        try:
+                            item = ready.get(timeout=timeout)
+                        except queue.Empty:
+                            if deadline is not None or abort.is_set():
+                                break
+                            continue
+                        if item is _PIPELINE_DONE:
+                            finished = True
+                            break
+                        idx, resource_file = item
+                        chunk.append(emit(_build_ffmpeg_task('Task{}'.format(idx), resource_file,
+                                                             output_container_sas_url, profiles)))
+                        if deadline is None:
+                            deadline = time.monotonic() + flush_seconds
+                    if not chunk:
+                        continue
+                    if 'first_task_submitted_at' not in report:
+                        _mark('first_task_submitted_at')
+                    in_flight.add(pool.submit(_submit_task_chunk, batch_service_client, job_id, chunk,
+                                              max_attempts, 1.0))
+                    if len(in_flight) >= submit_workers * 2:
+                        done, in_flight = concurrent.futures.wait(
+                            in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for fut in done:
+                            n, failed = fut.result()
+                            report['tasks_added'] += n
+                            failures.extend(failed)
+                for fut in concurrent.futures.as_completed(in_flight):
+                    n, failed = fut.result()
+                    report['tasks_added'] += n
+                    failures.extend(failed)
+            _mark('submit_done_at')
+            if failures:
+                raise RuntimeError(f"ERROR: {len(failures)} tasks were rejected by the Batch service "
+                                   f"(first: {failures[0].task_id}: {failures[0].error.code})")
+        except BaseException as e:
+            errors.append(e)
+            abort.set()
+
+    # 出力の一覧はアップロードスレッドから遅延読み込みせず、ステージ開始前に 1 回だけ読む
+    if result_cache is not None:
+        result_cache.load()
+    stages = [threading.Thread(target=fn, name=name, daemon=True) for name, fn in
+              (('setup', _setup_stage), ('upload', _upload_stage), ('submit', _submit_stage))]
+    for t in stages:
+        t.start()
+    for t in stages:
+        t.join()
+    if manifest is not None:
+        manifest.save()
+    if errors:
+        raise errors[0]
+    log.info("Pipeline: %s", report)
+    return report
+
+
+async def run_async(batch_service_client, storage: AsyncStorageV12, file_paths, input_container_name,
+                    job_id, output_container_sas_url, prepare_batch, max_concurrency=64,
+                    upload_concurrency=4, executor_workers=8, manifest: UploadManifest = None,
+                    result_cache: ResultCache = None, max_attempts=6, profiles=None, incremental=True,
+                    timing_markers=False):
+    """
+    asyncio-native counterpart of `run_pipeline`.
+
+    Storage I/O (uploads, properties, SAS keys) runs on the event loop with
+    at most ``max_concurrency`` files in flight over one shared connection
+    pool. Blocking Batch calls (``prepare_batch`` and add_collection chunks)
+    and local hashing run in a thread pool of ``executor_workers``. Files are
+    pulled from ``file_paths`` lazily by the worker coroutines, so memory
+    does not grow with the number of inputs. If ``prepare_batch``, a chunk
+    submission or an upload fails, the other coroutines are cancelled and
+    the error is raised.
+
+    ``manifest``, ``result_cache``, ``incremental`` and ``timing_markers``
+    behave as in `run_pipeline`.
+
+    :return: Timings (seconds from start) and counts.
+    :rtype: dict
+    """
+    loop = asyncio.get_running_loop()
+    emit = _with_timing_markers if timing_markers else (lambda task: task)
+    t0 = time.monotonic()
+    report = {'uploaded': 0, 'cached': 0, 'tasks_added': 0}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, executor_workers))
+    failures = []
+    try:
+        setup = loop.run_in_executor(executor, prepare_batch)
+        ready = asyncio.Queue(maxsize=max(1, max_concurrency) * 4)
+        paths = enumerate(file_paths)
+
+        async def _upload_worker():
+            for idx, path in paths:
+                blob_name = os.path.basename(path)
+                md5_hex = None
+                if manifest is not None:
+                    fp = await loop.run_in_executor(executor, manifest.fingerprint, path)
+                    md5_hex = fp["md5"]
+                    if result_cache is not None and result_cache.lookup(_output_names(blob_name, profiles), md5_hex):
+                        report['cached'] += 1
+                        continue
+                if incremental and md5_hex is not None and _blob_matches_fingerprint(
+                        await storage.get_blob_properties_or_none(input_container_name, blob_name), fp):
+                    log.info("Skip upload (unchanged): %s", blob_name)
+                else:
+                    await storage.upload_blob_from_path(input_container_name, blob_name, path,
+                                                        max_concurrency=upload_concurrency, md5_hex=md5_hex)
+                    report['uploaded'] += 1
+                sas_url = await storage.make_blob_user_delegation_sas_url(
+                    input_container_name, blob_name, permissions=BlobSasPermissions(read=True))
+                await ready.put(emit(_build_ffmpeg_task('Task{}'.format(idx), batchmodels.ResourceFile(
+                    file_path=blob_name, http_url=sas_url), output_container_sas_url, profiles)))
+
+        async def _uploads():
+            workers = [asyncio.ensure_future(_upload_worker()) for _ in range(max(1, max_concurrency))]
+            try:
+                await asyncio.gather(*workers)
+            except BaseException:
+                for w in workers:
+                    w.cancel()
+                raise
+            report['upload_done_at'] = round(time.monotonic() - t0, 2)
+            await ready.put(None)
+
+        async def _submitter():
+            await setup
+            report['batch_ready_at'] = round(time.monotonic() - t0, 2)
+            pending = set()
+            done_uploading = False
+            while not done_uploading:
+                chunk = []
+                while len(chunk) < MAX_TASKS_PER_ADD_COLLECTION:
+                    try:
+                        task = await asyncio.wait_for(ready.get(), timeout=1.0 if chunk else None)
+                    except asyncio.TimeoutError:
+                        break
+                    if task is None:
+                        done_uploading = True
+                        break
+                    chunk.append(task)
+                if chunk:
+                    report.setdefault('first_task_submitted_at', round(time.monotonic() - t0, 2))
+                    pending.add(loop.run_in_executor(executor, _submit_task_chunk, batch_service_client,
+                                                     job_id, chunk, max_attempts, 1.0))
+                if len(pending) >= executor_workers:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for fut in done:
+                        n, failed = fut.result()
+                        report['tasks_added'] += n
+                        failures.extend(failed)
+            for n, failed in await asyncio.gather(*pending):
+                report['tasks_added'] += n
+                failures.extend(failed)
+            report['submit_done_at'] = round(time.monotonic() - t0, 2)
+
+        # lookup() がイベントループ上で一覧を読み込まないよう、ワーカー開始前に読み込んでおく
+        if result_cache is not None:
+            await loop.run_in_executor(executor, result_cache.load)
+        # 投入側が失敗したらアップロード側も止める（キューが満杯のまま put で待ち続けないように）
+        uploads = asyncio.ensure_future(_uploads())
+        submitter = asyncio.ensure_future(_submitter())
+        try:
+            done, _ = await asyncio.wait({uploads, submitter}, return_when=asyncio.FIRST_EXCEPTION)
+            for fut in done:
+                fut.result()
+        except BaseException:
+            uploads.cancel()
+            submitter.cancel()
+            raise
+    finally:
+        executor.shutdown(wait=True)
+        if manifest is not None:
+            manifest.save()
+    if failures:
+        raise RuntimeError(f"ERROR: {len(failures)} tasks were rejected by the Batch service "
+                           f"(first: {failures[0].task_id}: {failures[0].error.code})")
+    log.info("Async run: %s, key cache: %s", report, storage.key_cache.stats())
+    return report
+
+
+class InputDirectoryWatcher:
+    """
+    Finds new input files under a directory by polling it with ``os.scandir``.
+
+    A file is reported once its size and modification time have not changed
+    for ``settle_seconds``, so files that are still being written or copied
+    in are not picked up half-finished. A reported file is reported again
+    only if it changes later. Each poll costs one ``scandir`` per directory
+    and one ``stat`` per matching file.
+    """
+    def __init__(self, root, suffixes=('.mp4',), settle_seconds=30):
+        self.root = root
+        self.suffixes = tuple(s.lower() for s in suffixes)
+        self.settle_seconds = settle_seconds
+        self._pending = {}   # path -> ((size, mtime_ns), 最初にこの状態を見た時刻)
+        self.reported = {}   # path -> (size, mtime_ns)
+
+    def _scan(self, path):
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        yield from self._scan(entry.path)
+                    elif entry.name.lower().endswith(self.suffixes) and entry.is_file():
+                        try:
+                            st = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        yield entry.path, (st.st_size, st.st_mtime_ns)
+        except (FileNotFoundError, PermissionError) as e:
+            log.debug("Cannot scan '%s': %s", path, e)
+
+    def poll(self):
+        """書き込みが落ち着いた新しい（または変更された）ファイルのパスを返す"""
+        now = time.monotonic()
+        ready = []
+        seen = set()
+        for path, sig in self._scan(self.root):
+            seen.add(path)
+            if self.reported.get(path) == sig:
+                continue
+            pending = self._pending.get(path)
+            if pending is None or pending[0] != sig:
+                self._pending[path] = (sig, now)
+            elif now - pending[1] >= self.settle_seconds:
+                del self._pending[path]
+                self.reported[path] = sig
+                ready.append(path)
+        # 削除されたファイルは忘れる（同じ名前で再作成されたら新しいファイルとして扱う）
+        for tracked in (self._pending, self.reported):
+            for path in [p for p in tracked if p not in seen]:
+                del tracked[path]
+        return sorted(ready)
+
+    def forget(self, paths):
+        """報告済みのファイルを未報告に戻す（落ち着き時間の後、次回以降の poll で再び報告される）"""
+        for path in paths:
+            self.reported.pop(path, None)
+
+
+def stable_task_id(blob_name, size, mtime_ns, prefix='File'):
+    """入力名と内容の指紋（サイズ/更新時刻）から、再起動しても同じになるタスク ID を返す
+
+    Batch のタスク ID は 64 文字以内の英数字/-/_ のため、名前は置換・短縮してハッシュを付ける。
+    """
+    digest = hashlib.sha1(f"{blob_name}\0{size}\0{mtime_ns}".encode()).hexdigest()[:16]
+    stem = re.sub(r'[^A-Za-z0-9_-]', '_', os.path.splitext(os.path.basename(blob_name))[0])[:40]
+    return f"{prefix}-{stem}-{digest}"
+
+
+def run_watch(batch_service_client, storage: StorageV12, watch_dir, input_container_name, job_id,
+              output_container_name, prepare_batch, poll_seconds=10, settle_seconds=30,
+              upload_workers=8, upload_concurrency=4, submit_workers=4, max_attempts=6,
+              sas_hours=24, status_seconds=300, timing_markers=False, profiles=None, stop_event=None):
+    """
+    Feeds files that arrive under ``watch_dir`` into one long-lived job.
+
+    ``prepare_batch`` should create (or reuse) the pool and the job without
+    deleting anything. The directory is polled every ``poll_seconds``; each
+    file that has settled (see `InputDirectoryWatcher`) is uploaded and
+    submitted as one task. Task IDs are derived from the file name, size
+    and modification time (`stable_task_id`), so after a restart the files
+    whose tasks are already in the job are skipped, and a resubmission that
+    fails with TaskExists counts as added. If uploading or submitting a
+    batch of files fails, the error is logged and those files are picked up
+    again after they settle once more. Failed tasks stay in the job and
+    are not retried.
+
+    :param callable prepare_batch: Creates or reuses the pool and the job.
+    :param int sas_hours: Lifetime of the input and output SAS URLs given to
+     each task; it must cover the time a task may wait in the queue.
+    :param int status_seconds: Interval of the task count log.
+    :param threading.Event stop_event: Stops the loop when set (Ctrl+C also
+     stops it).
+    :return: Counts of files seen, tasks added and polls.
+    :rtype: dict
+    """
+    prepare_batch()
+    stop_event = stop_event or threading.Event()
+    watcher = InputDirectoryWatcher(watch_dir, settle_seconds=settle_seconds)
+    emit = _with_timing_markers if timing_markers else (lambda task: task)
+    known = set(list_task_ids(batch_service_client, job_id, None))
+    report = {'files': 0, 'skipped': 0, 'tasks_added': 0, 'polls': 0, 'errors': 0}
+    log.info("Watching '%s' for new files (job '%s' has %d tasks)", watch_dir, job_id, len(known))
+    next_status = time.monotonic() + status_seconds
+    try:
+        while not stop_event.is_set():
+            report['polls'] += 1
+            ready = []
+            for path in watcher.poll():
+                task_id = stable_task_id(os.path.basename(path), *watcher.reported[path])
+                if task_id in known:
+                    report['skipped'] += 1
+                else:
+                    ready.append((task_id, path))
+            if ready:
+                started = time.monotonic()
+                try:
+                    storage.upload_blobs_from_paths(
+                        input_container_name, [(os.path.basename(p), p) for _, p in ready],
+                        max_workers=upload_workers, max_concurrency=upload_concurrency)
+                    # 長時間動き続けるため、SAS は投入のたびに発行する（キーはキャッシュされる）
+                    output_url = storage.make_container_user_delegation_sas_url(
+                        output_container_name,
+                        BlobSasPermissions(read=True, write=True, add=True, create=True, list=True),
+                        expiry_hours=sas_hours)
+                    tasks = []
+                    for task_id, path in ready:
+                        blob_name = os.path.basename(path)
+                        resource_file = batchmodels.ResourceFile(
+                            file_path=blob_name, http_url=storage.make_blob_user_delegation_sas_url(
+                                input_container_name, blob_name, BlobSasPermissions(read=True),
+                                expiry_hours=sas_hours))
+                        task = _build_ffmpeg_task(task_id, resource_file, output_url, profiles)
+                        tasks.append(emit(task))
+                    report['tasks_added'] += submit_tasks(batch_service_client, job_id, tasks,
+                                                          max_workers=submit_workers, max_attempts=max_attempts)
+                    report['files'] += len(ready)
+                    known.update(task_id for task_id, _ in ready)
+                    log.info("Watch: %d new files uploaded and submitted in %.1fs",
+                             len(ready), time.monotonic() - started)
+                except (AzureError, batchmodels.BatchErrorException, ClientRequestError, RuntimeError, OSError) as e:
+                    # 一時的な失敗で常駐を止めない。投入済みのタスクは再投入時に TaskExists として数えられる
+                    report['errors'] += 1
+                    log.error("Watch: failed to upload/submit %d files, will retry: %s", len(ready), e)
+                    watcher.forget(path for _, path in ready)
+            if time.monotonic() >= next_status:
+                next_status = time.monotonic() + status_seconds
+                try:
+                    log.info("Watch: job '%s' task counts %s",
+                             job_id, _counts_to_dict(_get_task_counts(batch_service_client, job_id)))
+                except (batchmodels.BatchErrorException, ClientRequestError) as e:
+                    log.debug("Could not read task counts: %s", e)
+            stop_event.wait(poll_seconds)
+    except KeyboardInterrupt:
+        log.info("Watch mode interrupted.")
+    log.info("Watch mode stopped: %s", report)
+    return report
+
+
+def _autoscale_logger(batch_client, pool_id, min_interval=60):
+    """監視ループから呼ばれ、最短 min_interval 秒ごとに自動スケールの判断をログ出力するコールバックを返す"""
+    state = {'timestamp': None, 'next': 0.0}
+
+    def _on_poll(_counts):
+        if time.time() < state['next']:
+            return
+        state['next'] = time.time() + min_interval
+        try:
+            state['timestamp'] = log_autoscale_decisions(batch_client, pool_id, state['timestamp'])
+        except batchmodels.BatchErrorException as e:
+            log.debug("Could not read autoscale run: %s", e)
+    return _on_poll
+
+
+def _chain_callbacks(callbacks):
+    """複数の on_poll コールバックを順に呼ぶ 1 つのコールバックにまとめる（空なら None）"""
+    if not callbacks:
+        return None
+
+    def _on_poll(counts):
+        for callback in callbacks:
+            callback(counts)
+    return _on_poll
+
+
 # ==========================
 # Utility: delete-if-exists
 # ==========================
@@ -486,36 +3686,100 @@ def _delete_pool_if_exists(batch_client: BatchServiceClient, pool_id: str, wait_
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description='Transcode mp4 files to mp3 with Azure Batch and ffmpeg.')
+    parser.add_argument('--resume', action='store_true',
+                        help='中断した実行を再開する（ジョブを削除せず、未アップロード/未投入の分だけ処理する）')
+    args = parser.parse_args()
+
     start_time = datetime.datetime.now().replace(microsecond=0)
+    run_started_utc = datetime.datetime.now(datetime.UTC)
     log.info('Start time: %s', start_time)
 
+    # 入力ソース: 'local'（InputFiles をアップロード、既定）/ 'blob'（Storage 上の Blob を再アップロードせずに使う）
+    input_source = getattr(config, '_INPUT_SOURCE', 'local')
+    # 監視モード: InputFiles に届いたファイルを、削除せずに使い続けるジョブへ逐次投入する
+    watch_mode = getattr(config, '_WATCH_MODE', False)
+
+    # Create a list of all MP4 files in the InputFiles directory.
+    input_file_paths = []
+
+    if input_source == 'local' and not watch_mode:
+        for folder, subs, files in os.walk(os.path.join(sys.path[0], 'InputFiles')):
+            for filename in files:
+                if filename.endswith(".mp4"):
+                    input_file_paths.append(os.path.abspath(
+                        os.path.join(folder, filename)))
+
+        log.info("Input file count: %d", len(input_file_paths))
+
+    # 変換プロファイル: 1 回のデコードで書き出す出力の一覧（既定は mp3 のみ）
+    transcode_profiles = validate_transcode_profiles(getattr(config, '_TRANSCODE_PROFILES', None))
+
+    # 実行バックエンド: 'auto' では小さなバッチをローカルのプロセスプールで変換する（プール/ジョブ/アップロード不要）
+    backend_name = 'batch' if input_source == 'blob' or watch_mode else choose_execution_backend(
+        input_file_paths, getattr(config, '_EXECUTION_BACKEND', 'batch'),
+        max_files=getattr(config, '_LOCAL_MAX_FILES', 24),
+        max_total_mb=getattr(config, '_LOCAL_MAX_TOTAL_MB', 2048))
+    if backend_name == 'local':
+        local_output_dir = os.path.join(sys.path[0], getattr(config, '_LOCAL_OUTPUT_DIR', 'LocalOutput'))
+        os.makedirs(local_output_dir, exist_ok=True)
+        local_backend = LocalProcessBackend(config._JOB_ID, max_workers=getattr(config, '_LOCAL_MAX_WORKERS', None))
+        local_segment_mode = getattr(config, '_SEGMENT_MODE', False)
+        local_backend.create_pool()
+        local_backend.create_job(uses_task_dependencies=local_segment_mode)
+        local_backend.add_tasks(
+            list(local_resource_files(input_file_paths)), pathlib.Path(local_output_dir).as_uri(),
+            media_info=collect_media_info(input_file_paths, probe_duration=local_segment_mode),
+            segment_seconds=getattr(config, '_SEGMENT_SECONDS', 600) if local_segment_mode else None,
+            segment_min_duration=getattr(config, '_SEGMENT_MIN_DURATION_SECONDS', 1800),
+            max_segments=getattr(config, '_SEGMENT_MAX_COUNT', 32),
+            pack_max_bytes=int(getattr(config, '_PACK_SMALL_INPUT_MB', 0) * 1024 * 1024),
+            pack_max_files=getattr(config, '_PACK_MAX_FILES', 16),
+            profiles=transcode_profiles)
+        local_summary = local_backend.wait_for_tasks_to_complete(datetime.timedelta(minutes=30))
+        local_backend.close()
+        log.info("Outputs written to %s", local_output_dir)
+        end_time = datetime.datetime.now().replace(microsecond=0)
+        log.info('End time: %s', end_time)
+        log.info('Elapsed: %s', end_time - start_time)
+        sys.exit(1 if local_summary['failed'] else 0)
+
     # Storage (AAD, v12)
     aad_cred = DefaultAzureCredential(exclude_interactive_browser_credential=False)
-    storage = StorageV12(config._STORAGE_ACCOUNT_NAME, aad_cred)
+    upload_workers = getattr(config, '_UPLOAD_MAX_WORKERS', 8)
+    upload_concurrency = getattr(config, '_UPLOAD_MAX_CONCURRENCY', 4)
+    storage = StorageV12(
+        config._STORAGE_ACCOUNT_NAME, aad_cred,
+        max_block_size=int(getattr(config, '_UPLOAD_BLOCK_SIZE_MB', 8) * 1024 * 1024),
+        max_single_put_size=int(getattr(config, '_UPLOAD_SINGLE_PUT_MB', 32) * 1024 * 1024),
+        connection_pool_size=upload_workers * upload_concurrency,
+        key_lifetime_hours=getattr(config, '_USER_DELEGATION_KEY_HOURS', 6))
 
     input_container_name = 'input'
     output_container_name = 'output'
     # Optional: clean storage at start
-    if getattr(config, '_CLEAN_STORAGE_AT_START', False):
+    if getattr(config, '_CLEAN_STORAGE_AT_START', False) and not args.resume:
         storage.delete_container_if_exists(input_container_name)
         storage.delete_container_if_exists(output_container_name)
     storage.ensure_container(input_container_name)
     storage.ensure_container(output_container_name)
 
-    # Create a list of all MP4 files in the InputFiles directory.
-    input_file_paths = []
-
-    for folder, subs, files in os.walk(os.path.join(sys.path[0], 'InputFiles')):
-        for filename in files:
-            if filename.endswith(".mp4"):
-                input_file_paths.append(os.path.abspath(
-                    os.path.join(folder, filename)))
-
-    # Upload the input files. This is the collection of files that are to be processed by the tasks.
-    input_files = [
-        upload_file_to_container(storage, input_container_name, file_path)
-        for file_path in input_file_paths]
-    log.info("Input file count: %d", len(input_file_paths))
+    # 差分モードでは manifest を使い、コンテナーに同一内容の Blob があるファイルはアップロードしない
+    incremental = getattr(config, '_INCREMENTAL_UPLOAD', False)
+    # 分割モード: 長い入力は時間範囲ごとのタスクに分けて複数ノードで変換し、最後に結合する
+    segment_mode = getattr(config, '_SEGMENT_MODE', False)
+    # パイプラインモード: アップロード・プール/ジョブ作成・タスク投入を同時に進める
+    pipeline_mode = getattr(config, '_PIPELINE_MODE', False)
+    # スケジューリング: 'longest_first' では長い（大きい）入力から投入する（通常モードのみ）
+    longest_first = getattr(config, '_SCHEDULING', 'fifo') == 'longest_first'
+    # 結果キャッシュ: 入力の MD5 + 変換シグネチャが一致する出力が既にある入力はタスクを作らない
+    result_cache = None
+    if getattr(config, '_RESULT_CACHE', False):
+        result_cache = ResultCache(storage, output_container_name, signature=transcode_signature(transcode_profiles))
+    upload_manifest = None
+    if incremental or result_cache is not None:
+        upload_manifest = UploadManifest(os.path.join(
+            sys.path[0], getattr(config, '_UPLOAD_MANIFEST_PATH', '.upload_manifest.json')))
 
     # Obtain a shared access signature URL that provides write access to the output
     # container to which the tasks will upload their output.
@@ -526,53 +3790,285 @@ if __name__ == '__main__':
     )
 
     # Create a Batch service client (AAD or SharedKey)
-    batch_url = _normalize_batch_url(getattr(config, '_BATCH_ACCOUNT_URL', ''))
-    auth_mode = getattr(config, '_AUTH_MODE', 'SharedKey').upper()
-    log.info("Batch URL: %s", batch_url)
-    log.info("Auth mode: %s", auth_mode)
-    if auth_mode == 'AAD':
-        # AAD 認証: 毎リクエスト前にトークンを更新する msrest 互換クレデンシャルを使用
-        token_creds = AADTokenCredentials(aad_cred, "https://batch.core.windows.net/.default")
-        batch_client = BatchServiceClient(token_creds, batch_url=batch_url)
-    else:
-        # SharedKey 認証
-        creds = batch_auth.SharedKeyCredentials(
-            config._BATCH_ACCOUNT_NAME,
-            config._BATCH_ACCOUNT_KEY
-        )
-        batch_client = BatchServiceClient(creds, batch_url=batch_url)
-
-    try:
+    batch_client = create_batch_client(aad_cred)
+    batch_backend = AzureBatchBackend(batch_client, storage, config._POOL_ID, config._JOB_ID,
+                                      max_workers=getattr(config, '_TASK_SUBMIT_WORKERS', 8),
+                                      max_attempts=getattr(config, '_TASK_SUBMIT_MAX_ATTEMPTS', 6))
+    # シャーディング: 入力を複数の Batch アカウント/プールのジョブに分けて並列に処理する（既定モードのみ）
+    shard_targets = getattr(config, '_SHARD_TARGETS', None)
+    batch_targets = [(batch_client, config._POOL_ID, config._JOB_ID)]
+    if shard_targets:
+        if args.resume or input_source == 'blob' or watch_mode or pipeline_mode or getattr(config, '_ASYNC_MODE', False):
+            parser.error("_SHARD_TARGETS is only supported for local inputs in the default mode (without --resume)")
+        batch_backend = ShardedBatchBackend.from_targets(
+            shard_targets, aad_cred, storage, config._JOB_ID, split=getattr(config, '_SHARD_SPLIT', 'weight'),
+            max_workers=getattr(config, '_TASK_SUBMIT_WORKERS', 8),
+            max_attempts=getattr(config, '_TASK_SUBMIT_MAX_ATTEMPTS', 6))
+        batch_targets = [(b.client, b.pool_id, b.job_id) for _, b, _ in batch_backend.shards]
+        log.warning("Sharded run over %d targets: task metrics, straggler duplicates, run state and "
+                    "download follow mode are not applied.", len(batch_targets))
+
+    # 実行状態: アップロード/投入/成功したタスクを SQLite に記録し、--resume で続きから再開できるようにする
+    # 再開できるのは既定モード（ローカル入力）だけなので、他のモードでは記録もしない
+    run_state = None
+    default_local_mode = not (input_source == 'blob' or watch_mode or pipeline_mode
+                              or getattr(config, '_ASYNC_MODE', False))
+    if args.resume and not default_local_mode:
+        parser.error("--resume is only supported for local inputs in the default mode")
+    if getattr(config, '_RUN_STATE_PATH', '.run_state.sqlite') and default_local_mode and not shard_targets:
+        run_state = RunStateStore(os.path.join(sys.path[0], getattr(config, '_RUN_STATE_PATH', '.run_state.sqlite')))
+        run_state.begin(config._JOB_ID, resume=args.resume)
+    elif args.resume:
+        parser.error("--resume requires config._RUN_STATE_PATH")
+
+    def _prepare_batch():
         # Clean start: delete existing resources (pool deletion is optional)
-        _delete_job_if_exists(batch_client, config._JOB_ID)
-        if getattr(config, '_DELETE_EXISTING_POOL_AT_START', False):
-            _delete_pool_if_exists(batch_client, config._POOL_ID)
+        # 再開時は既存のジョブ（投入済み/完了済みのタスク）をそのまま使う
+        if not args.resume:
+            def _clean_target(target):
+                client, pool_id, job_id = target
+                _delete_job_if_exists(client, job_id)
+                if getattr(config, '_DELETE_EXISTING_POOL_AT_START', False):
+                    _delete_pool_if_exists(client, pool_id)
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(batch_targets)) as pool:
+                list(pool.map(_clean_target, batch_targets))
 
         # Create the pool that will contain the compute nodes that will execute the
         # tasks.
-        create_pool(batch_client, config._POOL_ID)
+        pool_settings.update(batch_backend.create_pool())
 
         # Create the job that will run the tasks.
-        create_job(batch_client, config._JOB_ID, config._POOL_ID)
+        batch_backend.create_job(uses_task_dependencies=segment_mode and not (pipeline_mode or async_mode))
+
+    # asyncio モード: aio Storage SDK でアップロードし、Batch 呼び出しはスレッドプールで並行実行する
+    async_mode = getattr(config, '_ASYNC_MODE', False)
+
+    async def _run_async_main():
+        from azure.identity.aio import DefaultAzureCredential as AioDefaultAzureCredential
+        async with AioDefaultAzureCredential(exclude_interactive_browser_credential=False) as aio_cred:
+            async with AsyncStorageV12(
+                    config._STORAGE_ACCOUNT_NAME, aio_cred,
+                    max_block_size=int(getattr(config, '_UPLOAD_BLOCK_SIZE_MB', 8) * 1024 * 1024),
+                    max_single_put_size=int(getattr(config, '_UPLOAD_SINGLE_PUT_MB', 32) * 1024 * 1024),
+                    connection_limit=getattr(config, '_ASYNC_CONNECTION_LIMIT', 64),
+                    key_lifetime_hours=getattr(config, '_USER_DELEGATION_KEY_HOURS', 6)) as astorage:
+                return await run_async(
+                    batch_client, astorage, input_file_paths, input_container_name,
+                    config._JOB_ID, output_container_sas_url, _prepare_batch,
+                    max_concurrency=getattr(config, '_ASYNC_MAX_CONCURRENCY', 64),
+                    upload_concurrency=upload_concurrency,
+                    executor_workers=getattr(config, '_TASK_SUBMIT_WORKERS', 8),
+                    manifest=upload_manifest, result_cache=result_cache,
+                    max_attempts=getattr(config, '_TASK_SUBMIT_MAX_ATTEMPTS', 6),
+                    profiles=transcode_profiles, incremental=incremental, timing_markers=timing_markers)
+
+    # タスクメトリクス: 完了タスクの実行情報から待ち/実行時間を集計（マーカー有効時は内訳も）
+    timing_markers = getattr(config, '_TASK_TIMING_MARKERS', False)
+    task_metrics = None
+    if getattr(config, '_TASK_METRICS', False) and not shard_targets:
+        task_metrics = TaskMetricsCollector(batch_client, config._JOB_ID, read_markers=timing_markers)
+
+    if watch_mode:
+        def _prepare_watch():
+            # 既存のジョブ/プールは削除せずに再利用する（ノードを起動したまま待機させる）
+            batch_backend.create_pool()
+            batch_backend.create_job()
+
+        watch_stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: watch_stop.set())
+        try:
+            run_watch(batch_client, storage, os.path.join(sys.path[0], 'InputFiles'), input_container_name,
+                      config._JOB_ID, output_container_name, _prepare_watch,
+                      poll_seconds=getattr(config, '_WATCH_POLL_SECONDS', 10),
+                      settle_seconds=getattr(config, '_WATCH_SETTLE_SECONDS', 30),
+                      upload_workers=upload_workers, upload_concurrency=upload_concurrency,
+                      submit_workers=getattr(config, '_TASK_SUBMIT_WORKERS', 8),
+                      max_attempts=getattr(config, '_TASK_SUBMIT_MAX_ATTEMPTS', 6),
+                      sas_hours=getattr(config, '_WATCH_SAS_HOURS', 24),
+                      timing_markers=timing_markers, profiles=transcode_profiles, stop_event=watch_stop)
+        except batchmodels.BatchErrorException as err:
+            log_batch_exception(err)
+            raise
+        sys.exit(0)
 
-        # Add the tasks to the job. Pass the input files and a SAS URL
-        # to the storage container for output files.
-        add_tasks(batch_client, config._JOB_ID,
-                  input_files, output_container_sas_url)
+    pool_settings = {}
+    try:
+        if input_source == 'blob':
+            # Storage 上の入力をページ単位で一覧しながらタスクを投入する（一覧全体をメモリに持たない）
+            source_container = config._INPUT_SOURCE_CONTAINER
+            source_prefix = getattr(config, '_INPUT_SOURCE_PREFIX', None)
+            source_sas_hours = getattr(config, '_INPUT_SOURCE_SAS_HOURS', 24)
+            if segment_mode or getattr(config, '_PACK_SMALL_INPUT_MB', 0) or result_cache is not None:
+                log.warning("Segmented mode, packing and the result cache are not applied to blob inputs.")
+            _prepare_batch()
+            if getattr(config, '_INPUT_SOURCE_STAGE', False):
+                input_files = stage_blob_input_files(storage, source_container, input_container_name,
+                                                     prefix=source_prefix, sas_hours=source_sas_hours)
+            else:
+                input_files = iter_blob_input_files(storage, source_container, prefix=source_prefix,
+                                                    sas_hours=source_sas_hours)
+            batch_backend.add_tasks(input_files, output_container_sas_url,
+                                    timing_markers=timing_markers, profiles=transcode_profiles)
+        elif async_mode:
+            if segment_mode or getattr(config, '_PACK_SMALL_INPUT_MB', 0):
+                log.warning("Segmented mode and packing are not applied in async mode (one task per input).")
+            asyncio.run(_run_async_main())
+        elif pipeline_mode:
+            if segment_mode or getattr(config, '_PACK_SMALL_INPUT_MB', 0):
+                log.warning("Segmented mode and packing are not applied in pipeline mode (one task per input).")
+            run_pipeline(batch_client, storage, input_file_paths, input_container_name,
+                         config._JOB_ID, output_container_sas_url, _prepare_batch,
+                         upload_workers=upload_workers, upload_concurrency=upload_concurrency,
+                         queue_size=getattr(config, '_PIPELINE_QUEUE_SIZE', 1000),
+                         manifest=upload_manifest if incremental or result_cache is not None else None,
+                         result_cache=result_cache,
+                         submit_workers=getattr(config, '_TASK_SUBMIT_WORKERS', 8),
+                         max_attempts=getattr(config, '_TASK_SUBMIT_MAX_ATTEMPTS', 6),
+                         profiles=transcode_profiles, incremental=incremental, timing_markers=timing_markers)
+        else:
+            media_info = collect_media_info(input_file_paths, probe_duration=segment_mode or longest_first,
+                                            manifest=upload_manifest if result_cache is not None else None)
+            # 結果キャッシュに出力がある入力はアップロードもしない（以降のタスク作成でも照合しない）
+            if result_cache is not None:
+                input_file_paths = drop_cached_inputs(input_file_paths, media_info, result_cache, transcode_profiles)
+
+            # Upload the input files. This is the collection of files that are to be processed by the tasks.
+            input_files = upload_files_to_container(
+                storage, input_container_name, input_file_paths,
+                max_workers=upload_workers, max_concurrency=upload_concurrency,
+                manifest=upload_manifest if incremental else None,
+                run_state=run_state)
+
+            _prepare_batch()
+
+            # 推定所要時間（プールの最大ノード数 x スロット数）を表示し、長い入力から先に投入する
+            if getattr(config, '_AUTOSCALE', False):
+                pool_nodes = (getattr(config, '_AUTOSCALE_MAX_DEDICATED', 0)
+                              + getattr(config, '_AUTOSCALE_MAX_LOW_PRIORITY', DEFAULT_AUTOSCALE_MAX_LOW_PRIORITY))
+            else:
+                pool_nodes = config._DEDICATED_POOL_NODE_COUNT + config._LOW_PRIORITY_POOL_NODE_COUNT
+            estimate = estimate_makespan(
+                input_files, media_info, pool_nodes * pool_settings.get('task_slots', 1) * len(batch_targets),
+                seconds_per_media_second=getattr(config, '_ESTIMATE_SECONDS_PER_MEDIA_SECOND', 0.05),
+                seconds_per_mb=getattr(config, '_ESTIMATE_SECONDS_PER_MB', 0.5),
+                segment_seconds=getattr(config, '_SEGMENT_SECONDS', 600) if segment_mode else None,
+                segment_min_duration=getattr(config, '_SEGMENT_MIN_DURATION_SECONDS', 1800),
+                max_segments=getattr(config, '_SEGMENT_MAX_COUNT', 32))
+            log.info("Estimated makespan on %d slots: %.0fs in input order, %.0fs longest first (lower bound %.0fs)",
+                     estimate['slots'], estimate['input_order'], estimate['longest_first'], estimate['lower_bound'])
+            if longest_first:
+                input_files = order_longest_first(input_files, media_info)
+
+            # Add the tasks to the job. Pass the input files and a SAS URL
+            # to the storage container for output files.
+            batch_backend.add_tasks(
+                input_files, output_container_sas_url,
+                media_info=media_info,
+                segment_seconds=getattr(config, '_SEGMENT_SECONDS', 600) if segment_mode else None,
+                segment_min_duration=getattr(config, '_SEGMENT_MIN_DURATION_SECONDS', 1800),
+                max_segments=getattr(config, '_SEGMENT_MAX_COUNT', 32),
+                pack_max_bytes=int(getattr(config, '_PACK_SMALL_INPUT_MB', 0) * 1024 * 1024),
+                pack_max_files=getattr(config, '_PACK_MAX_FILES', 16),
+                timing_markers=timing_markers,
+                profiles=transcode_profiles,
+                preserve_order=longest_first,
+                run_state=run_state)
+        autoscale_formula = pool_settings.get('autoscale_formula')
+
+        # 監視中に呼ぶコールバック（自動スケールの判断ログ、タスクメトリクスの逐次収集）
+        poll_callbacks = []
+        if autoscale_formula:
+            poll_callbacks.extend(_autoscale_logger(client, pool_id) for client, pool_id, _ in batch_targets)
+        if task_metrics is not None and getattr(config, '_TASK_METRICS_LIVE_SECONDS', 0):
+            poll_callbacks.append(task_metrics.on_poll(config._TASK_METRICS_LIVE_SECONDS))
+        if run_state is not None:
+            poll_callbacks.append(run_state.on_poll(batch_client, config._JOB_ID,
+                                                    getattr(config, '_RUN_STATE_RECORD_SECONDS', 60)))
+        # 出力のダウンロード: 追従モードでは成功したタスクの出力をジョブの実行中に取得する
+        download_dir = getattr(config, '_DOWNLOAD_OUTPUT_DIR', None)
+        if download_dir:
+            download_dir = os.path.join(sys.path[0], download_dir)
+        output_follower = None
+        if download_dir and getattr(config, '_DOWNLOAD_FOLLOW', False) and not shard_targets:
+            output_follower = OutputFollower(batch_client, config._JOB_ID, storage, output_container_name, download_dir,
+                                             max_workers=getattr(config, '_DOWNLOAD_MAX_WORKERS', 8),
+                                             max_concurrency=getattr(config, '_DOWNLOAD_MAX_CONCURRENCY', 4))
+            poll_callbacks.append(output_follower.on_poll(getattr(config, '_DOWNLOAD_FOLLOW_SECONDS', 30)))
+
+        # 遅いタスク（低優先度ノードのプリエンプションや遅いノード）の重複実行
+        straggler_policy = None
+        if getattr(config, '_STRAGGLER_POLICY', False) and not shard_targets:
+            straggler_policy = StragglerPolicy(
+                batch_client, config._JOB_ID,
+                multiplier=getattr(config, '_STRAGGLER_MULTIPLIER', 2.0),
+                min_completed=getattr(config, '_STRAGGLER_MIN_COMPLETED', 5),
+                min_seconds=getattr(config, '_STRAGGLER_MIN_SECONDS', 120),
+                max_duplicates=getattr(config, '_STRAGGLER_MAX_DUPLICATES', 10),
+                check_interval=getattr(config, '_STRAGGLER_CHECK_SECONDS', 30))
 
         # Pause execution until tasks reach Completed state.
-        wait_for_tasks_to_complete(batch_client,
-                                   config._JOB_ID,
-                                   datetime.timedelta(minutes=30))
+        batch_backend.wait_for_tasks_to_complete(datetime.timedelta(minutes=30),
+                                                 mode=getattr(config, '_MONITOR_MODE', 'counts'),
+                                                 max_poll_interval=getattr(config, '_MONITOR_MAX_POLL_SECONDS', 30),
+                                                 on_poll=_chain_callbacks(poll_callbacks),
+                                                 straggler_policy=straggler_policy)
 
         log.info("Success: all tasks reached 'Completed' within the timeout.")
 
+        # ノードの起動時間（プロビジョニング遅延）を報告
+        for client, pool_id, _ in batch_targets:
+            try:
+                report_node_startup_times(client, pool_id)
+            except batchmodels.BatchErrorException as e:
+                log.debug("Could not read node start-up times: %s", e)
+
+        # タスクごとの待ち/ダウンロード/実行/アップロード時間を集計して書き出す
+        if task_metrics is not None:
+            try:
+                task_metrics.collect()
+                task_metrics.write(
+                    json_path=os.path.join(sys.path[0], getattr(config, '_TASK_METRICS_JSON', 'task_metrics.json')),
+                    prometheus_path=os.path.join(sys.path[0], getattr(config, '_TASK_METRICS_PROM', 'task_metrics.prom')))
+            except batchmodels.BatchErrorException as e:
+                log.warning("Could not collect task metrics: %s", e)
+
+        # 今回作られた出力に結果キャッシュのキーを記録する
+        # （失敗したタスクの出力は記録しない）
+        if result_cache is not None:
+            succeeded_outputs = set()
+            for client, _, job_id in batch_targets:
+                succeeded_outputs |= succeeded_output_names(client, job_id)
+            result_cache.commit(since=run_started_utc, succeeded_outputs=succeeded_outputs)
+
+        if run_state is not None:
+            run_state.sync_succeeded(batch_client, config._JOB_ID)
+
+        # 結合済みのセグメント出力は不要なので削除する
+        if segment_mode and not (pipeline_mode or async_mode):
+            storage.delete_blobs_with_prefix(output_container_name, SEGMENTS_PREFIX)
+
+        # 出力コンテナーの内容をローカルへダウンロードする（サイズ/ETag が一致するファイルは取得しない）
+        if download_dir:
+            if output_follower is not None:
+                output_follower.finish()
+            download_outputs(storage, output_container_name, download_dir,
+                             max_workers=getattr(config, '_DOWNLOAD_MAX_WORKERS', 8),
+                             max_concurrency=getattr(config, '_DOWNLOAD_MAX_CONCURRENCY', 4))
+
     except batchmodels.BatchErrorException as err:
         log_batch_exception(err)
         raise
 
-    # Delete input container in storage
-    storage.delete_container_if_exists(input_container_name)
+    # Delete input container in storage（差分モードでは次回の比較のために残す）
+    if incremental:
+        log.info("Incremental upload enabled: keeping container '%s'", input_container_name)
+    else:
+        storage.delete_container_if_exists(input_container_name)
+
+    log.info("User delegation key cache: %s", storage.key_cache.stats())
+    if isinstance(batch_client.config.credentials, AADTokenCredentials):
+        log.info("Batch AAD token cache: %s", batch_client.config.credentials.stats())
 
     # Print out some timing info
     end_time = datetime.datetime.now().replace(microsecond=0)
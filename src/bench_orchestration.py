@@ -0,0 +1,394 @@
+"""
+オーケストレーション処理のオフラインベンチマーク（Azure リソース不要）
+
+BlobServiceClient / BatchServiceClient をプロセス内のフェイクに差し替え、
+upload_files_to_container → add_tasks → wait_for_tasks_to_complete → dump_batch_diagnostics を
+合成入力（既定 100 / 10,000 / 100,000 件）で実行し、ステージごとに
+壁時計時間・API 呼び出し回数・ピークメモリ（tracemalloc）を出力する。
+
+    python bench_orchestration.py
+    python bench_orchestration.py --sizes 100,10000 --latency-ms 2 --throttle 0.05 --json bench.json
+
+フェイクは --latency-ms の遅延を各 API 呼び出しに入れ、--throttle の確率で
+add_collection を 429 で拒否、または一部タスクを server_error で返す。
+"""
+from __future__ import print_function
+import argparse
+import collections
+import datetime
+import importlib
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+try:
+    import config  # noqa: F401
+except ImportError:
+    # config.py が無い環境でも動くよう、サンプル設定で代用する（フェイクは設定値を使わない）
+    sys.modules['config'] = importlib.import_module('config_sample')
+
+import batch_python_tutorial_ffmpeg as orch
+from azure.batch import models as batchmodels
+from azure.storage.blob import UserDelegationKey
+
+
+class ApiCounter:
+    """フェイクの API 呼び出し回数を数え、遅延とスロットリングを注入する"""
+    def __init__(self, latency_ms=0.0, throttle=0.0, seed=0):
+        self.latency = latency_ms / 1000.0
+        self.throttle = throttle
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+    def hit(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def throttled(self):
+        with self._lock:
+            return self._random.random() < self.throttle
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+
+# ---------------- Storage fakes ----------------
+
+class FakeBlobClient:
+    def __init__(self, service, container, name):
+        self._service, self._container, self._name = service, container, name
+
+    def upload_blob(self, data, length=None, overwrite=True, max_concurrency=1, **kwargs):
+        self._service.api.hit('blob.upload_blob')
+        size = len(data.read())
+        self._service.blobs[(self._container, self._name)] = {'size': size, 'metadata': kwargs.get('metadata') or {}}
+
+    def get_blob_properties(self):
+        self._service.api.hit('blob.get_blob_properties')
+        blob = self._service.blobs.get((self._container, self._name))
+        if blob is None:
+            raise orch.ResourceNotFoundError("The specified blob does not exist.")
+        return types.SimpleNamespace(name=self._name, size=blob['size'], metadata=blob['metadata'])
+
+
+class FakeContainerClient:
+    def __init__(self, service, container):
+        self._service, self._container = service, container
+
+    def exists(self):
+        self._service.api.hit('container.exists')
+        return self._container in self._service.containers
+
+
+class FakeBlobServiceClient:
+    """StorageV12 が使う BlobServiceClient の API だけを持つインメモリ実装"""
+    def __init__(self, api: ApiCounter):
+        self.api = api
+        self.containers = set()
+        self.blobs = {}
+
+    def get_container_client(self, container):
+        return FakeContainerClient(self, container)
+
+    def get_blob_client(self, container, blob):
+        return FakeBlobClient(self, container, blob)
+
+    def create_container(self, container):
+        self.api.hit('service.create_container')
+        self.containers.add(container)
+
+    def get_user_delegation_key(self, key_start_time, key_expiry_time):
+        self.api.hit('service.get_user_delegation_key')
+        key = UserDelegationKey()
+        key.signed_oid = key.signed_tid = '00000000-0000-0000-0000-000000000000'
+        key.signed_start = key_start_time.strftime('%Y-%m-%dT%H:%M:%SZ')
+        key.signed_expiry = key_expiry_time.strftime('%Y-%m-%dT%H:%M:%SZ')
+        key.signed_service = 'b'
+        key.signed_version = '2023-11-03'
+        key.value = 'YmVuY2htYXJrLWtleS1ub3QtYS1zZWNyZXQ='
+        return key
+
+
+def make_fake_storage(api: ApiCounter) -> orch.StorageV12:
+    storage = orch.StorageV12('benchaccount', credential=None)
+    storage.svc = FakeBlobServiceClient(api)
+    return storage
+
+
+# ---------------- Batch fakes ----------------
+
+def _throttled_error():
+    """429 応答の BatchErrorException（_is_transient_batch_error が参照する属性だけを持つ）"""
+    err = batchmodels.BatchErrorException.__new__(batchmodels.BatchErrorException)
+    Exception.__init__(err, "Server is busy (429)")
+    err.response = types.SimpleNamespace(status_code=429)
+    err.error = None
+    return err
+
+
+class FakeBatchJob:
+    """タスクの状態を保持する。ポーリングごとに残りタスクの 1/polls_to_complete ずつ完了させる"""
+    def __init__(self, fail_rate, polls_to_complete, seed):
+        self.tasks = collections.OrderedDict()
+        self.fail_rate = fail_rate
+        self.polls_left = max(1, polls_to_complete)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def add(self, task_id):
+        with self._lock:
+            if task_id in self.tasks:
+                return False
+            self.tasks[task_id] = {'state': batchmodels.TaskState.active, 'result': None}
+            return True
+
+    def advance(self):
+        with self._lock:
+            pending = [t for t in self.tasks.values() if t['state'] != batchmodels.TaskState.completed]
+            n = -(-len(pending) // self.polls_left)
+            self.polls_left = max(1, self.polls_left - 1)
+            for task in pending[:n]:
+                task['state'] = batchmodels.TaskState.completed
+                task['result'] = (batchmodels.TaskExecutionResult.failure
+                                  if self._random.random() < self.fail_rate
+                                  else batchmodels.TaskExecutionResult.success)
+            for task in pending[n:]:
+                task['state'] = batchmodels.TaskState.running
+
+    def matches(self, task, odata_filter):
+        if odata_filter is None:
+            return True
+        if odata_filter == "state ne 'completed'":
+            return task['state'] != batchmodels.TaskState.completed
+        if odata_filter == "executionInfo/result eq 'failure'":
+            return task['result'] == batchmodels.TaskExecutionResult.failure
+        if odata_filter == "executionInfo/result eq 'success'":
+            return task['result'] == batchmodels.TaskExecutionResult.success
+        raise ValueError(f"Unsupported filter in fake: {odata_filter}")
+
+
+class FakeTaskOperations:
+    def __init__(self, client):
+        self._client = client
+
+    def add_collection(self, job_id, value):
+        api = self._client.api
+        api.hit('task.add_collection')
+        if len(value) > orch.MAX_TASKS_PER_ADD_COLLECTION:
+            raise ValueError("add_collection accepts at most 100 tasks")
+        if api.throttled():
+            raise _throttled_error()
+        job = self._client.jobs[job_id]
+        results = []
+        for task in value:
+            if api.throttled():
+                results.append(batchmodels.TaskAddResult(status=batchmodels.TaskAddStatus.server_error,
+                                                         task_id=task.id))
+            elif job.add(task.id):
+                results.append(batchmodels.TaskAddResult(status=batchmodels.TaskAddStatus.success, task_id=task.id))
+            else:
+                results.append(batchmodels.TaskAddResult(
+                    status=batchmodels.TaskAddStatus.client_error, task_id=task.id,
+                    error=batchmodels.BatchError(code='TaskExists')))
+        return batchmodels.TaskAddCollectionResult(value=results)
+
+    def list(self, job_id, task_list_options=None):
+        self._client.api.hit('task.list')
+        job = self._client.jobs[job_id]
+        odata_filter = getattr(task_list_options, 'filter', None)
+        with job._lock:
+            items = list(job.tasks.items())
+        # 実サービスと同様に 1000 件ごとのページとして数える
+        for page_start in range(0, len(items), 1000):
+            if page_start:
+                self._client.api.hit('task.list.next_page')
+            for task_id, task in items[page_start:page_start + 1000]:
+                if job.matches(task, odata_filter):
+                    yield batchmodels.CloudTask(
+                        id=task_id, state=task['state'],
+                        execution_info=batchmodels.TaskExecutionInformation(
+                            retry_count=0, requeue_count=0, result=task['result'],
+                            exit_code=None if task['result'] is None else
+                            int(task['result'] == batchmodels.TaskExecutionResult.failure)),
+                        node_info=batchmodels.ComputeNodeInformation(node_id='tvmps_bench_0'))
+
+
+class FakeJobOperations:
+    def __init__(self, client):
+        self._client = client
+
+    def get_task_counts(self, job_id):
+        self._client.api.hit('job.get_task_counts')
+        job = self._client.jobs[job_id]
+        job.advance()
+        with job._lock:
+            states = [(t['state'], t['result']) for t in job.tasks.values()]
+        completed = sum(1 for s, _ in states if s == batchmodels.TaskState.completed)
+        failed = sum(1 for _, r in states if r == batchmodels.TaskExecutionResult.failure)
+        running = sum(1 for s, _ in states if s == batchmodels.TaskState.running)
+        counts = dict(active=len(states) - completed - running, running=running, completed=completed,
+                      succeeded=completed - failed, failed=failed)
+        return batchmodels.TaskCountsResult(task_counts=batchmodels.TaskCounts(**counts),
+                                            task_slot_counts=batchmodels.TaskSlotCounts(**counts))
+
+    def get(self, job_id):
+        self._client.api.hit('job.get')
+        return types.SimpleNamespace(id=job_id, pool_info=batchmodels.PoolInformation(pool_id='benchpool'))
+
+
+class FakeFileOperations:
+    LOG = b"frame=  100 fps=0.0 q=-0.0 size=     256kB time=00:00:04.00 bitrate= 524.3kbits/s\n" * 200
+
+    def __init__(self, client):
+        self._client = client
+
+    def get_properties_from_task(self, job_id, task_id, file_path, raw=False):
+        self._client.api.hit('file.get_properties_from_task')
+        return types.SimpleNamespace(headers={'Content-Length': str(len(self.LOG))})
+
+    def get_from_task(self, job_id, task_id, file_path, file_get_from_task_options=None):
+        self._client.api.hit('file.get_from_task')
+        start, end = file_get_from_task_options.ocp_range[len('bytes='):].split('-')
+        return iter([self.LOG[int(start):int(end) + 1]])
+
+
+class FakePoolOperations:
+    def __init__(self, client):
+        self._client = client
+
+    def get(self, pool_id):
+        self._client.api.hit('pool.get')
+        return types.SimpleNamespace(id=pool_id, state='active', allocation_state='steady',
+                                     target_dedicated_nodes=0, target_low_priority_nodes=4,
+                                     current_dedicated_nodes=0, current_low_priority_nodes=4)
+
+
+class FakeComputeNodeOperations:
+    def __init__(self, client):
+        self._client = client
+
+    def list(self, pool_id, compute_node_list_options=None):
+        self._client.api.hit('compute_node.list')
+        return iter([types.SimpleNamespace(id=f'tvmps_bench_{i}', state='idle', scheduling_state='enabled',
+                                           start_task_information=None) for i in range(4)])
+
+
+class FakeBatchServiceClient:
+    """オーケストレーションが使う BatchServiceClient の API だけを持つインメモリ実装"""
+    def __init__(self, api: ApiCounter, fail_rate=0.01, polls_to_complete=1, seed=0):
+        self.api = api
+        self.jobs = collections.defaultdict(lambda: FakeBatchJob(fail_rate, polls_to_complete, seed))
+        self.task = FakeTaskOperations(self)
+        self.job = FakeJobOperations(self)
+        self.file = FakeFileOperations(self)
+        self.pool = FakePoolOperations(self)
+        self.compute_node = FakeComputeNodeOperations(self)
+
+
+# ---------------- Runner ----------------
+
+def _make_inputs(directory, count, size_bytes):
+    payload = b'\0' * size_bytes
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f'bench_{i:06d}.mp4')
+        with open(path, 'wb') as f:
+            f.write(payload)
+        paths.append(path)
+    return paths
+
+
+def _measure(api, name, fn, trace_memory):
+    api.reset()
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        value = fn()
+    finally:
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+    return value, {'stage': name, 'seconds': round(elapsed, 3),
+                   'api_calls': sum(api.calls.values()), 'calls': dict(sorted(api.calls.items())),
+                   'peak_mb': None if peak is None else round(peak / (1024 * 1024), 2)}
+
+
+def run_benchmark(count, args):
+    """count 件の合成入力で 4 ステージを実行し、ステージごとの計測結果のリストを返す"""
+    api = ApiCounter(latency_ms=args.latency_ms, throttle=args.throttle, seed=args.seed)
+    storage = make_fake_storage(api)
+    storage.svc.containers.add('input')
+    batch_client = FakeBatchServiceClient(api, fail_rate=args.fail_rate,
+                                          polls_to_complete=args.polls_to_complete, seed=args.seed)
+    workdir = tempfile.mkdtemp(prefix='bench_orch_')
+    try:
+        paths = _make_inputs(workdir, count, args.input_bytes)
+        results = []
+        input_files, r = _measure(api, 'upload', lambda: orch.upload_files_to_container(
+            storage, 'input', paths, max_workers=args.workers, max_concurrency=1), not args.no_memory)
+        results.append(r)
+        output_sas = storage.make_container_user_delegation_sas_url(
+            'output', orch.BlobSasPermissions(write=True))
+        _, r = _measure(api, 'add_tasks', lambda: orch.add_tasks(
+            batch_client, 'benchjob', input_files, output_sas, max_workers=args.workers), not args.no_memory)
+        results.append(r)
+        _, r = _measure(api, 'wait', lambda: orch.wait_for_tasks_to_complete(
+            batch_client, 'benchjob', datetime.timedelta(minutes=30)), not args.no_memory)
+        results.append(r)
+        _, r = _measure(api, 'diagnostics', lambda: orch.dump_batch_diagnostics(
+            batch_client, 'benchjob', max_workers=args.workers), not args.no_memory)
+        results.append(r)
+        return [dict(inputs=count, **r) for r in results]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='100,10000,100000',
+                        help='カンマ区切りの入力件数（既定: 100,10000,100000）')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='API 呼び出しごとの遅延（ms）')
+    parser.add_argument('--throttle', type=float, default=0.0,
+                        help='add_collection を 429 で拒否/タスクを server_error にする確率')
+    parser.add_argument('--fail-rate', type=float, default=0.01, help='失敗させるタスクの割合')
+    parser.add_argument('--polls-to-complete', type=int, default=1,
+                        help='全タスクが完了するまでのポーリング回数（1 回あたり約 1 秒以上の待機を含む）')
+    parser.add_argument('--input-bytes', type=int, default=16, help='合成入力ファイルのサイズ')
+    parser.add_argument('--workers', type=int, default=8, help='アップロード/投入/ログ取得の並列数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help='tracemalloc を無効化（計測のオーバーヘッドを除く）')
+    parser.add_argument('--json', help='結果を JSON で書き出すパス')
+    args = parser.parse_args(argv)
+
+    # アップロードやタスクごとの INFO ログで計測が歪まないよう抑制する
+    orch.log.setLevel(logging.WARNING)
+
+    rows = []
+    for count in (int(s) for s in args.sizes.split(',') if s.strip()):
+        for row in run_benchmark(count, args):
+            rows.append(row)
+            print("{inputs:>8} {stage:<12} {seconds:>9.3f}s {api_calls:>9} calls  peak {peak}".format(
+                peak='-' if row['peak_mb'] is None else f"{row['peak_mb']:.2f} MB", **row))
+            print("         " + ", ".join(f"{k}={v}" for k, v in row['calls'].items()))
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, indent=2)
+    return rows
+
+
+if __name__ == '__main__':
+    main()
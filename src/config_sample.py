@@ -36,6 +36,8 @@ _AUTH_MODE = 'AAD'  # or 'SharedKey'
 _BATCH_ACCOUNT_NAME = '<your-batch-account-name>'
 _BATCH_ACCOUNT_KEY = ''  # when _AUTH_MODE == 'SharedKey', set the key
 _BATCH_ACCOUNT_URL = 'https://<your-batch-account>.<region>.batch.azure.com'
+# AAD: Batch 用トークンを有効期限のこの秒数前まで再利用する（毎リクエストの再取得を避ける）
+_AAD_TOKEN_REFRESH_MARGIN_SECONDS = 300
 
 # ---------------- User Subscription mode (VNet) settings ----------------
 # ユーザーサブスクリプションモードでプールを作成する場合、
@@ -55,4 +57,209 @@ _LOG_LEVEL = 'INFO'
 _DELETE_EXISTING_POOL_AT_START = True
 
 # 起動時に Storage の input/output コンテナーを削除してから作成するか（既定 False）
-_CLEAN_STORAGE_AT_START = False
\ No newline at end of file
+_CLEAN_STORAGE_AT_START = False
+
+# ---------------- Upload tuning (optional) ----------------
+# 入力ファイルを並列にアップロードするワーカー数（同時に処理するファイル数）
+_UPLOAD_MAX_WORKERS = 8
+# 1 ファイルあたりのブロック並列送信数（max_single_put_size を超える大きいファイルに効く）
+_UPLOAD_MAX_CONCURRENCY = 4
+# ブロックサイズ / 単一 PUT で送る上限サイズ（MB）
+_UPLOAD_BLOCK_SIZE_MB = 8
+_UPLOAD_SINGLE_PUT_MB = 32
+
+# ユーザー委任キーの有効期間（時間）。キーはキャッシュされ、期限が近づくまで全 SAS 発行で共有されます（最大 7 日）
+_USER_DELEGATION_KEY_HOURS = 6
+
+# 差分アップロード: size/mtime/MD5 のフィンガープリントを manifest に記録し、
+# input コンテナーに同一内容の Blob があればアップロードを省略します（既定 False）。
+# 有効時は次回比較のため、実行終了時の input コンテナー削除を行いません。
+_INCREMENTAL_UPLOAD = False
+_UPLOAD_MANIFEST_PATH = '.upload_manifest.json'
+
+# ---------------- Task submission (optional) ----------------
+# タスクは 100 件/ペイロード上限ごとのチャンクに分けて並列投入します。
+# 同時に投入するチャンク数と、失敗/スロットリング時の再試行回数
+_TASK_SUBMIT_WORKERS = 8
+_TASK_SUBMIT_MAX_ATTEMPTS = 6
+
+# ---------------- Monitoring (optional) ----------------
+# 'counts': job.get_task_counts をポーリングし、変化がなければ間隔を最大 _MONITOR_MAX_POLL_SECONDS まで伸ばす
+# 'list'  : 毎回全タスクを一覧する（従来の挙動）
+_MONITOR_MODE = 'counts'
+_MONITOR_MAX_POLL_SECONDS = 30
+
+# ---------------- Segmented mode (optional) ----------------
+# 長い入力を _SEGMENT_SECONDS ごとのタスクに分割して複数ノードで並列変換し、依存タスクで 1 つの mp3 に結合します。
+# 入力の長さはローカルの ffprobe で取得します（ffprobe が無い場合は分割しません）。
+_SEGMENT_MODE = False
+_SEGMENT_MIN_DURATION_SECONDS = 1800  # これより短い入力は分割しない
+_SEGMENT_SECONDS = 600
+_SEGMENT_MAX_COUNT = 32
+
+# ---------------- Node utilisation (optional) ----------------
+# 1 ノードで同時に実行するタスク数。'auto' で VM サイズの vCPU 数（上限は vCPU の 4 倍）
+# ※既存プールを再利用する場合は反映されません（_DELETE_EXISTING_POOL_AT_START で作り直す）
+_TASK_SLOTS_PER_NODE = 1
+# ノードへのタスク割り当て: 'spread'（既定）または 'pack'（1 ノードのスロットを埋めてから次へ）
+_NODE_FILL_TYPE = None
+# この値（MB）以下の小さい入力は最大 _PACK_MAX_FILES 件ずつ 1 タスクにまとめて変換します（0 で無効）
+_PACK_SMALL_INPUT_MB = 0
+_PACK_MAX_FILES = 16
+
+# ---------------- Autoscale (optional) ----------------
+# True にすると固定ノード数（_DEDICATED_POOL_NODE_COUNT / _LOW_PRIORITY_POOL_NODE_COUNT）の代わりに、
+# 待機中/実行中タスク数からノード数を決める自動スケール式を生成してプールに設定します。
+# 縮小時は実行中タスクの完了を待ってからノードを外します（taskcompletion）。
+_AUTOSCALE = False
+_AUTOSCALE_MIN_DEDICATED = 0
+_AUTOSCALE_MAX_DEDICATED = 0
+_AUTOSCALE_MIN_LOW_PRIORITY = 0
+_AUTOSCALE_MAX_LOW_PRIORITY = 20
+_AUTOSCALE_PREFER_LOW_PRIORITY = True  # Spot/低優先度ノードを先に使い、不足分を専用ノードで補う
+_AUTOSCALE_INTERVAL_MINUTES = 5  # 評価間隔（サービス下限 5 分）
+
+# ---------------- ffmpeg provisioning (optional) ----------------
+# 'apt'        : StartTask で毎回 apt-get install（既定、従来の挙動）
+# 'staged'     : _FFMPEG_ARCHIVE_PATH の静的ビルド（tar.xz、例: ffmpeg-*-amd64-static.tar.xz）を
+#                _FFMPEG_TOOLS_CONTAINER に一度だけアップロードし、ノード共有ディレクトリに SHA-256 検証付きでキャッシュ
+# 'app_package': Batch アカウントのアプリケーションパッケージ (id, version) を使用
+_FFMPEG_PROVISION = 'apt'
+_FFMPEG_ARCHIVE_PATH = ''
+_FFMPEG_TOOLS_CONTAINER = 'tools'
+_FFMPEG_SAS_HOURS = 144  # ノード追加時にも使うため長め（ユーザー委任 SAS の上限 7 日未満）
+_FFMPEG_APP_PACKAGE = None  # 例: ('ffmpeg', '6.1')
+
+# ---------------- Result cache (optional) ----------------
+# 入力の MD5 と変換シグネチャから作るキーを出力 Blob のメタデータに記録し、
+# 同じキーの出力が output コンテナーにある入力はタスクを作りません（既定 False）。
+# 入力の MD5 は _UPLOAD_MANIFEST_PATH の manifest にキャッシュされます。
+_RESULT_CACHE = False
+
+# ---------------- Pipeline mode (optional) ----------------
+# True にすると、プール/ジョブ作成をアップロードと同時に開始し、アップロードと SAS 発行が終わった入力から
+# 順にタスクを投入します（1 入力 1 タスク。分割モード/パッキングは適用されません）。
+# _PIPELINE_QUEUE_SIZE は投入待ちの入力数の上限（メモリ使用量を一定に保つ）
+_PIPELINE_MODE = False
+_PIPELINE_QUEUE_SIZE = 1000
+
+# ---------------- Async mode (optional) ----------------
+# True にすると azure.storage.blob.aio（要 aiohttp）でアップロードし、Batch 呼び出しはスレッドプールで並行実行します。
+# _ASYNC_MAX_CONCURRENCY: 同時に処理するファイル数、_ASYNC_CONNECTION_LIMIT: 共有する HTTP 接続数の上限
+_ASYNC_MODE = False
+_ASYNC_MAX_CONCURRENCY = 64
+_ASYNC_CONNECTION_LIMIT = 64
+
+# ---------------- Task metrics (optional) ----------------
+# True にすると、完了したタスクの実行情報から待ち時間（作成→開始）と実行時間を集計し、
+# パーセンタイルとノード別の内訳を JSON / Prometheus テキスト形式で書き出します。
+_TASK_METRICS = False
+_TASK_METRICS_JSON = 'task_metrics.json'
+_TASK_METRICS_PROM = 'task_metrics.prom'
+# 0 より大きい場合、監視中にもこの秒数ごとに完了タスクを取り込みます（0: 終了時のみ）
+_TASK_METRICS_LIVE_SECONDS = 0
+# True にすると、各タスクのコマンド開始/終了時刻を timing.txt に記録し、
+# ダウンロード/ffmpeg 実行/アップロード時間に分けて集計します（ローカル実行バックエンドでは無効）
+_TASK_TIMING_MARKERS = False
+
+# ---------------- Execution backend (optional) ----------------
+# 'batch': Azure Batch で実行（既定）
+# 'local': このマシンのプロセスプールで同じタスク（コマンドライン）を実行し、出力を _LOCAL_OUTPUT_DIR に書き出す（要 ffmpeg/bash）
+# 'auto' : 入力が _LOCAL_MAX_FILES 件以下かつ合計 _LOCAL_MAX_TOTAL_MB 以下で、ffmpeg がローカルにあれば 'local'
+_EXECUTION_BACKEND = 'batch'
+_LOCAL_MAX_FILES = 24
+_LOCAL_MAX_TOTAL_MB = 2048
+_LOCAL_OUTPUT_DIR = 'LocalOutput'
+_LOCAL_MAX_WORKERS = None  # None: CPU コア数
+
+# ---------------- Transcode profiles (optional) ----------------
+# 1 タスクが入力を 1 回だけデコードし、プロファイルごとの出力を 1 回の ffmpeg 実行で書き出します。
+# None は従来どおり <stem>.mp3 のみ。各プロファイル:
+#   'name'  : 名前, 'suffix': 出力ファイル名の末尾（<stem><suffix>）, 'args': その出力に付ける ffmpeg オプション
+#   'path'  : 出力コンテナー内のプレフィックス（任意）, 'upload_condition': 'tasksuccess'（既定）/'taskcompletion'
+# 例:
+# _TRANSCODE_PROFILES = [
+#     {'name': 'mp3_192k', 'suffix': '.mp3', 'args': '-map 0:a -c:a libmp3lame -b:a 192k'},
+#     {'name': 'mp3_96k', 'suffix': '_96k.mp3', 'args': '-map 0:a -c:a libmp3lame -b:a 96k', 'path': 'low/'},
+#     {'name': 'aac', 'suffix': '.m4a', 'args': '-map 0:a -c:a aac -b:a 160k'},
+#     {'name': 'thumbnail', 'suffix': '.jpg', 'args': '-map 0:v -ss 5 -frames:v 1', 'upload_condition': 'taskcompletion'},
+# ]
+# 分割モード（_SEGMENT_MODE）は既定プロファイルのときのみ適用されます。
+_TRANSCODE_PROFILES = None
+
+# ---------------- Input source (optional) ----------------
+# 'local': InputFiles 配下の mp4 をアップロード（既定）
+# 'blob' : _INPUT_SOURCE_CONTAINER（_INPUT_SOURCE_PREFIX 配下）の mp4 Blob をダウンロード/再アップロードせずに使う。
+#          一覧はページ単位で逐次処理するため、数百万件でもメモリ使用量は一定です。
+# _INPUT_SOURCE_STAGE = True の場合は、input コンテナーへサーバー側コピーしてから処理します。
+# _INPUT_SOURCE_SAS_HOURS: タスクが入力を読むための SAS の有効時間（ジョブの所要時間より長くする）
+_INPUT_SOURCE = 'local'
+_INPUT_SOURCE_CONTAINER = 'media'
+_INPUT_SOURCE_PREFIX = None
+_INPUT_SOURCE_STAGE = False
+_INPUT_SOURCE_SAS_HOURS = 24
+
+# ---------------- Scheduling (optional) ----------------
+# 'fifo': 入力の列挙順に投入（既定） / 'longest_first': 長さ（ffprobe、無ければサイズ）の長い順に投入
+# Batch にはタスク単位の優先度がないため、チャンクを 1 つずつ投入してキュー順を保ちます（通常モードのみ）。
+_SCHEDULING = 'fifo'
+# 推定所要時間（makespan）の計算に使う目安: メディア 1 秒あたり / 1 MB あたりの変換秒数
+_ESTIMATE_SECONDS_PER_MEDIA_SECOND = 0.05
+_ESTIMATE_SECONDS_PER_MB = 0.5
+
+# ---------------- Stragglers (optional) ----------------
+# True: 実行中のタスクが、成功したタスクの実行時間の中央値 × _STRAGGLER_MULTIPLIER（最低 _STRAGGLER_MIN_SECONDS 秒）を
+# 超えたら、同じ内容の重複タスク（<タスクID>-dup）を投入し、先に成功した方を採用してもう一方を終了します。
+# 判定は成功タスクが _STRAGGLER_MIN_COMPLETED 件以上になってから。重複タスクは最大 _STRAGGLER_MAX_DUPLICATES 件。
+# Batch にはノードの反アフィニティ指定がないため、重複タスクが別ノードで動くかどうかは空きスロット次第です。
+_STRAGGLER_POLICY = False
+_STRAGGLER_MULTIPLIER = 2.0
+_STRAGGLER_MIN_COMPLETED = 5
+_STRAGGLER_MIN_SECONDS = 120
+_STRAGGLER_MAX_DUPLICATES = 10
+_STRAGGLER_CHECK_SECONDS = 30
+
+# ---------------- Watch mode (optional) ----------------
+# True: 一度きりの実行ではなく常駐し、InputFiles 配下に届いた mp4 を _WATCH_POLL_SECONDS ごとに検出して
+# アップロード/タスク投入します。ジョブとプールは削除せずに使い続けます（Ctrl+C / SIGTERM で停止）。
+# サイズと更新時刻が _WATCH_SETTLE_SECONDS 秒変わらないファイルだけを書き込み完了として扱います。
+# タスク ID はファイル名/サイズ/更新時刻から決まるため、再起動しても投入済みのファイルは再投入されません。
+# ノードを待機させておく場合は固定ノード数、または自動スケールの最小ノード数を 1 以上にしてください。
+_WATCH_MODE = False
+_WATCH_POLL_SECONDS = 10
+_WATCH_SETTLE_SECONDS = 30
+# タスクに渡す入力/出力 SAS の有効時間（キューで待つ時間より長くする）
+_WATCH_SAS_HOURS = 24
+
+# ---------------- Run state / resume (optional) ----------------
+# アップロード済みの入力、投入したタスク、成功したタスクを記録する SQLite ファイル（None で無効、既定モード・ローカル入力のみ）。
+# オーケストレーターが途中で止まった場合は `python batch_python_tutorial_ffmpeg.py --resume` で再開すると、
+# ジョブを削除せず、未アップロードのファイルと未投入のタスクだけを処理します（既定モード・ローカル入力のみ）。
+_RUN_STATE_PATH = '.run_state.sqlite'
+# タスクの監視中、成功したタスクを記録する間隔（秒）。再開時はこれ以降に成功したタスクだけが再実行されます。
+_RUN_STATE_RECORD_SECONDS = 60
+
+# ---------------- Output download (optional) ----------------
+# 完了後に output コンテナーの内容をこのディレクトリ（スクリプトからの相対パス）へダウンロードする（None で無効、例: 'OutputFiles'）。
+# 一覧はページ単位、ダウンロードは _DOWNLOAD_MAX_WORKERS 並列（大きな Blob は範囲ごとに _DOWNLOAD_MAX_CONCURRENCY 並列）。
+# ローカルのサイズと記録済みの ETag（.download_manifest.json）が一致するファイルは再取得しないため、中断しても再実行で続きから取得できます。
+_DOWNLOAD_OUTPUT_DIR = None
+_DOWNLOAD_MAX_WORKERS = 8
+_DOWNLOAD_MAX_CONCURRENCY = 4
+# True: ジョブの実行中も _DOWNLOAD_FOLLOW_SECONDS ごとに、成功したタスクの出力を取得する
+_DOWNLOAD_FOLLOW = False
+_DOWNLOAD_FOLLOW_SECONDS = 30
+
+# ---------------- Sharding (optional) ----------------
+# 複数の Batch アカウント/プールに入力を分けて並列に処理する（既定モード・ローカル入力のみ、--resume 不可）。
+# 各要素は dict: 'name'（必須ではないが一意に）, 'batch_account_url', 'auth_mode', 'account_name', 'account_key',
+#   'pool_id'（既定 _POOL_ID）, 'job_id'（既定 '<_JOB_ID>-<name>'）, 'weight'（既定 1）
+# 省略したキーは上のアカウント設定を使います。プールの VM サイズ/ノード数は全シャード共通の設定です。
+# 例:
+# _SHARD_TARGETS = [
+#     {'name': 'east', 'batch_account_url': 'https://acct1.eastus.batch.azure.com', 'weight': 2},
+#     {'name': 'west', 'batch_account_url': 'https://acct2.westus2.batch.azure.com', 'weight': 1},
+# ]
+_SHARD_TARGETS = None
+# 'weight': weight の比で分割 / 'capacity': 作成後の各プールのタスクスロット数の比で分割
+_SHARD_SPLIT = 'weight'
@@ -0,0 +1,48 @@
+import importlib
+import os
+import shlex
+import shutil
+import stat
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+try:
+    import config  # noqa: F401
+except ImportError:
+    # config.py が無い環境でも動くよう、サンプル設定で代用する
+    sys.modules['config'] = importlib.import_module('config_sample')
+
+FAKE_FFMPEG = """#!/bin/bash
+# 最後の引数に出力を書く。入力名に bad を含むと途中まで書いて失敗する
+in=""; prev=""; for a in "$@"; do [ "$prev" = "-i" ] && in="$a"; prev="$a"; done
+case "$in" in *bad*) echo "partial" > "${@: -1}"; exit 3;; esac
+echo "converted $in" > "${@: -1}"
+"""
+
+
+@pytest.fixture
+def task_dir(tmp_path, monkeypatch):
+    """フェイクの ffmpeg を PATH に置き、タスクの作業ディレクトリを返す"""
+    if shutil.which('bash') is None:
+        pytest.skip('bash is not available')
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    ffmpeg = bin_dir / 'ffmpeg'
+    ffmpeg.write_text(FAKE_FFMPEG)
+    ffmpeg.chmod(ffmpeg.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', '{}{}{}'.format(bin_dir, os.pathsep, os.environ['PATH']))
+    work = tmp_path / 'wd'
+    work.mkdir()
+    return work
+
+
+@pytest.fixture
+def run_task():
+    def _run(task, cwd):
+        # Batch と同様にシェルを介さず、command_line を引数に分けて実行する（$rc などは展開されない）
+        return subprocess.run(shlex.split(task.command_line), cwd=cwd).returncode
+    return _run
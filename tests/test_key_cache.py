@@ -0,0 +1,58 @@
+import asyncio
+import datetime
+
+import batch_python_tutorial_ffmpeg as orch
+
+
+def _now():
+    return datetime.datetime.now(datetime.UTC)
+
+
+class FakeFetch:
+    def __init__(self):
+        self.windows = []
+
+    def __call__(self, start, expiry):
+        self.windows.append((start, expiry))
+        return f'key{len(self.windows)}'
+
+
+def test_repeated_short_sas_requests_reuse_one_key():
+    fetch = FakeFetch()
+    cache = orch.UserDelegationKeyCache(fetch)
+    keys = {cache.get(_now() + datetime.timedelta(hours=1)) for _ in range(5)}
+    assert keys == {'key1'} and len(fetch.windows) == 1
+    assert cache.stats()['hits'] == 4
+
+
+def test_repeated_sas_requests_longer_than_the_key_lifetime_reuse_one_key():
+    fetch = FakeFetch()
+    cache = orch.UserDelegationKeyCache(fetch, lifetime=datetime.timedelta(hours=6))
+    for _ in range(5):
+        assert cache.get(_now() + datetime.timedelta(hours=24)) == 'key1'
+    assert len(fetch.windows) == 1
+    assert cache.stats()['hits'] == 4 and cache.stats()['misses'] == 1
+
+
+def test_key_expiry_is_capped_at_the_service_maximum():
+    fetch = FakeFetch()
+    cache = orch.UserDelegationKeyCache(fetch, lifetime=datetime.timedelta(days=3))
+    before = _now()
+    cache.get(before + datetime.timedelta(days=6))
+    start, expiry = fetch.windows[0]
+    assert start < before
+    assert expiry <= _now() + orch.UserDelegationKeyCache.MAX_LIFETIME
+
+
+def test_async_cache_reuses_one_key_for_long_sas_requests():
+    fetch = FakeFetch()
+
+    async def _fetch(start, expiry):
+        return fetch(start, expiry)
+
+    async def _run():
+        cache = orch.AsyncUserDelegationKeyCache(_fetch, lifetime=datetime.timedelta(hours=6))
+        return await asyncio.gather(*[cache.get(_now() + datetime.timedelta(hours=24)) for _ in range(5)])
+
+    assert set(asyncio.run(_run())) == {'key1'}
+    assert len(fetch.windows) == 1
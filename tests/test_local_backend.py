@@ -0,0 +1,51 @@
+import datetime
+import shutil
+
+import pytest
+from azure.batch import models as batchmodels
+
+import batch_python_tutorial_ffmpeg as orch
+
+pytestmark = pytest.mark.skipif(shutil.which('bash') is None, reason='bash is not available')
+
+SATISFY_ON_FAILURE = batchmodels.ExitConditions(
+    default=batchmodels.ExitOptions(dependency_action=batchmodels.DependencyAction.satisfy))
+
+
+def _task(task_id, script, depends_on=None, exit_conditions=None, resource_files=None):
+    return batchmodels.TaskAddParameter(
+        id=task_id, command_line="bash -c '{}'".format(script),
+        depends_on=batchmodels.TaskDependencies(task_ids=depends_on) if depends_on else None,
+        exit_conditions=exit_conditions, resource_files=resource_files)
+
+
+def _run(tmp_path, monkeypatch, tasks):
+    monkeypatch.setattr(orch, 'build_tasks', lambda *args, **kwargs: iter(tasks))
+    backend = orch.LocalProcessBackend('job', work_root=str(tmp_path), max_workers=2)
+    backend.create_job(uses_task_dependencies=True)
+    backend.add_tasks([], (tmp_path / 'out').as_uri())
+    summary = backend.wait_for_tasks_to_complete(datetime.timedelta(minutes=1))
+    return backend, summary
+
+
+def test_failed_dependency_satisfied_on_failure_still_runs_the_dependant(tmp_path, monkeypatch):
+    backend, summary = _run(tmp_path, monkeypatch, [
+        _task('Task0-seg000', 'exit 1', exit_conditions=SATISFY_ON_FAILURE),
+        _task('Task0', 'exit 2', depends_on=['Task0-seg000']),
+        _task('Other', 'exit 1'),
+        _task('Blocked', 'exit 0', depends_on=['Other']),
+    ])
+    assert backend._results['Task0']['exit_code'] == 2
+    assert backend._results['Blocked'].get('blocked')
+    assert sorted(summary['failed_task_ids']) == ['Blocked', 'Other', 'Task0', 'Task0-seg000']
+
+
+def test_task_that_raises_in_the_worker_is_recorded_as_failed(tmp_path, monkeypatch):
+    missing = batchmodels.ResourceFile(http_url=(tmp_path / 'missing.mp4').as_uri(), file_path='in.mp4')
+    backend, summary = _run(tmp_path, monkeypatch, [
+        _task('Broken', 'exit 0', resource_files=[missing]),
+        _task('Fine', 'exit 0'),
+    ])
+    assert backend._results['Broken']['exit_code'] is None
+    assert 'missing.mp4' in backend._results['Broken']['error']
+    assert summary['failed_task_ids'] == ['Broken'] and summary['succeeded'] == 1
@@ -0,0 +1,38 @@
+from azure.batch import models as batchmodels
+
+import batch_python_tutorial_ffmpeg as orch
+
+
+def _resource_files(*names):
+    return [batchmodels.ResourceFile(file_path=name, http_url='https://example/' + name) for name in names]
+
+
+def test_packed_task_converts_every_input(task_dir, run_task):
+    task = orch._build_packed_task('Pack0', _resource_files('a.mp4', 'b.mp4'), 'https://out')
+    assert run_task(task, task_dir) == 0
+    assert (task_dir / 'a.mp3').read_text() == 'converted a.mp4\n'
+    assert (task_dir / 'b.mp3').read_text() == 'converted b.mp4\n'
+
+
+def test_packed_task_removes_output_of_failed_conversion(task_dir, run_task):
+    task = orch._build_packed_task('Pack0', _resource_files('bad.mp4', 'b.mp4'), 'https://out')
+    assert run_task(task, task_dir) == 1
+    # 途中まで書かれた出力はアップロードされないよう消え、後続の入力は変換される
+    assert not (task_dir / 'bad.mp3').exists()
+    assert (task_dir / 'b.mp3').exists()
+
+
+def test_packed_task_removes_every_profile_output_of_failed_conversion(task_dir, run_task):
+    profiles = [{'name': 'mp3', 'suffix': '.mp3', 'args': ''}, {'name': 'low', 'suffix': '_low.mp3', 'args': ''}]
+    (task_dir / 'bad.mp3').write_text('partial')
+    (task_dir / 'bad_low.mp3').write_text('partial')
+    task = orch._build_packed_task('Pack0', _resource_files('bad.mp4'), 'https://out', profiles)
+    assert run_task(task, task_dir) == 1
+    assert not (task_dir / 'bad.mp3').exists() and not (task_dir / 'bad_low.mp3').exists()
+
+
+def test_packed_task_uploads_outputs_on_task_completion():
+    task = orch._build_packed_task('Pack0', _resource_files('a.mp4', 'b.mp4'), 'https://out')
+    assert [of.file_pattern for of in task.output_files] == ['a.mp3', 'b.mp3']
+    assert {of.upload_options.upload_condition for of in task.output_files} == {
+        batchmodels.OutputFileUploadCondition.task_completion}
@@ -0,0 +1,117 @@
+import concurrent.futures
+import datetime
+import threading
+import time
+import types
+
+import batch_python_tutorial_ffmpeg as orch
+
+
+class FakeStorage:
+    """list_blob_properties / set_blob_metadata だけを持つ Storage のフェイク"""
+    def __init__(self, blobs=None):
+        self.blobs = dict(blobs or {})
+        self.list_calls = 0
+        self.metadata = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, metadata=None, last_modified=None):
+        self.blobs[name] = types.SimpleNamespace(
+            metadata=metadata or {},
+            last_modified=last_modified or datetime.datetime.now(datetime.timezone.utc))
+
+    def list_blob_properties(self, container_name):
+        with self._lock:
+            self.list_calls += 1
+        time.sleep(0.01)
+        return dict(self.blobs)
+
+    def set_blob_metadata(self, container_name, blob_name, metadata):
+        self.metadata[blob_name] = metadata
+
+
+def test_lookup_hits_when_all_outputs_have_the_key():
+    storage = FakeStorage()
+    cache = orch.ResultCache(storage, 'output')
+    key = cache.key_for('md5')
+    storage.add('a.mp3', {cache.METADATA_KEY: key})
+    storage.add('a.jpg', {cache.METADATA_KEY: key})
+    assert cache.lookup(['a.mp3', 'a.jpg'], 'md5')
+    assert cache.hits == 1 and cache._expected == {}
+
+
+def test_lookup_misses_on_missing_output_different_key_or_no_md5():
+    storage = FakeStorage()
+    cache = orch.ResultCache(storage, 'output')
+    storage.add('a.mp3', {cache.METADATA_KEY: cache.key_for('md5')})
+    storage.add('b.mp3', {cache.METADATA_KEY: cache.key_for('old')})
+    assert not cache.lookup(['a.mp3', 'a.jpg'], 'md5')
+    assert not cache.lookup(['b.mp3'], 'md5')
+    assert not cache.lookup(['c.mp3'], None)
+    assert cache.hits == 0
+    assert set(cache._expected) == {'a.mp3', 'a.jpg', 'b.mp3'}
+
+
+def test_lookup_key_depends_on_signature():
+    storage = FakeStorage()
+    storage.add('a.mp3', {orch.ResultCache.METADATA_KEY: orch.ResultCache(storage, 'output').key_for('md5')})
+    assert not orch.ResultCache(storage, 'output', signature='other').lookup(['a.mp3'], 'md5')
+
+
+def test_concurrent_lookups_load_the_listing_once():
+    storage = FakeStorage()
+    cache = orch.ResultCache(storage, 'output')
+    for i in range(0, 200, 2):
+        storage.add(f'f{i}.mp3', {cache.METADATA_KEY: cache.key_for(f'md5-{i}')})
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as pool:
+        hits = list(pool.map(lambda i: cache.lookup([f'f{i}.mp3'], f'md5-{i}'), range(200)))
+    assert storage.list_calls == 1
+    assert sum(hits) == cache.hits == 100
+    assert len(cache._expected) == 100
+
+
+def test_commit_records_keys_on_outputs_written_since_the_run_started():
+    storage = FakeStorage()
+    cache = orch.ResultCache(storage, 'output')
+    started = datetime.datetime.now(datetime.timezone.utc)
+    assert not cache.lookup(['new.mp3'], 'md5-new')
+    assert not cache.lookup(['stale.mp3'], 'md5-stale')
+    storage.add('new.mp3', {'source': 'x'}, last_modified=started + datetime.timedelta(seconds=1))
+    storage.add('stale.mp3', last_modified=started - datetime.timedelta(days=1))
+    assert cache.commit(since=started) == 1
+    assert storage.metadata == {'new.mp3': {'source': 'x', cache.METADATA_KEY: cache.key_for('md5-new')}}
+
+
+def test_commit_skips_outputs_of_failed_tasks():
+    storage = FakeStorage()
+    cache = orch.ResultCache(storage, 'output')
+    started = datetime.datetime.now(datetime.timezone.utc)
+    assert not cache.lookup(['ok.mp3'], 'md5-ok')
+    assert not cache.lookup(['failed.mp3'], 'md5-failed')
+    storage.add('ok.mp3', last_modified=started + datetime.timedelta(seconds=1))
+    storage.add('failed.mp3', last_modified=started + datetime.timedelta(seconds=1))
+    assert cache.commit(since=started, succeeded_outputs={'ok.mp3'}) == 1
+    assert set(storage.metadata) == {'ok.mp3'}
+
+
+def test_succeeded_output_names_lists_successful_tasks_only(monkeypatch):
+    def output_file(pattern, path=None):
+        return types.SimpleNamespace(file_pattern=pattern,
+                                     destination=types.SimpleNamespace(container=types.SimpleNamespace(path=path)))
+    calls = []
+
+    def fake_list_tasks(client, job_id, odata_filter=None, select='id', limit=None):
+        calls.append((odata_filter, select))
+        return [types.SimpleNamespace(id='Task0', output_files=[output_file('a.mp3'), output_file('a.jpg', 'thumbs/a.jpg')]),
+                types.SimpleNamespace(id='Task1', output_files=[output_file('../std*.txt', 'logs/Task1')])]
+    monkeypatch.setattr(orch, 'list_tasks', fake_list_tasks)
+    assert orch.succeeded_output_names(None, 'job') == {'a.mp3', 'thumbs/a.jpg'}
+    assert calls == [("executionInfo/result eq 'success'", 'id,outputFiles')]
+
+
+def test_drop_cached_inputs_keeps_only_inputs_without_cached_outputs():
+    storage = FakeStorage()
+    cache = orch.ResultCache(storage, 'output')
+    storage.add('a.mp3', {cache.METADATA_KEY: cache.key_for('md5-a')})
+    media_info = {'a.mp4': {'md5': 'md5-a'}, 'b.mp4': {'md5': 'md5-b'}}
+    assert orch.drop_cached_inputs(['in/a.mp4', 'in/b.mp4'], media_info, cache) == ['in/b.mp4']
@@ -0,0 +1,103 @@
+import datetime
+import types
+
+import pytest
+from azure.batch import models as batchmodels
+
+import batch_python_tutorial_ffmpeg as orch
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = orch.RunStateStore(str(tmp_path / 'state.sqlite'))
+    store.begin('job')
+    yield store
+    store.close()
+
+
+def _task(task_id, *inputs):
+    return batchmodels.TaskAddParameter(
+        id=task_id, command_line='x',
+        resource_files=[batchmodels.ResourceFile(file_path=name, http_url='https://example/' + name)
+                        for name in inputs])
+
+
+def _recorded(store):
+    return store._db.execute('SELECT task_id, inputs, succeeded FROM tasks ORDER BY task_id').fetchall()
+
+
+def test_pending_tasks_records_and_yields_new_tasks(store):
+    tasks = [_task(f'Task{i}', f'f{i}.mp4') for i in range(5)]
+    assert [t.id for t in store.pending_tasks(tasks, batch_size=2)] == [f'Task{i}' for i in range(5)]
+    assert _recorded(store) == [(f'Task{i}', f'f{i}.mp4', 0) for i in range(5)]
+
+
+def test_pending_tasks_skips_tasks_in_the_job_and_succeeded_tasks(store):
+    tasks = [_task(f'Task{i}', f'f{i}.mp4') for i in range(4)]
+    list(store.pending_tasks(tasks))
+    store.record_succeeded(['Task1'])
+    # 再開: Task0 はジョブに残っている。ジョブが消えていても成功済みの Task1 は再投入しない
+    assert [t.id for t in store.pending_tasks(tasks, existing_ids={'Task0'})] == ['Task2', 'Task3']
+
+
+def test_pending_tasks_records_skipped_tasks_so_they_can_be_marked_succeeded(store):
+    tasks = [_task('Task0', 'a.mp4'), _task('Task1', 'b.mp4')]
+    assert [t.id for t in store.pending_tasks(tasks, existing_ids={'Task0'})] == ['Task1']
+    store.record_succeeded(['Task0'])
+    assert [t.id for t in store.pending_tasks(tasks)] == ['Task1']
+
+
+def test_pending_tasks_rejects_changed_inputs(store):
+    list(store.pending_tasks([_task('Pack0', 'a.mp4', 'b.mp4')]))
+    with pytest.raises(RuntimeError):
+        list(store.pending_tasks([_task('Pack0', 'a.mp4', 'c.mp4')]))
+
+
+def test_begin_resume_requires_the_same_job(tmp_path):
+    path = str(tmp_path / 'state.sqlite')
+    store = orch.RunStateStore(path)
+    store.begin('job')
+    list(store.pending_tasks([_task('Task0', 'a.mp4')]))
+    store.close()
+    store = orch.RunStateStore(path)
+    store.begin('job', resume=True)
+    assert len(_recorded(store)) == 1
+    with pytest.raises(RuntimeError):
+        store.begin('other', resume=True)
+    store.begin('other')
+    assert _recorded(store) == []
+    store.close()
+
+
+def test_uploads_are_recorded_with_size_and_mtime(store, tmp_path):
+    path = tmp_path / 'a.mp4'
+    path.write_bytes(b'x')
+    assert not store.is_uploaded('a.mp4', str(path))
+    store.record_upload(('a.mp4', str(path)))
+    assert store.is_uploaded('a.mp4', str(path))
+    path.write_bytes(b'changed')
+    assert not store.is_uploaded('a.mp4', str(path))
+
+
+def test_on_poll_lists_only_tasks_that_succeeded_since_the_last_record(store):
+    list(store.pending_tasks([_task(f'Task{i}', f'f{i}.mp4') for i in range(3)]))
+    t0 = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+    succeeded = [types.SimpleNamespace(id='Task0', state_transition_time=t0)]
+    filters = []
+
+    def _list(job_id, task_list_options=None):
+        filters.append(task_list_options.filter)
+        return list(succeeded)
+
+    on_poll = store.on_poll(types.SimpleNamespace(task=types.SimpleNamespace(list=_list)), 'job', min_interval=0)
+    on_poll({'succeeded': 1})
+    on_poll({'succeeded': 1})
+    succeeded[:] = [types.SimpleNamespace(id='Task2', state_transition_time=t0 + datetime.timedelta(seconds=5))]
+    on_poll({'succeeded': 2})
+    assert filters == ["executionInfo/result eq 'success'",
+                       "executionInfo/result eq 'success' and "
+                       "stateTransitionTime ge datetime'2026-01-01T00:00:00.000000Z'"]
+    assert [row[0] for row in _recorded(store) if row[2]] == ['Task0', 'Task2']
+    # 終了時の記録も前回以降に遷移したタスクだけを一覧する
+    store.sync_succeeded(types.SimpleNamespace(task=types.SimpleNamespace(list=_list)), 'job')
+    assert filters[-1].endswith("stateTransitionTime ge datetime'2026-01-01T00:00:05.000000Z'")
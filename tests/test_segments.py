@@ -0,0 +1,30 @@
+import types
+
+import pytest
+
+import batch_python_tutorial_ffmpeg as orch
+
+
+def test_segment_ranges_cover_the_input_without_gaps():
+    ranges = orch._segment_ranges(1000, 300, 10)
+    assert len(ranges) == 4
+    assert ranges[0][0] == 0
+    for (start, length), (next_start, _) in zip(ranges, ranges[1:]):
+        assert start + length == pytest.approx(next_start)
+    # 最後のセグメントは終端まで（長さを指定しない）
+    assert ranges[-1] == (750.0, None)
+
+
+def test_segment_ranges_respect_max_segments_and_short_inputs():
+    assert len(orch._segment_ranges(3600, 60, 8)) == 8
+    assert orch._segment_ranges(10, 600, 8) == [(0.0, None)]
+
+
+def test_only_segment_task_ids_are_treated_as_depended_on():
+    input_file = types.SimpleNamespace(file_path='long.mp4', http_url='https://example/long.mp4')
+    tasks = orch._build_segmented_tasks('Task7', input_file, 'https://example/out', 1000, 300, 10)
+    merge = tasks[-1]
+    assert all(orch.StragglerPolicy._is_depended_on(t.id) for t in tasks[:-1])
+    assert set(merge.depends_on.task_ids) == {t.id for t in tasks[:-1]}
+    assert not orch.StragglerPolicy._is_depended_on(merge.id)
+    assert not orch.StragglerPolicy._is_depended_on('Task7-seg000' + orch.StragglerPolicy.DUPLICATE_SUFFIX)
@@ -0,0 +1,41 @@
+import pytest
+from azure.batch import models as batchmodels
+
+import batch_python_tutorial_ffmpeg as orch
+
+
+def _inputs(*names):
+    return [batchmodels.ResourceFile(file_path=name, http_url='https://example/' + name) for name in names]
+
+
+def _names(shards):
+    return {shard: [f.file_path for f in files] for shard, files in shards.items()}
+
+
+def test_split_balances_work_by_weight():
+    files = _inputs(*[f'f{i}.mp4' for i in range(12)])
+    shards = orch.split_inputs_across_shards(files, {'a': 2, 'b': 1})
+    assert len(shards['a']) == 8 and len(shards['b']) == 4
+    assert sorted(f.file_path for fs in shards.values() for f in fs) == sorted(f.file_path for f in files)
+
+
+def test_split_uses_durations_and_keeps_input_order():
+    files = _inputs('long.mp4', 's1.mp4', 's2.mp4', 's3.mp4')
+    media_info = {'long.mp4': {'duration': 300}, 's1.mp4': {'duration': 100},
+                  's2.mp4': {'duration': 100}, 's3.mp4': {'duration': 100}}
+    assert _names(orch.split_inputs_across_shards(files, {'a': 1, 'b': 1}, media_info)) == {
+        'a': ['long.mp4'], 'b': ['s1.mp4', 's2.mp4', 's3.mp4']}
+
+
+def test_split_falls_back_to_size():
+    files = _inputs('big.mp4', 'small1.mp4', 'small2.mp4')
+    media_info = {'big.mp4': {'size': 2000}, 'small1.mp4': {'size': 1000}, 'small2.mp4': {'size': 1000}}
+    assert _names(orch.split_inputs_across_shards(files, {'a': 1, 'b': 1}, media_info)) == {
+        'a': ['big.mp4'], 'b': ['small1.mp4', 'small2.mp4']}
+
+
+def test_split_skips_zero_weight_shards():
+    shards = orch.split_inputs_across_shards(_inputs('a.mp4', 'b.mp4'), {'a': 1, 'off': 0})
+    assert _names(shards) == {'a': ['a.mp4', 'b.mp4'], 'off': []}
+    with pytest.raises(ValueError):
+        orch.split_inputs_across_shards(_inputs('a.mp4'), {'off': 0})
@@ -0,0 +1,23 @@
+from azure.batch import models as batchmodels
+
+import batch_python_tutorial_ffmpeg as orch
+
+
+def _task(task_id, command_line='/bin/bash -c "ffmpeg -i a.mp4 a.mp3"'):
+    return batchmodels.TaskAddParameter(id=task_id, command_line=command_line)
+
+
+def test_chunk_tasks_splits_by_count_and_keeps_order():
+    chunks = list(orch._chunk_tasks((_task(f'Task{i}') for i in range(7)), max_tasks=3))
+    assert [len(c) for c in chunks] == [3, 3, 1]
+    assert [t.id for c in chunks for t in c] == [f'Task{i}' for i in range(7)]
+
+
+def test_chunk_tasks_splits_by_payload_size():
+    tasks = [_task(f'Task{i}', 'x' * 1000) for i in range(5)]
+    size = orch._task_payload_size(tasks[0])
+    chunks = list(orch._chunk_tasks(tasks, max_tasks=100, max_bytes=size * 2))
+    assert [len(c) for c in chunks] == [2, 2, 1]
+    # 上限より大きい 1 タスクはそれだけでチャンクになる
+    assert [len(c) for c in orch._chunk_tasks(tasks[:2], max_bytes=size // 2)] == [1, 1]
+    assert list(orch._chunk_tasks([])) == []
@@ -0,0 +1,36 @@
+from azure.batch import models as batchmodels
+
+import batch_python_tutorial_ffmpeg as orch
+
+
+def _resource_files(*names):
+    return [batchmodels.ResourceFile(file_path=name, http_url='https://example/' + name) for name in names]
+
+
+def _markers(cwd):
+    return [line.split()[0] for line in (cwd / orch.TIMING_MARKER_FILE).read_text().splitlines()]
+
+
+def test_timing_markers_record_end_of_packed_command(task_dir, run_task):
+    task = orch._with_timing_markers(orch._build_packed_task('Pack0', _resource_files('a.mp4', 'b.mp4'), 'https://out'))
+    assert run_task(task, task_dir) == 0
+    assert _markers(task_dir) == ['start', 'end']
+    assert (task_dir / 'a.mp3').exists() and (task_dir / 'b.mp3').exists()
+
+
+def test_timing_markers_keep_exit_code_of_failed_packed_command(task_dir, run_task):
+    task = orch._with_timing_markers(orch._build_packed_task('Pack0', _resource_files('a.mp4', 'bad.mp4'), 'https://out'))
+    assert run_task(task, task_dir) == 1
+    assert _markers(task_dir) == ['start', 'end']
+    assert (task_dir / 'a.mp3').exists()
+
+
+def test_timing_markers_wrap_single_input_command(task_dir, run_task):
+    task = orch._with_timing_markers(orch._build_ffmpeg_task('Task0', _resource_files('bad.mp4')[0], 'https://out'))
+    assert run_task(task, task_dir) == 3
+    assert _markers(task_dir) == ['start', 'end']
+
+
+def test_timing_markers_leave_other_commands_unchanged():
+    task = batchmodels.TaskAddParameter(id='t', command_line='cmd /c echo hi')
+    assert orch._with_timing_markers(task).command_line == 'cmd /c echo hi'
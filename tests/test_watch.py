@@ -0,0 +1,106 @@
+import os
+import re
+
+import pytest
+
+import batch_python_tutorial_ffmpeg as orch
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(orch.time, 'monotonic', clock)
+    return clock
+
+
+def _write(path, data, mtime_ns=None):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_poll_reports_a_file_once_it_has_settled(tmp_path, clock):
+    path = str(tmp_path / 'sub' / 'a.mp4')
+    _write(path, b'x', mtime_ns=1)
+    _write(str(tmp_path / 'notes.txt'), b'ignored')
+    watcher = orch.InputDirectoryWatcher(str(tmp_path), settle_seconds=30)
+    assert watcher.poll() == []
+    clock.now += 10
+    assert watcher.poll() == []
+    clock.now += 20
+    assert watcher.poll() == [path]
+    # 変更されない限り再び報告しない
+    clock.now += 60
+    assert watcher.poll() == []
+
+
+def test_poll_waits_for_a_growing_file(tmp_path, clock):
+    path = str(tmp_path / 'a.mp4')
+    _write(path, b'x', mtime_ns=1)
+    watcher = orch.InputDirectoryWatcher(str(tmp_path), settle_seconds=30)
+    watcher.poll()
+    clock.now += 25
+    _write(path, b'xx', mtime_ns=2)
+    clock.now += 10
+    assert watcher.poll() == []
+    clock.now += 30
+    assert watcher.poll() == [path]
+
+
+def test_poll_reports_changed_and_recreated_files_again(tmp_path, clock):
+    path = str(tmp_path / 'a.MP4')
+    _write(path, b'x', mtime_ns=1)
+    watcher = orch.InputDirectoryWatcher(str(tmp_path), settle_seconds=0)
+    watcher.poll()
+    assert watcher.poll() == [path]
+    _write(path, b'changed', mtime_ns=2)
+    watcher.poll()
+    assert watcher.poll() == [path]
+    os.remove(path)
+    assert watcher.poll() == [] and path not in watcher.reported
+    _write(path, b'changed', mtime_ns=2)
+    watcher.poll()
+    assert watcher.poll() == [path]
+
+
+def test_forget_makes_a_file_reported_again_after_it_settles(tmp_path, clock):
+    path = str(tmp_path / 'a.mp4')
+    _write(path, b'x', mtime_ns=1)
+    watcher = orch.InputDirectoryWatcher(str(tmp_path), settle_seconds=30)
+    watcher.poll()
+    clock.now += 30
+    assert watcher.poll() == [path]
+    watcher.forget([path])
+    assert watcher.poll() == []
+    clock.now += 30
+    assert watcher.poll() == [path]
+
+
+def test_poll_of_missing_directory_returns_nothing(tmp_path):
+    assert orch.InputDirectoryWatcher(str(tmp_path / 'missing')).poll() == []
+
+
+def test_stable_task_id_depends_on_name_and_content_signature():
+    task_id = orch.stable_task_id('a.mp4', 10, 1)
+    assert task_id == orch.stable_task_id('a.mp4', 10, 1)
+    assert task_id.startswith('File-a-')
+    assert len({task_id, orch.stable_task_id('a.mp4', 11, 1), orch.stable_task_id('a.mp4', 10, 2),
+                orch.stable_task_id('b.mp4', 10, 1)}) == 4
+
+
+def test_stable_task_id_is_a_valid_batch_task_id():
+    task_id = orch.stable_task_id('dir/My Clip (final)' + 'x' * 100 + '.mp4', 1, 1, prefix='Watch')
+    assert re.fullmatch(r'[A-Za-z0-9_-]{1,64}', task_id)
+    assert task_id.startswith('Watch-My_Clip__final_')
+    # 長い名前を同じ長さに切り詰めても、ハッシュで区別される
+    assert task_id != orch.stable_task_id('dir/My Clip (final)' + 'x' * 101 + '.mp4', 1, 1, prefix='Watch')